@@ -0,0 +1,184 @@
+# Benchmark allocateRooms across engines and solvers on synthetic rosters
+# Reports wall time, peak traced memory and allocation quality per
+# configuration, and fails when a run regresses against the stored baseline.
+#
+# Usage (from the backend directory):
+#   python benchmarks/bench_allocation.py [--preset small] [--engines python,numpy,indexed]
+#   python benchmarks/bench_allocation.py --preset medium --update-baseline
+#   python benchmarks/bench_allocation.py --thresholds 0.5,0.6,0.7
+# Wall time is compared with a tolerance factor since it depends on the
+# machine; quality (total score and assigned users) is deterministic for a
+# seed and must not drop at all.
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from main.algorithm import allocateRooms, ENGINES, SOLVERS, MODES
+from main.policy import DEFAULT_POLICY, ScoringPolicy
+from generator import generateRoster, UNAVAILABILITY_PATTERNS
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Roster sizes: (users, rooms, equipment)
+PRESETS = {
+    'small': (1000, 100, 50),
+    'medium': (10000, 1000, 100),
+    'large': (100000, 5000, 200)
+}
+
+def runOnce(roster, engine, solver, mode='week', slots=1, improveTime=0, policy=None):
+    """Time one allocation; returns (seconds, stats)"""
+    start = time.perf_counter()
+    result = allocateRooms(roster['users'], roster['rooms'], engine=engine, solver=solver,
+                           mode=mode, slots=slots, improveTime=improveTime, policy=policy)
+    return time.perf_counter() - start, result['stats']
+
+def measure(roster, engine, solver, repeat, mode='week', slots=1, improveTime=0, policy=None):
+    """
+    Benchmark one engine and solver pair
+    Timing runs are separate from the traced run since tracemalloc slows
+    allocation-heavy code considerably
+
+    Returns:
+        dict: best wallTime, peakMemory in bytes, totalScore and assignedUsers
+    """
+    timings = []
+    for _ in range(repeat):
+        elapsed, stats = runOnce(roster, engine, solver, mode, slots, improveTime, policy)
+        timings.append(elapsed)
+
+    tracemalloc.start()
+    runOnce(roster, engine, solver, mode, slots, improveTime, policy)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'wallTime': min(timings),
+        'peakMemory': peak,
+        'totalScore': stats['totalScore'],
+        'assignedUsers': stats['assignedUsers']
+    }
+
+def findRegressions(key, result, baseline, timeTolerance, memoryTolerance, timeSlack=0.05):
+    """
+    List human readable regressions of result against its baseline entry
+    Slowdowns under timeSlack seconds are ignored so millisecond runs do not flake
+    """
+    problems = []
+    if result['assignedUsers'] < baseline['assignedUsers']:
+        problems.append(f"{key}: assignedUsers {result['assignedUsers']} < {baseline['assignedUsers']}")
+    if result['totalScore'] < baseline['totalScore'] - 1e-6:
+        problems.append(f"{key}: totalScore {result['totalScore']:.4f} < {baseline['totalScore']:.4f}")
+    if result['wallTime'] > max(baseline['wallTime'] * timeTolerance, baseline['wallTime'] + timeSlack):
+        problems.append(f"{key}: wallTime {result['wallTime']:.3f}s > {timeTolerance}x {baseline['wallTime']:.3f}s")
+    if result['peakMemory'] > baseline['peakMemory'] * memoryTolerance:
+        problems.append(f"{key}: peakMemory {result['peakMemory']} > {memoryTolerance}x {baseline['peakMemory']}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark allocateRooms on synthetic rosters')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--solvers', default=','.join(SOLVERS))
+    parser.add_argument('--chemical-ratio', type=float, default=0.5)
+    parser.add_argument('--equipment-density', type=float, default=0.2)
+    parser.add_argument('--unavailability', choices=UNAVAILABILITY_PATTERNS, default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mode', choices=MODES, default='week')
+    parser.add_argument('--slots', type=int, default=1)
+    parser.add_argument('--improve', type=float, default=0,
+                        help='Seconds of local search after Phase 1')
+    parser.add_argument('--policy', type=json.loads, default={},
+                        help='JSON object of scoring policy parameters')
+    parser.add_argument('--thresholds', default='',
+                        help='Comma separated thresholds to sweep with the policy')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--time-tolerance', type=float, default=1.5)
+    parser.add_argument('--memory-tolerance', type=float, default=1.2)
+    parser.add_argument('--time-slack', type=float, default=0.05,
+                        help='Seconds of slowdown always tolerated')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Record these results as the new baseline instead of comparing')
+    args = parser.parse_args()
+
+    users, rooms, equipment = PRESETS[args.preset]
+    roster = generateRoster(
+        users=users,
+        rooms=rooms,
+        equipment=equipment,
+        chemicalRatio=args.chemical_ratio,
+        equipmentDensity=args.equipment_density,
+        unavailability=args.unavailability,
+        seed=args.seed
+    )
+    scenario = (f'{args.preset}-chem{args.chemical_ratio}-density{args.equipment_density}'
+                f'-{args.unavailability}-seed{args.seed}')
+    if args.mode != 'week':
+        scenario += f'-{args.mode}{args.slots}'
+    if args.improve:
+        scenario += f'-improve{args.improve}'
+
+    # Non-default policies get their own baseline entries
+    basePolicy = ScoringPolicy.fromDocument(args.policy)
+    if args.thresholds:
+        policies = [ScoringPolicy.fromDocument({'threshold': float(t)}, basePolicy)
+                    for t in args.thresholds.split(',')]
+    else:
+        policies = [basePolicy]
+
+    print(f'{scenario}: {users} users, {rooms} rooms, {equipment} equipment')
+    print(f"{'engine':>8} {'solver':>8} {'threshold':>9} {'wall (s)':>10} {'peak (MB)':>10} "
+          f"{'assigned':>9} {'score':>10}")
+    results = {}
+    for policy in policies:
+        policySuffix = ''
+        if policy != DEFAULT_POLICY:
+            policySuffix = '/' + ','.join(
+                f'{name}={value}' for name, value in policy.toDocument().items()
+                if value != getattr(DEFAULT_POLICY, name)
+            )
+        for engine in args.engines.split(','):
+            for solver in args.solvers.split(','):
+                result = measure(roster, engine, solver, args.repeat, args.mode, args.slots,
+                                 args.improve, policy)
+                results[f'{scenario}/{engine}/{solver}{policySuffix}'] = result
+                print(f"{engine:>8} {solver:>8} {policy.threshold:>9} {result['wallTime']:>10.3f} "
+                      f"{result['peakMemory'] / 2 ** 20:>10.1f} {result['assignedUsers']:>9} "
+                      f"{result['totalScore']:>10.2f}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return
+
+    problems = []
+    for key, result in results.items():
+        if key not in baseline:
+            print(f'{key}: no baseline entry, skipped')
+            continue
+        problems.extend(findRegressions(key, result, baseline[key],
+                                        args.time_tolerance, args.memory_tolerance,
+                                        args.time_slack))
+    if problems:
+        print('Regressions against baseline:')
+        for problem in problems:
+            print(f'  {problem}')
+        sys.exit(1)
+    print('No regressions against baseline')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Benchmark equipment name enrichment in Database.usersGet
+# Compares the in-process python join with the MongoDB aggregation pipeline.
+#
+# Usage (from the backend directory):
+#   python benchmarks/bench_users.py [--users N] [--equipment N] [--uri mongodb://localhost:27017/]
+# Without --uri the benchmark runs against mongomock, which measures the
+# pipeline's correctness and rough shape only; use a local mongod for real numbers.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from main.data import Database, USER_ENRICHMENTS
+from generator import generateEquipment, generateUsers
+
+def seedDatabase(database, userCount, equipmentCount, seed=0):
+    """Replace users and equipment with a seeded synthetic data set"""
+    rng = random.Random(seed)
+    equipment = generateEquipment(equipmentCount, rng)
+    database.db['users'].drop()
+    database.db['equipment'].drop()
+    database.db['equipment'].insert_many(equipment)
+    database.db['users'].insert_many(generateUsers(userCount, equipment, rng, maxEquipment=8))
+    database.invalidateEquipmentCache()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark usersGet equipment enrichment')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--equipment', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--uri', default=None, help='MongoDB URI, mongomock when omitted')
+    args = parser.parse_args()
+
+    database = Database(args.uri or "mongodb://localhost:27017/")
+    if args.uri is None:
+        import mongomock
+        database.client = mongomock.MongoClient()
+    database.db = database.client['usersBenchmark']
+    seedDatabase(database, args.users, args.equipment)
+
+    results = {}
+    for enrichment in USER_ENRICHMENTS:
+        timings = []
+        for _ in range(args.repeat):
+            # Cold catalog cache so both paths pay for the equipment read
+            database.invalidateEquipmentCache()
+            start = time.perf_counter()
+            results[enrichment] = database.usersGet(enrichment=enrichment)
+            timings.append(time.perf_counter() - start)
+        print(f'{enrichment:>10}: best {min(timings) * 1000:8.1f} ms over {args.repeat} runs')
+
+    if results['python'] != results['aggregate']:
+        print('Enrichment results differ')
+        sys.exit(1)
+
+    database.client.drop_database('usersBenchmark')
+
+if __name__ == '__main__':
+    main()
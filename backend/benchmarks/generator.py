@@ -0,0 +1,104 @@
+# Seeded synthetic roster generator for benchmarks
+# Produces equipment catalogs, rooms and users shaped like the documents in
+# mongo-data, at any size and with controllable constraint mixes.
+import random
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+
+ROOM_CAPACITIES = [10, 20, 25, 40, 60, 100]
+
+# Unavailability patterns supported by generateUsers
+UNAVAILABILITY_PATTERNS = ('none', 'random', 'partTime')
+
+def generateEquipment(count, rng, dependencyRate=0.3):
+    """
+    Generate an equipment catalog
+    Each item depends on an earlier item with probability dependencyRate,
+    giving dependency chains like Pipette -> Beaker -> Workbench
+    """
+    return [
+        {
+            '_id': i,
+            'name': f'Equipment {i}',
+            'dependentId': rng.randint(1, i - 1) if i > 1 and rng.random() < dependencyRate else None
+        }
+        for i in range(1, count + 1)
+    ]
+
+def generateRooms(count, equipment, rng, chemicalRatio=0.5, equipmentDensity=0.2):
+    """
+    Generate rooms
+    Each room holds each catalog item with probability equipmentDensity
+    """
+    return [
+        {
+            '_id': i,
+            'name': f'Room {i}',
+            'attributes': {
+                'capacity': rng.choice(ROOM_CAPACITIES),
+                'chemicalUse': rng.random() < chemicalRatio,
+                'equipment': [
+                    {'_id': item['_id'], 'quantity': rng.randint(1, 30)}
+                    for item in equipment
+                    if rng.random() < equipmentDensity
+                ]
+            }
+        }
+        for i in range(1, count + 1)
+    ]
+
+def generateUnavailability(pattern, rng):
+    """
+    Generate one user's unavailability
+    - 'none': available every day
+    - 'random': each day unavailable with probability 0.3
+    - 'partTime': available on one to three random days
+    """
+    if pattern == 'none':
+        return {day: False for day in DAYS}
+    if pattern == 'random':
+        return {day: rng.random() < 0.3 for day in DAYS}
+    availableDays = set(rng.sample(DAYS, rng.randint(1, 3)))
+    return {day: day not in availableDays for day in DAYS}
+
+def generateUsers(count, equipment, rng, chemicalRatio=0.5, maxEquipment=4,
+                  unavailability='random'):
+    """
+    Generate users with room preferences
+    Each user requests between zero and maxEquipment distinct catalog items
+    """
+    if unavailability not in UNAVAILABILITY_PATTERNS:
+        raise ValueError(f"Unknown unavailability pattern: {unavailability}")
+    return [
+        {
+            '_id': i,
+            'name': f'User {i}',
+            'isManager': False,
+            'unavailability': generateUnavailability(unavailability, rng),
+            'roomPreference': {
+                'capacity': rng.randint(1, 60),
+                'chemicalUse': rng.random() < chemicalRatio,
+                'equipment': [
+                    {'_id': item['_id'], 'quantity': rng.randint(1, 20)}
+                    for item in rng.sample(equipment, min(len(equipment), rng.randint(0, maxEquipment)))
+                ]
+            }
+        }
+        for i in range(1, count + 1)
+    ]
+
+def generateRoster(users=1000, rooms=100, equipment=50, chemicalRatio=0.5,
+                   equipmentDensity=0.2, maxUserEquipment=4, unavailability='random', seed=0):
+    """
+    Generate a complete roster from a single seed
+
+    Returns:
+        dict: 'equipment', 'rooms' and 'users' document lists
+    """
+    rng = random.Random(seed)
+    catalog = generateEquipment(equipment, rng)
+    return {
+        'equipment': catalog,
+        'rooms': generateRooms(rooms, catalog, rng, chemicalRatio, equipmentDensity),
+        'users': generateUsers(users, catalog, rng, chemicalRatio, maxUserEquipment, unavailability)
+    }
@@ -1,94 +1,61 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from main.scoring import calculateScoreMatrix
+from main.roomindex import RoomIndex
+from main.models import DAYS, Assignment, Booking, User, Room, toUsers, toRooms
+from main.metrics import metrics
+from main.dependencies import expandUsers
+from main.policy import DEFAULT_POLICY
+
+# Scoring engines supported by assignRoomsToUsers
+ENGINES = ('python', 'numpy', 'indexed')
+
+# Phase 1 assignment strategies supported by assignRoomsToUsers
+SOLVERS = ('greedy', 'optimal')
+
+# Scheduling modes supported by allocateRooms
+# - 'week': one room per user, used on every day they are available
+# - 'daily': a room per user per available day, in one of a number of time slots
+MODES = ('week', 'daily')
+
 def calculateRoomScore(user, room):
     """
     Calculate compatibility score between user and room with strict chemical preference
     Returns score between 0 and 1, or None if room is incompatible
+    Accepts user and room documents; the allocation engines call scoreRoom directly
     Time Complexity: O(E) where E is number of equipment items
     """
-    # Strict chemical safety check - immediate disqualification if mismatch
-    if user['roomPreference']['chemicalUse'] != room['attributes']['chemicalUse']:
-        return None
-
-    # Scoring weights for different criteria
-    weights = {
-        'capacity': 0.3,  # 30% weight for capacity match
-        'equipment': 0.7  # 70% weight for equipment match
-    }
-
-    # Capacity scoring (0.2 to 1.0):
-    # - If room is too small: 0.2 score
-    # - Otherwise: ratio of required/available + 0.2, capped at 1.0
-    requiredCapacity = user['roomPreference']['capacity']
-    roomCapacity = room['attributes']['capacity']
+    return scoreRoom(User.fromDocument(user), Room.fromDocument(room))
 
-    if roomCapacity < requiredCapacity:
-        capacityScore = 0.2  # Penalty for undersized rooms
-    else:
-        capacityRatio = requiredCapacity / roomCapacity
-        capacityScore = min(1.0, capacityRatio + 0.2)  # Bonus for right-sized rooms
-
-    # Equipment scoring (0 to 1.0):
-    # Convert equipment lists to dictionaries for O(1) lookup
-    equipmentScore = 0
-    userEquipment = {eq['_id']: eq['quantity'] for eq in user['roomPreference']['equipment']}
-    roomEquipment = {eq['_id']: eq['quantity'] for eq in room['attributes']['equipment']}
-
-    if userEquipment:
-        matches = 0
-        totalItems = len(userEquipment)
-
-        # Calculate partial matches for each equipment
-        for eqId, requiredQty in userEquipment.items():
-            availableQty = roomEquipment.get(eqId, 0)
-            if availableQty >= requiredQty:
-                matches += 1  # Full match
-            elif availableQty > 0:
-                matches += (availableQty / requiredQty)  # Partial match
-
-        equipmentScore = matches / totalItems
-    else:
-        equipmentScore = 1.0  # No equipment requirements means perfect match
-
-    # Calculate weighted final score
-    finalScore = (
-        capacityScore * weights['capacity'] +
-        equipmentScore * weights['equipment']
-    )
-
-    return finalScore
-
-def assignRoomsToUsers(users, rooms):
+def scoreRoom(user, room, policy=None):
     """
-    Assign rooms to users for the week, ensuring chemical preferences are strictly followed
-    
-    Time Complexity: O(U * R * E) where:
-    - U is number of users
-    - R is number of rooms
-    - E is max number of equipment items
-    
-    Space Complexity: O(U + R) for assignments and timetable storage
+    Calculate compatibility score between a User and a Room model
+    Returns score between 0 and 1, or None if room is incompatible
+    The engines call policy.scoreRoom, the compiled kernel, directly
+    Time Complexity: O(E) where E is number of equipment items
     """
-    days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+    return (policy or DEFAULT_POLICY).scoreRoom(user, room)
 
-    # Remove users unavailable for entire week
-    availableUsers = [
-        user for user in users
-        if not all(user['unavailability'][day] for day in days)
-    ]
-
-    def getUserPriority(user):
-        priority = 0
-        # More equipment needs = higher priority (x10 weight)
-        priority += len(user['roomPreference']['equipment']) * 10
-        # Higher capacity needs = higher priority
-        priority += user['roomPreference']['capacity']
-        return priority
+def assignBestRooms(sortedUsers, rooms, counters=None, policy=DEFAULT_POLICY):
+    """
+    Greedy best-room assignment scoring each user and room pair with the policy's kernel
+    Users claim rooms in the given order; a claimed room is unavailable to later users
 
-    # Sort users by priority (most demanding first)
-    sortedUsers = sorted(availableUsers, key=getUserPriority, reverse=True)
+    Args:
+        counters: Optional dict whose 'scoreEvaluations' count is increased
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        dict: Mapping of user id to Assignment
+    """
     availableRooms = rooms.copy()
     userRoomAssignments = {}
+    evaluations = 0
+    score = policy.scoreRoom
+    threshold = policy.threshold
 
-    # Phase 1: Assign best matching rooms to users
     for user in sortedUsers:
         bestRoom = None
         bestScore = 0
@@ -97,43 +64,534 @@ def assignRoomsToUsers(users, rooms):
         # Filter for chemical compatibility first
         compatibleRooms = [
             (i, room) for i, room in enumerate(availableRooms)
-            if room['attributes']['chemicalUse'] == user['roomPreference']['chemicalUse']
+            if room.chemicalUse == user.chemicalUse
         ]
 
         # Find best matching room among compatible ones
+        evaluations += len(compatibleRooms)
         for i, room in compatibleRooms:
-            score = calculateRoomScore(user, room)
-            if score is not None and score > bestScore:
-                bestScore = score
+            roomScore = score(user, room)
+            if roomScore is not None and roomScore > bestScore:
+                bestScore = roomScore
                 bestRoom = room
                 bestRoomIdx = i
 
-        # Only assign if match is good enough (>60% compatibility)
-        if bestRoom and bestScore > 0.6:
-            userRoomAssignments[user['_id']] = {
-                'room_id': bestRoom['_id'],
-                'room_name': bestRoom['name'],
-                'score': bestScore
-            }
+        # Only assign if match is good enough (above the policy threshold, 60% by default)
+        if bestRoom and bestScore > threshold:
+            userRoomAssignments[user.id] = Assignment(user.id, bestRoom.id, bestRoom.name, bestScore)
             availableRooms.pop(bestRoomIdx)
 
-    # Phase 2: Create weekly timetable
-    timetable = {day: [] for day in days}
+    if counters is not None:
+        counters['scoreEvaluations'] += evaluations
+    return userRoomAssignments
+
+def assignBestRoomsVectorised(sortedUsers, rooms, counters=None, scores=None, policy=DEFAULT_POLICY):
+    """
+    Greedy best-room assignment driven by a precomputed score matrix
+    Users claim rooms in the given order exactly as the scalar pass does,
+    but each user's best room is found with a single argmax over the matrix row
+
+    Args:
+        counters: Optional dict whose 'scoreEvaluations' count is increased
+        scores: Optional score matrix from ScoreCache.matrix, computed when None;
+            it is modified in place
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        dict: Mapping of user id to Assignment
+    """
+    userRoomAssignments = {}
+    if not sortedUsers or not rooms:
+        return userRoomAssignments
+
+    # Incompatible pairs (NaN) can never be chosen
+    if scores is None:
+        scores = calculateScoreMatrix(sortedUsers, rooms, policy)
+        if counters is not None:
+            counters['scoreEvaluations'] += int(scores.size - np.count_nonzero(np.isnan(scores)))
+    scores[np.isnan(scores)] = -np.inf
+
+    for u, user in enumerate(sortedUsers):
+        # argmax returns the first best room, matching the scalar tie-break
+        bestRoomIdx = int(np.argmax(scores[u]))
+        bestScore = scores[u, bestRoomIdx]
+
+        # Only assign if match is good enough (above the policy threshold)
+        if bestScore > policy.threshold:
+            bestRoom = rooms[bestRoomIdx]
+            userRoomAssignments[user.id] = Assignment(
+                user.id, bestRoom.id, bestRoom.name, float(bestScore)
+            )
+            # Room is no longer available to anyone else
+            scores[:, bestRoomIdx] = -np.inf
+
+    return userRoomAssignments
+
+def assignBestRoomsIndexed(sortedUsers, rooms, counters=None, policy=DEFAULT_POLICY):
+    """
+    Greedy best-room assignment using a RoomIndex
+    Gives the same assignments as assignBestRooms, but candidate rooms are
+    retrieved from the user's chemicalUse group in capacity order and rooms
+    that cannot beat the current best or the threshold are never scored
+
+    Args:
+        counters: Optional dict whose 'scoreEvaluations' and 'roomsPruned'
+            counts are increased by the index's own counters
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        dict: Mapping of user id to Assignment
+    """
+    index = RoomIndex(rooms, policy)
+    userRoomAssignments = {}
+
+    for user in sortedUsers:
+        # Only rooms scoring above the policy threshold are returned
+        bestRoomIdx, bestScore = index.bestRoom(user)
+        if bestRoomIdx is not None:
+            bestRoom = rooms[bestRoomIdx]
+            userRoomAssignments[user.id] = Assignment(user.id, bestRoom.id, bestRoom.name, bestScore)
+            index.remove(bestRoomIdx)
+
+    if counters is not None:
+        counters['scoreEvaluations'] += index.evaluations
+        counters['roomsPruned'] += index.pruned
+    return userRoomAssignments
+
+def calculateScoreMatrixScalar(users, rooms, policy=DEFAULT_POLICY):
+    """
+    Build the user x room score matrix one pair at a time with the policy's kernel
+    Incompatible pairs are NaN, matching calculateScoreMatrix
+    """
+    scoreRoom = policy.scoreRoom
+    scores = np.full((len(users), len(rooms)), np.nan)
+    for u, user in enumerate(users):
+        for r, room in enumerate(rooms):
+            score = scoreRoom(user, room)
+            if score is not None:
+                scores[u, r] = score
+    return scores
+
+def assignOptimalRooms(sortedUsers, rooms, engine='python', counters=None, scores=None,
+                       policy=DEFAULT_POLICY):
+    """
+    Globally optimal room assignment maximising the total compatibility score
+    Solves a rectangular min-cost matching separately for chemical and
+    non-chemical users, since the two groups can never share rooms.
+    Pairs at or below the policy threshold are never matched.
+
+    Args:
+        counters: Optional dict whose 'scoreEvaluations' count is increased
+        scores: Optional score matrix of every user and room from
+            ScoreCache.matrix, scored by the engine when None
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        dict: Mapping of user id to Assignment
+
+    Time Complexity: O(U * R * E) to score plus O(U * R * min(U, R)) to match
+    """
+    # Imported here so loading the module does not pay for scipy
+    from scipy.optimize import linear_sum_assignment
+
+    userRoomAssignments = {}
+
+    for chemicalUse in (True, False):
+        userRows = [u for u, user in enumerate(sortedUsers) if user.chemicalUse == chemicalUse]
+        roomColumns = [r for r, room in enumerate(rooms) if room.chemicalUse == chemicalUse]
+        if not userRows or not roomColumns:
+            continue
+        partitionUsers = [sortedUsers[u] for u in userRows]
+        partitionRooms = [rooms[r] for r in roomColumns]
+
+        if scores is not None:
+            partitionScores = scores[np.ix_(userRows, roomColumns)]
+        else:
+            if engine == 'numpy':
+                partitionScores = calculateScoreMatrix(partitionUsers, partitionRooms, policy)
+            else:
+                partitionScores = calculateScoreMatrixScalar(partitionUsers, partitionRooms, policy)
+            if counters is not None:
+                counters['scoreEvaluations'] += partitionScores.size
+
+        # Pairs below the threshold contribute nothing, so the solver never prefers them
+        eligible = np.nan_to_num(partitionScores, nan=0.0) > policy.threshold
+        weights = np.where(eligible, partitionScores, 0.0)
+        userIdx, roomIdx = linear_sum_assignment(weights, maximize=True)
+
+        for u, r in zip(userIdx, roomIdx):
+            if not eligible[u, r]:
+                continue
+            user = partitionUsers[u]
+            room = partitionRooms[r]
+            userRoomAssignments[user.id] = Assignment(user.id, room.id, room.name, float(partitionScores[u, r]))
+
+    return userRoomAssignments
+
+def assignDailyRooms(sortedUsers, rooms, slots=1, counters=None, policy=DEFAULT_POLICY):
+    """
+    Greedy room x day x slot assignment
+    Users claim, in the given order, their best free room on each day they are
+    available, taking the earliest time slot that offers their best score.
+    Each day and slot has its own RoomIndex of free rooms, copied from one
+    shared base, so a room taken on Monday is still free on Tuesday.
+
+    Args:
+        slots: Time slots per day, each room can be booked once per slot
+        counters: Optional dict whose 'scoreEvaluations' and 'roomsPruned'
+            counts are increased
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        list: Bookings in user order, then day order
+
+    Time Complexity: O(U * D * S * R * E) worst case, typically far less as
+    each lookup stops at the user's best possible score
+    """
+    base = RoomIndex(rooms, policy)
+    indexes = [[base.copy() for _ in range(slots)] for _ in DAYS]
+    bookings = []
+
+    for user in sortedUsers:
+        # Best score over all rooms, which no free room can beat
+        _, idealScore = base.bestRoom(user)
+        if not idealScore:
+            continue
+
+        for dayIdx in range(len(DAYS)):
+            if not user.availability >> dayIdx & 1:
+                continue
+            bestRoomIdx, bestScore, bestSlot = None, 0, None
+            for slot, index in enumerate(indexes[dayIdx]):
+                roomIdx, score = index.bestRoom(user)
+                # Earlier slots win ties
+                if roomIdx is not None and score > bestScore:
+                    bestRoomIdx, bestScore, bestSlot = roomIdx, score, slot
+                    if score >= idealScore:
+                        break
+            if bestRoomIdx is not None:
+                room = rooms[bestRoomIdx]
+                bookings.append(Booking(user.id, dayIdx, bestSlot, room.id, room.name, bestScore))
+                indexes[dayIdx][bestSlot].remove(bestRoomIdx)
+
+    if counters is not None:
+        for index in [base] + [index for dayIndexes in indexes for index in dayIndexes]:
+            counters['scoreEvaluations'] += index.evaluations
+            counters['roomsPruned'] += index.pruned
+    return bookings
+
+def assignDailyRoomsOptimal(sortedUsers, rooms, slots=1, engine='python', counters=None, scores=None,
+                            policy=DEFAULT_POLICY):
+    """
+    Room x day x slot assignment maximising each slot's total score
+    Scores every user and room pair once, unless given their scores, then
+    fills each day slot by slot: every slot solves one matching between the
+    users available that day and not yet booked and every room, so matrices
+    stay U x R however many slots there are. Earlier slots are filled first,
+    as assignDailyRooms does.
+    Pairs at or below the policy threshold are never matched.
+
+    Returns:
+        list: Bookings in day order, then slot order
+
+    Time Complexity: O(U * R * E) to score plus
+    O(D * S * U * R * min(U, R)) to match
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    bookings = []
+    if not sortedUsers or not rooms:
+        return bookings
+
+    if scores is None:
+        if engine == 'numpy':
+            scores = calculateScoreMatrix(sortedUsers, rooms, policy)
+        else:
+            scores = calculateScoreMatrixScalar(sortedUsers, rooms, policy)
+        if counters is not None:
+            counters['scoreEvaluations'] += scores.size
+
+    eligible = np.nan_to_num(scores, nan=0.0) > policy.threshold
+    weights = np.where(eligible, scores, 0.0)
+
+    for dayIdx in range(len(DAYS)):
+        dayRows = [u for u, user in enumerate(sortedUsers) if user.availability >> dayIdx & 1]
+        for slot in range(slots):
+            if not dayRows:
+                break
+            rowIdx, colIdx = linear_sum_assignment(weights[dayRows], maximize=True)
+            booked = set()
+            for row, r in zip(rowIdx, colIdx):
+                u = dayRows[row]
+                if not eligible[u, r]:
+                    continue
+                booked.add(u)
+                user = sortedUsers[u]
+                room = rooms[r]
+                bookings.append(Booking(user.id, dayIdx, slot, room.id, room.name, float(scores[u, r])))
+            # Users left unbooked cannot do better in a later slot offering the same rooms
+            if not booked:
+                break
+            dayRows = [u for u in dayRows if u not in booked]
+
+    return bookings
+
+def improveAssignments(sortedUsers, rooms, userRoomAssignments, timeBudget, counters=None, scores=None,
+                       policy=DEFAULT_POLICY):
+    """
+    Time-boxed local search over Phase 1 room assignments
+    Every pair is scored once up front, so each candidate move is priced from
+    the cached matrix in O(1). Sweeps the users in priority order, applying the
+    best improving move for each, until a sweep finds none or the budget runs out:
+    - an unassigned user takes a free room, or a room whose holder moves on to
+      a free room (an ejection chain of length one)
+    - an assigned user relocates to a better free room
+    - two assigned users swap rooms when it raises their combined score
+    Placing a user always wins over score, and nobody ever loses their room.
+    Pairs at or below the policy threshold are never used.
+
+    Args:
+        userRoomAssignments: Phase 1 Assignments keyed by user id
+        timeBudget: Seconds to search for; moves already applied are kept
+            when it runs out
+        counters: Optional dict whose 'scoreEvaluations', 'searchMoves',
+            'searchScoreGain' and 'searchAssignedGain' counts are increased
+        scores: Optional score matrix from ScoreCache.matrix, computed when None
+        policy: ScoringPolicy scoring pairs and setting the threshold
+
+    Returns:
+        dict: Mapping of user id to Assignment, in priority order
+
+    Time Complexity: O(U * R * E) to score plus O(U * R) per sweep, and
+    O(R * F) for each ejection chain tried where F is the number of free rooms
+    """
+    if not sortedUsers or not rooms or timeBudget <= 0:
+        return userRoomAssignments
+
+    deadline = time.perf_counter() + timeBudget
+    evaluations = 0
+    if scores is None:
+        scores = calculateScoreMatrix(sortedUsers, rooms, policy)
+        evaluations = int(scores.size - np.count_nonzero(np.isnan(scores)))
+    valid = np.nan_to_num(scores, nan=0.0) > policy.threshold
+    scores = np.where(valid, scores, 0.0)
+
+    # userRoom[u] is the room index held by user u, roomHolder[r] the user holding room r; -1 for none
+    roomIdx = {room.id: r for r, room in enumerate(rooms)}
+    userRoom = np.full(len(sortedUsers), -1, dtype=int)
+    roomHolder = np.full(len(rooms), -1, dtype=int)
+    for u, user in enumerate(sortedUsers):
+        assignment = userRoomAssignments.get(user.id)
+        if assignment is not None and assignment.roomId in roomIdx:
+            r = roomIdx[assignment.roomId]
+            userRoom[u] = r
+            roomHolder[r] = u
+
+    moves = 0
+    scoreGain = 0.0
+    assignedGain = 0
+    epsilon = 1e-9
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for u in range(len(sortedUsers)):
+            if time.perf_counter() >= deadline:
+                break
+            free = roomHolder < 0
+            a = userRoom[u]
+
+            if a < 0:
+                # Free room first, then the ejection chain keeping the most score
+                candidates = valid[u] & free
+                if candidates.any():
+                    r = int(np.argmax(np.where(candidates, scores[u], -np.inf)))
+                    userRoom[u], roomHolder[r] = r, u
+                    moves, assignedGain, scoreGain = moves + 1, assignedGain + 1, scoreGain + scores[u, r]
+                    improved = True
+                    continue
+                held = np.flatnonzero(valid[u] & ~free)
+                freeRooms = np.flatnonzero(free)
+                if not len(held) or not len(freeRooms):
+                    continue
+                holders = roomHolder[held]
+                onward = np.where(valid[holders][:, freeRooms], scores[holders][:, freeRooms], -np.inf)
+                best = np.argmax(onward, axis=1)
+                onwardScore = onward[np.arange(len(held)), best]
+                gains = scores[u, held] + onwardScore - scores[holders, held]
+                gains[np.isneginf(onwardScore)] = -np.inf
+                k = int(np.argmax(gains))
+                if np.isneginf(gains[k]):
+                    continue
+                b, v, r = held[k], holders[k], freeRooms[best[k]]
+                userRoom[v], roomHolder[r] = r, v
+                userRoom[u], roomHolder[b] = b, u
+                moves, assignedGain, scoreGain = moves + 1, assignedGain + 1, scoreGain + gains[k]
+                improved = True
+                continue
+
+            # Relocation to a free room, or a swap with the holder of room b
+            current = scores[u, a]
+            relocate = np.where(valid[u] & free, scores[u] - current, -np.inf)
+            holders = np.where(free, u, roomHolder)
+            swap = np.where(
+                valid[u] & ~free & valid[holders, a],
+                scores[u] + scores[holders, a] - current - scores[holders, np.arange(len(rooms))],
+                -np.inf
+            )
+            gains = np.maximum(relocate, swap)
+            b = int(np.argmax(gains))
+            if gains[b] <= epsilon:
+                continue
+            v = roomHolder[b]
+            if v >= 0:
+                userRoom[v], roomHolder[a] = a, v
+            else:
+                roomHolder[a] = -1
+            userRoom[u], roomHolder[b] = b, u
+            moves, scoreGain = moves + 1, scoreGain + gains[b]
+            improved = True
+
+    if counters is not None:
+        counters['scoreEvaluations'] += evaluations
+        counters['searchMoves'] = counters.get('searchMoves', 0) + moves
+        counters['searchScoreGain'] = counters.get('searchScoreGain', 0.0) + float(scoreGain)
+        counters['searchAssignedGain'] = counters.get('searchAssignedGain', 0) + assignedGain
+
+    improvedAssignments = {}
+    for u, user in enumerate(sortedUsers):
+        r = userRoom[u]
+        if r < 0:
+            continue
+        previous = userRoomAssignments.get(user.id)
+        room = rooms[r]
+        if previous is not None and previous.roomId == room.id:
+            improvedAssignments[user.id] = previous
+        else:
+            improvedAssignments[user.id] = Assignment(user.id, room.id, room.name, float(scores[u, r]))
+    return improvedAssignments
+
+def getUserPriority(user):
+    """
+    Allocation priority of a user, higher values are allocated first
+    """
+    priority = 0
+    # More equipment needs = higher priority (x10 weight)
+    priority += len(user.equipment) * 10
+    # Higher capacity needs = higher priority
+    priority += user.capacity
+    return priority
+
+def partitionUsersAndRooms(sortedUsers, rooms, partitionKeys=('chemicalUse',)):
+    """
+    Split users and rooms into independent sub-problems by hard constraint keys
+    A user can only ever be given a room whose attributes match every key of
+    their room preference, so each partition can be solved on its own.
+
+    Args:
+        sortedUsers: Users in allocation priority order
+        rooms: List of rooms available for allocation
+        partitionKeys: Fields compared between user room preferences and room attributes
+
+    Returns:
+        list: (users, rooms) pairs, ordered by partition key; relative order of
+              users and rooms is preserved so each partition solves identically
+              to the unpartitioned problem
+    """
+    partitions = {}
+    for user in sortedUsers:
+        key = tuple(user.constraint(k) for k in partitionKeys)
+        partitions.setdefault(key, ([], []))[0].append(user)
+    for room in rooms:
+        key = tuple(room.constraint(k) for k in partitionKeys)
+        # Rooms nobody can use are never scored
+        if key in partitions:
+            partitions[key][1].append(room)
+
+    return [partitions[key] for key in sorted(partitions, key=repr)]
+
+def workerContext():
+    """
+    Multiprocessing context for worker process pools
+    Workers start from a clean forkserver process, or spawn where that is not
+    available, so they never inherit a forked copy of a threaded server's
+    locks or MongoDB sockets
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+def assignPartition(task):
+    """
+    Phase 1 for a single partition, run in-process or in a worker process
+
+    Args:
+        task: Tuple of (sortedUsers, rooms, engine, solver, mode, slots, improveTime,
+            scores, policy), where scores is a precomputed score matrix or None
+
+    Returns:
+        tuple: (mapping of user id to Assignment, or a list of Bookings in
+                'daily' mode, dict of 'scoreEvaluations' and 'roomsPruned'
+                counts, plus the local search counts when it ran)
+    """
+    sortedUsers, rooms, engine, solver, mode, slots, improveTime, scores, policy = task
+    counters = {'scoreEvaluations': 0, 'roomsPruned': 0}
+    if mode == 'daily':
+        if solver == 'optimal':
+            assignments = assignDailyRoomsOptimal(sortedUsers, rooms, slots, engine, counters, scores, policy)
+        else:
+            assignments = assignDailyRooms(sortedUsers, rooms, slots, counters, policy)
+    elif not sortedUsers or not rooms:
+        assignments = {}
+    elif solver == 'optimal':
+        assignments = assignOptimalRooms(sortedUsers, rooms, engine, counters, scores, policy)
+    elif engine == 'numpy':
+        # The local search below reads the matrix too, so greedy then gets a copy
+        greedyScores = scores.copy() if scores is not None and improveTime > 0 else scores
+        assignments = assignBestRoomsVectorised(sortedUsers, rooms, counters, greedyScores, policy)
+    elif engine == 'indexed':
+        assignments = assignBestRoomsIndexed(sortedUsers, rooms, counters, policy)
+    else:
+        assignments = assignBestRooms(sortedUsers, rooms, counters, policy)
+    if mode == 'week' and improveTime > 0:
+        assignments = improveAssignments(
+            sortedUsers, rooms, assignments, improveTime, counters, scores, policy
+        )
+    return assignments, counters
+
+def buildTimetable(sortedUsers, userRoomAssignments):
+    """
+    Phase 2: Create weekly timetable from Phase 1 room assignments
+    Users are listed each day in priority order, skipping days they are unavailable
+
+    Returns:
+        dict: Weekly timetable mapping each day to its user and room assignments
+
+    Time Complexity: O(U + A * D) where A is the number of assigned users
+    and D the number of days
+    """
+    timetable = {day: [] for day in DAYS}
+
+    # One pass buckets assigned users into the days their availability bitmask allows,
+    # keeping priority order, so each day only visits users it can schedule
+    eligibleUsers = [[] for _ in DAYS]
+    for user in sortedUsers:
+        if user.id not in userRoomAssignments:
+            continue
+        for dayIdx in range(len(DAYS)):
+            if user.availability >> dayIdx & 1:
+                eligibleUsers[dayIdx].append(user)
 
     # Fill each day's schedule ensuring no double-booking
-    for day in days:
+    for dayIdx, day in enumerate(DAYS):
         assignedRoomsToday = set()
         assignedUsersToday = set()
 
-        for user in sortedUsers:
-            # Skip if user is unavailable, already assigned, or has no room
-            if (user['unavailability'][day] or
-                user['_id'] in assignedUsersToday or
-                user['_id'] not in userRoomAssignments):
+        for user in eligibleUsers[dayIdx]:
+            # Skip if user is already assigned today
+            if user.id in assignedUsersToday:
                 continue
 
-            roomId = userRoomAssignments[user['_id']]['room_id']
-            roomName = userRoomAssignments[user['_id']]['room_name']
+            roomId = userRoomAssignments[user.id].roomId
+            roomName = userRoomAssignments[user.id].roomName
 
             # Skip if room already assigned today
             if roomId in assignedRoomsToday:
@@ -141,13 +599,375 @@ def assignRoomsToUsers(users, rooms):
 
             # Add assignment to timetable
             timetable[day].append({
-                'user_id': user['_id'],
-                'user_name': user['name'],
+                'user_id': user.id,
+                'user_name': user.name,
                 'room_id': roomId,
                 'room_name': roomName,
             })
 
             assignedRoomsToday.add(roomId)
-            assignedUsersToday.add(user['_id'])
+            assignedUsersToday.add(user.id)
+
+    return timetable
+
+def buildDailyTimetable(sortedUsers, bookings, slots=1):
+    """
+    Phase 2 for 'daily' mode: lay out room x day bookings as a weekly timetable
+    Each day lists its bookings in user priority order; entries carry their
+    time slot when there is more than one
+
+    Returns:
+        dict: Weekly timetable mapping each day to its user and room assignments
+    """
+    rank = {user.id: i for i, user in enumerate(sortedUsers)}
+    names = {user.id: user.name for user in sortedUsers}
+    timetable = {day: [] for day in DAYS}
+
+    for booking in sorted(bookings, key=lambda b: (b.day, rank[b.userId])):
+        entry = {
+            'user_id': booking.userId,
+            'user_name': names[booking.userId],
+            'room_id': booking.roomId,
+            'room_name': booking.roomName,
+        }
+        if slots > 1:
+            entry['slot'] = booking.slot
+        timetable[DAYS[booking.day]].append(entry)
+
+    return timetable
+
+def usesScoreMatrix(engine, solver, mode='week', improveTime=0):
+    """Whether an allocation with these options scores every user and room pair into a matrix"""
+    return solver == 'optimal' or (mode == 'week' and (engine == 'numpy' or improveTime > 0))
+
+def allocateRooms(users, rooms, engine='python', solver='greedy',
+                  partitionKeys=('chemicalUse',), maxWorkers=1, mode='week', slots=1,
+                  closures=None, improveTime=0, scoreCache=None, policy=None, progress=None):
+    """
+    Assign rooms to users for the week, ensuring chemical preferences are strictly followed
+
+    Args:
+        users: List of users to be allocated rooms, as User models or documents
+        rooms: List of rooms available for allocation, as Room models or documents
+        engine: Scoring engine, one of ENGINES
+            - 'python': scores each user and room pair with scoreRoom
+            - 'numpy': scores all pairs at once with calculateScoreMatrix
+            - 'indexed': greedy lookups through a RoomIndex with upper-bound pruning;
+              the 'optimal' solver scores with calculateRoomScore under this engine
+        solver: Phase 1 assignment strategy, one of SOLVERS
+            - 'greedy': users pick their best free room in priority order
+            - 'optimal': maximum total score matching over all users
+        partitionKeys: Hard constraint fields splitting the problem into
+            independent partitions, see partitionUsersAndRooms
+        maxWorkers: Number of worker processes solving partitions in parallel,
+            1 solves every partition in the calling process, None uses every core
+        mode: Scheduling mode, one of MODES
+            - 'week': each user keeps one room for the whole week
+            - 'daily': rooms are allocated per day, and per time slot, so a
+              room can serve different users on different days; greedy runs
+              use RoomIndex lookups whatever the engine
+        slots: Time slots per day in 'daily' mode
+        closures: Equipment dependency closures from dependencyClosures; when
+            given, each user's requirements are expanded with the dependencies
+            of the items they need before scoring. Priority still follows the
+            items users asked for
+        improveTime: Seconds of local search run after Phase 1 in 'week'
+            mode, see improveAssignments; shared between partitions by their
+            user counts. 0 skips it
+        scoreCache: Optional ScoreCache; when the solver, engine or local
+            search works from a full score matrix, each partition's matrix is
+            gathered from it in this process, scoring only pairs it lacks.
+            The 'python' engine's 'optimal' solver then uses the vectorised
+            scores, which are identical. Greedy passes that score pair by
+            pair never consult it, so they keep O(U + R) memory
+        policy: ScoringPolicy every engine scores with and whose threshold
+            rooms must beat, DEFAULT_POLICY when None
+        progress: Optional callable taking phase, partitionsDone and partitions
+            keywords, called as each phase starts and as each partition is solved
+
+    Returns:
+        dict: Weekly timetable, Phase 1 room assignments ('week' mode) or
+              Bookings ('daily' mode) and run statistics (total score,
+              assigned and unassigned user counts, score evaluations, pruned
+              rooms, score cache hits and wall time in seconds, and the local
+              search's moves, score gain and assigned-user gain when it ran)
+
+    Time Complexity: O(U * R * E) where:
+    - U is number of users
+    - R is number of rooms
+    - E is max number of equipment items
+    plus O(U * R * min(U, R)) matching time for the 'optimal' solver,
+    split across partitions and workers
+    
+    Space Complexity: O(U + R) for assignments and timetable storage,
+    O(U * R) per partition for the score matrix when using the 'numpy' engine,
+    'optimal' solver or local search, whether or not scoreCache is given
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown scoring engine: {engine}")
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver: {solver}")
+    if mode not in MODES:
+        raise ValueError(f"Unknown scheduling mode: {mode}")
+    if slots < 1:
+        raise ValueError(f"Invalid slot count: {slots}")
+    if improveTime < 0:
+        raise ValueError(f"Invalid local search time: {improveTime}")
+
+    startTime = time.perf_counter()
+    users = toUsers(users)
+    rooms = toRooms(rooms)
+    policy = policy or DEFAULT_POLICY
+
+    # Remove users unavailable for entire week
+    availableUsers = [user for user in users if user.availability]
+
+    # Sort users by priority (most demanding first)
+    sortedUsers = sorted(availableUsers, key=getUserPriority, reverse=True)
+
+    # Expanded once per run so scoring never walks dependency chains
+    if closures is not None:
+        sortedUsers = expandUsers(sortedUsers, closures)
+
+    # Strategies working from a full score matrix can take it from the cache
+    usesMatrix = usesScoreMatrix(engine, solver, mode, improveTime)
+    counters = {'scoreEvaluations': 0, 'roomsPruned': 0}
+
+    # Phase 1: Assign best matching rooms to users, one partition at a time
+    with metrics.span('allocation_phase_seconds', phase='assign'):
+        tasks = []
+        for partitionUsers, partitionRooms in partitionUsersAndRooms(sortedUsers, rooms, partitionKeys):
+            if not partitionRooms:
+                continue
+            scores = None
+            if scoreCache is not None and usesMatrix and partitionUsers:
+                scores = scoreCache.matrix(partitionUsers, partitionRooms, counters, policy)
+            tasks.append((
+                partitionUsers, partitionRooms, engine, solver, mode, slots,
+                improveTime * len(partitionUsers) / len(sortedUsers), scores, policy
+            ))
+        if progress is not None:
+            progress(phase='assign', partitionsDone=0, partitions=len(tasks))
+        partitionResults = []
+        if maxWorkers == 1 or len(tasks) <= 1:
+            for task in tasks:
+                partitionResults.append(assignPartition(task))
+                if progress is not None:
+                    progress(phase='assign', partitionsDone=len(partitionResults), partitions=len(tasks))
+        else:
+            # No more processes than partitions to solve
+            workers = min(maxWorkers or len(tasks), len(tasks))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=workerContext()) as executor:
+                # Results arrive in partition order as each one is solved
+                for partitionResult in executor.map(assignPartition, tasks):
+                    partitionResults.append(partitionResult)
+                    if progress is not None:
+                        progress(phase='assign', partitionsDone=len(partitionResults), partitions=len(tasks))
+
+    # Partitions share no users or rooms, so merging cannot conflict
+    userRoomAssignments = {}
+    bookings = []
+    for assignments, partitionCounters in partitionResults:
+        if mode == 'daily':
+            bookings.extend(assignments)
+        else:
+            userRoomAssignments.update(assignments)
+        for name, value in partitionCounters.items():
+            counters[name] = counters.get(name, 0) + value
+
+    # Phase 2: Create weekly timetable
+    if progress is not None:
+        progress(phase='timetable', partitionsDone=len(tasks), partitions=len(tasks))
+    with metrics.span('allocation_phase_seconds', phase='timetable'):
+        if mode == 'daily':
+            timetable = buildDailyTimetable(sortedUsers, bookings, slots)
+        else:
+            timetable = buildTimetable(sortedUsers, userRoomAssignments)
+
+    if mode == 'daily':
+        assignedUsers = len({booking.userId for booking in bookings})
+        totalScore = sum(booking.score for booking in bookings)
+    else:
+        assignedUsers = len(userRoomAssignments)
+        totalScore = sum(a.score for a in userRoomAssignments.values())
+    stats = {
+        'engine': engine,
+        'solver': solver,
+        'mode': mode,
+        'threshold': policy.threshold,
+        'partitions': len(tasks),
+        'totalScore': totalScore,
+        'assignedUsers': assignedUsers,
+        'unassignedUsers': len(sortedUsers) - assignedUsers,
+        'scoreEvaluations': counters['scoreEvaluations'],
+        'roomsPruned': counters['roomsPruned'],
+        'scoreCacheHits': counters.get('scoreCacheHits', 0),
+        'wallTime': time.perf_counter() - startTime
+    }
+    if mode == 'daily':
+        stats['slots'] = slots
+        stats['bookings'] = len(bookings)
+    elif improveTime > 0:
+        stats['localSearch'] = {
+            'moves': counters.get('searchMoves', 0),
+            'scoreGain': counters.get('searchScoreGain', 0.0),
+            'assignedGain': counters.get('searchAssignedGain', 0)
+        }
+    recordAllocationMetrics(stats)
+
+    result = {
+        'timetable': timetable,
+        'assignments': userRoomAssignments,
+        'stats': stats
+    }
+    if mode == 'daily':
+        result['bookings'] = bookings
+    return result
+
+def recordAllocationMetrics(stats):
+    """Add an allocation run's statistics to the process-wide metrics"""
+    if not metrics.enabled:
+        return
+    labels = {'engine': stats.get('engine', 'python'), 'solver': stats['solver']}
+    metrics.increment('allocations_total', **labels)
+    metrics.increment('score_evaluations_total', stats.get('scoreEvaluations', 0), **labels)
+    metrics.increment('rooms_pruned_total', stats.get('roomsPruned', 0), **labels)
+    metrics.increment('score_cache_hits_total', stats.get('scoreCacheHits', 0), **labels)
+    metrics.increment('users_assigned_total', stats['assignedUsers'], **labels)
+    metrics.increment('users_unassigned_total', stats.get('unassignedUsers', 0), **labels)
+    if 'localSearch' in stats:
+        metrics.increment('local_search_moves_total', stats['localSearch']['moves'], **labels)
+
+def repairAllocation(users, rooms, userRoomAssignments, changedUserId, maxCascade=3, closures=None,
+                     policy=None):
+    """
+    Incrementally re-roster after a single user's preference or unavailability changes
+    Keeps every other Phase 1 assignment and only re-places the changed user,
+    displacing lower priority users in a bounded cascade when the changed user
+    would have claimed their room in a full greedy run. A room left free by the
+    change is offered to the highest priority unassigned user it suits.
+    The result can differ from a full allocateRooms run; regenerate in full
+    when an exact greedy result is needed.
+
+    Args:
+        users: Users in the roster, with the changed user's current data,
+            as User models or documents
+        rooms: List of rooms available for allocation, as Room models or documents
+        userRoomAssignments: Previous Phase 1 Assignments keyed by user id
+        changedUserId: Id of the user whose data changed
+        maxCascade: Maximum number of users displaced by the repair
+        closures: Equipment dependency closures, as allocateRooms takes them
+        policy: ScoringPolicy, as allocateRooms takes it
+
+    Returns:
+        dict: Weekly timetable, Phase 1 room assignments and run statistics,
+              including the ids of users whose assignment changed
+
+    Time Complexity: O((C + F) * R * E + U log U) where C is the cascade length
+    and F the number of unassigned users offered the freed room
+    """
+    startTime = time.perf_counter()
+    users = toUsers(users)
+    rooms = toRooms(rooms)
+    policy = policy or DEFAULT_POLICY
+    scoreRoom = policy.scoreRoom
+
+    availableUsers = [user for user in users if user.availability]
+    sortedUsers = sorted(availableUsers, key=getUserPriority, reverse=True)
+    if closures is not None:
+        sortedUsers = expandUsers(sortedUsers, closures)
+    rank = {user.id: i for i, user in enumerate(sortedUsers)}
+    roomsById = {room.id: room for room in rooms}
+
+    # Drop assignments for users or rooms no longer in the roster
+    assignments = {
+        userId: assignment for userId, assignment in userRoomAssignments.items()
+        if userId in rank and assignment.roomId in roomsById
+    }
+    roomHolder = {assignment.roomId: userId for userId, assignment in assignments.items()}
+
+    # Ordered set of users whose assignment changed
+    changedUsers = {changedUserId: None}
+    freedRoomId = None
+    previous = userRoomAssignments.get(changedUserId)
+    assignments.pop(changedUserId, None)
+    if previous and previous.roomId in roomsById:
+        if roomHolder.get(previous.roomId) == changedUserId:
+            del roomHolder[previous.roomId]
+        freedRoomId = previous.roomId
+
+    # Re-place the changed user, then each displaced user in turn
+    userId = changedUserId if changedUserId in rank else None
+    displacedCount = 0
+    evaluations = 0
+    while userId is not None:
+        user = sortedUsers[rank[userId]]
+        canDisplace = displacedCount < maxCascade
+        bestRoom = None
+        bestScore = 0
+
+        for room in rooms:
+            holder = roomHolder.get(room.id)
+            # Only lower priority users can be displaced, as in a greedy run
+            if holder is not None and not (canDisplace and rank[holder] > rank[userId]):
+                continue
+            evaluations += 1
+            score = scoreRoom(user, room)
+            if score is not None and score > bestScore:
+                bestScore = score
+                bestRoom = room
+
+        userId = None
+        if bestRoom and bestScore > policy.threshold:
+            displaced = roomHolder.get(bestRoom.id)
+            if displaced is not None:
+                del assignments[displaced]
+                changedUsers[displaced] = None
+                displacedCount += 1
+                userId = displaced
+            assignments[user.id] = Assignment(user.id, bestRoom.id, bestRoom.name, bestScore)
+            roomHolder[bestRoom.id] = user.id
 
-    return timetable
\ No newline at end of file
+    # Offer a room left free by the change to unassigned users, highest priority first
+    if freedRoomId is not None and freedRoomId not in roomHolder:
+        room = roomsById[freedRoomId]
+        for user in sortedUsers:
+            if user.id in assignments:
+                continue
+            evaluations += 1
+            score = scoreRoom(user, room)
+            if score is not None and score > policy.threshold:
+                assignments[user.id] = Assignment(user.id, room.id, room.name, score)
+                roomHolder[room.id] = user.id
+                changedUsers[user.id] = None
+                break
+
+    with metrics.span('allocation_phase_seconds', phase='timetable'):
+        timetable = buildTimetable(sortedUsers, assignments)
+
+    stats = {
+        'solver': 'repair',
+        'repairedUsers': list(changedUsers),
+        'totalScore': sum(a.score for a in assignments.values()),
+        'assignedUsers': len(assignments),
+        'unassignedUsers': len(sortedUsers) - len(assignments),
+        'scoreEvaluations': evaluations,
+        'wallTime': time.perf_counter() - startTime
+    }
+    recordAllocationMetrics(stats)
+
+    return {
+        'timetable': timetable,
+        'assignments': assignments,
+        'stats': stats
+    }
+
+def assignRoomsToUsers(users, rooms, engine='python', solver='greedy', mode='week', slots=1, policy=None):
+    """
+    Assign rooms to users for the week, ensuring chemical preferences are strictly followed
+    See allocateRooms for the available engines, solvers, scheduling modes and policies
+
+    Returns:
+        dict: Weekly timetable mapping each day to its user and room assignments
+    """
+    return allocateRooms(users, rooms, engine, solver, mode=mode, slots=slots, policy=policy)['timetable']
@@ -0,0 +1,72 @@
+# Bounded in-memory caches
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe mapping holding at most maxSize entries, discarding the
+    least recently used entry when full
+    """
+
+    def __init__(self, maxSize=128):
+        """
+        Args:
+            maxSize: Maximum number of entries, 0 disables caching
+        """
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Cached value for key, marking it most recently used
+        Returns: The value, or default when key is not cached
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Cache value under key, evicting the least recently used entry if full"""
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Discard every entry"""
+        with self.lock:
+            self.entries.clear()
+
+    def copy(self):
+        """New cache holding the same entries in the same recency order"""
+        cache = LRUCache(self.maxSize)
+        with self.lock:
+            cache.entries = OrderedDict(self.entries)
+        return cache
+
+    def __getstate__(self):
+        # Locks cannot be pickled, a copy in another process gets its own
+        with self.lock:
+            state = dict(self.__dict__, entries=OrderedDict(self.entries))
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
@@ -1,6 +1,66 @@
 # Logic for database handling
-from pymongo import MongoClient
-from main.algorithm import assignRoomsToUsers
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from main.algorithm import allocateRooms, repairAllocation
+from main.models import DAYS, Assignment, Room, User, toUsers
+from main.metrics import metrics
+from main.cache import LRUCache
+from main.scorecache import ScoreCache
+from main.encoding import fingerprint
+from main.dependencies import dependencyClosures
+from main.scenarios import runScenarios
+from main.policy import ScoringPolicy
+
+# Equipment name enrichment strategies supported by usersGet
+USER_ENRICHMENTS = ('python', 'aggregate')
+
+DEFAULT_MONGO_URI = "mongodb://mongodb:27017/"
+
+# Environment variables configuring the MongoClient: variable -> (client option, type)
+MONGO_CLIENT_ENV = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    'MONGO_READ_PREFERENCE': ('readPreference', str),
+    'MONGO_APP_NAME': ('appname', str)
+}
+
+# Indexes created by ensureIndexes: collection -> list of index key lists
+INDEXES = {
+    'scenarios': [
+        [('run', ASCENDING), ('index', ASCENDING)]
+    ]
+}
+
+def clientOptionsFromEnv(environ=os.environ):
+    """
+    MongoClient keyword options set through MONGO_CLIENT_ENV variables
+    Returns: Dict of client options, empty when none are set
+    """
+    options = {}
+    for variable, (option, cast) in MONGO_CLIENT_ENV.items():
+        value = environ.get(variable)
+        if value:
+            options[option] = cast(value)
+    return options
+
+def availabilityQuery():
+    """
+    Users filter matching anyone available on at least one day
+    A single $nor on "unavailable every day" is checked per document during
+    the collection scan, where a rooted $or would union one index scan per day
+    """
+    return {'$nor': [{f'unavailability.{day}': True for day in DAYS}]}
 
 class Database:
     """
@@ -8,47 +68,384 @@ class Database:
     Manages CRUD operations for users, equipment, rooms, and timetables.
     """
     
-    def __init__(self, uri="mongodb://mongodb:27017/"):
-        """Initialize MongoDB connection with default local MongoDB URI"""
-        self.client = MongoClient(uri)
-        self.db = self.client['data']
+    def __init__(self, uri=None, equipmentCacheTtl=None, timetableMemoSize=32,
+                 timetableHistorySize=50, clientOptions=None, scoreCacheSize=None,
+                 persistScores=None):
+        """
+        Configure the MongoDB connection with default local MongoDB URI
+        No client is created until the first database call, see client
+        
+        Args:
+            uri: MongoDB connection string, MONGO_URI or the local default when None
+            equipmentCacheTtl: Seconds before the cached equipment catalog is
+                re-read, None to keep it until invalidated; EQUIPMENT_CACHE_TTL
+                sets it when None
+            timetableMemoSize: Generated timetables remembered by changeTimetable,
+                0 to always regenerate
+            timetableHistorySize: Timetable versions kept for delta reads
+            clientOptions: MongoClient options such as pool size and timeouts,
+                read from the environment by clientOptionsFromEnv when None
+            scoreCacheSize: Distinct room preferences whose scores are kept
+                between allocations, SCORE_CACHE_SIZE or 4096 when None
+            persistScores: Whether cached scores are also stored in the
+                scoreCache collection, SCORE_CACHE_PERSIST when None
+        """
+        uri = uri or os.environ.get('MONGO_URI', DEFAULT_MONGO_URI)
+        if clientOptions is None:
+            clientOptions = clientOptionsFromEnv()
+        if equipmentCacheTtl is None and os.environ.get('EQUIPMENT_CACHE_TTL'):
+            equipmentCacheTtl = float(os.environ['EQUIPMENT_CACHE_TTL'])
+        if scoreCacheSize is None:
+            scoreCacheSize = int(os.environ.get('SCORE_CACHE_SIZE', '4096'))
+        if persistScores is None:
+            persistScores = os.environ.get('SCORE_CACHE_PERSIST', 'false').lower() == 'true'
+        self.uri = uri
+        self.clientOptions = clientOptions
+        self.clientHandle = None
+        self.dbHandle = None
+        self.clientPid = None
+        self.connectionLock = threading.Lock()
+        self.equipmentCacheTtl = equipmentCacheTtl
+        self.equipmentCache = None
+        self.equipmentCacheTime = 0
+        self.equipmentVersion = 0
+        self.closureCache = None
+        self.policyCache = None
+        self.timetableMemo = LRUCache(timetableMemoSize)
+        self.timetableHistorySize = timetableHistorySize
+        self.scoreCache = ScoreCache(scoreCacheSize)
+        self.persistScores = persistScores
+
+    @property
+    def client(self):
+        """
+        MongoClient of the current process, created on first use
+        A process forked after the client was created, e.g. a pre-fork server
+        worker, gets a client of its own instead of the parent's sockets
+        """
+        pid = os.getpid()
+        if self.clientHandle is None or self.clientPid != pid:
+            with self.connectionLock:
+                if self.clientPid != pid:
+                    # Handles inherited from the parent process are never reused
+                    self.clientHandle = None
+                    self.dbHandle = None
+                    self.clientPid = pid
+                if self.clientHandle is None:
+                    self.clientHandle = MongoClient(self.uri, **self.clientOptions)
+        return self.clientHandle
+
+    @client.setter
+    def client(self, client):
+        """Use an existing client, e.g. a mongomock client in tests"""
+        self.clientHandle = client
+        self.dbHandle = None
+        self.clientPid = os.getpid()
+
+    @property
+    def db(self):
+        """The 'data' database of client, resolved on first use and again after a fork"""
+        if self.dbHandle is None or self.clientPid != os.getpid():
+            self.dbHandle = self.client['data']
+            self.attachScoreStore()
+        return self.dbHandle
+
+    @db.setter
+    def db(self, db):
+        """Use another database, e.g. a mongomock one in tests"""
+        self.dbHandle = db
+        self.clientPid = os.getpid()
+        self.attachScoreStore()
+
+    def attachScoreStore(self):
+        """
+        Point scoreCache at the scoreCache collection of the current database,
+        or keep it in memory only when persistScores is off
+        Only called when the database handle changes, so concurrent
+        allocations never see the store swapped under them
+        """
+        self.scoreCache.store = self.dbHandle['scoreCache'] if self.persistScores else None
+
+    def ensureIndexes(self):
+        """
+        Create the indexes in INDEXES if they do not exist yet
+        Safe to run on every start, existing indexes are left unchanged
+        
+        Returns:
+            list: Names of the indexes ensured
+        """
+        names = []
+        for collectionName, indexes in INDEXES.items():
+            for keys in indexes:
+                names.append(self.db[collectionName].create_index(keys))
+        return names
+
+    def invalidateEquipmentCache(self):
+        """
+        Discard the cached equipment catalog
+        Must be called after any write to the equipment collection
+        """
+        self.equipmentCache = None
+        self.equipmentVersion += 1
+
+    def equipmentCatalog(self):
+        """
+        Equipment catalog shared by every enrichment path, read from the
+        database at most once until invalidated or the TTL expires
+        Returns: Tuple of (equipment documents, id to name dict)
+        """
+        cache = self.equipmentCache
+        if cache is not None and (
+            self.equipmentCacheTtl is None or
+            time.monotonic() - self.equipmentCacheTime < self.equipmentCacheTtl
+        ):
+            return cache
+
+        # A catalog re-read after the TTL may differ, so it counts as a new version
+        if cache is not None:
+            self.equipmentVersion += 1
+        results = list(self.db['equipment'].find())
+        cache = (results, {equipment['_id']: equipment['name'] for equipment in results})
+        self.equipmentCache = cache
+        self.equipmentCacheTime = time.monotonic()
+        return cache
+
+    @metrics.timed('db_call_seconds')
+    def scoringPolicy(self):
+        """
+        Scoring policy every allocation uses
+        The 'scoringPolicy' document of the config collection takes precedence
+        over the SCORING_POLICY environment variable, a JSON object; parameters
+        missing from either keep their defaults
+        The document is re-read on every call, so a policy stored through any
+        worker process applies everywhere; the compiled policy is reused while
+        the document is unchanged
+        Returns: ScoringPolicy
+        """
+        document = self.db['config'].find_one({'_id': 'scoringPolicy'})
+        if document is None:
+            document = json.loads(os.environ.get('SCORING_POLICY', '{}'))
+        cache = self.policyCache
+        if cache is None or cache[0] != document:
+            cache = (document, ScoringPolicy.fromDocument(document))
+            self.policyCache = cache
+        return cache[1]
+
+    @metrics.timed('db_call_seconds')
+    def setScoringPolicy(self, document):
+        """
+        Validate and store the scoring policy used by later allocations
+        
+        Args:
+            document: Policy parameters by name, others keep their defaults
+            
+        Returns:
+            ScoringPolicy: The stored policy
+            
+        Raises:
+            ValueError: If a parameter is unknown or invalid
+        """
+        policy = ScoringPolicy.fromDocument(document)
+        self.db['config'].replace_one({'_id': 'scoringPolicy'}, policy.toDocument(), upsert=True)
+        return policy
+
+    def invalidateScoringPolicy(self):
+        """
+        Discard the compiled scoring policy
+        Only needed to pick up a changed SCORING_POLICY environment variable
+        """
+        self.policyCache = None
+
+    @metrics.timed('db_call_seconds')
+    def equipmentClosures(self):
+        """
+        Transitive dependencies of every equipment item, computed once per
+        catalog version from the cached catalog
+        Returns: Dict mapping equipment id to the ids it depends on, see dependencyClosures
+        """
+        catalog = self.equipmentCatalog()
+        cached = self.closureCache
+        if cached is None or cached[0] is not catalog:
+            cached = (catalog, dependencyClosures(catalog[0]))
+            self.closureCache = cached
+        return cached[1]
 
     def equipmentGet(self):
         """
         Retrieve all equipment records from database
         Returns: List of equipment documents
         """
-        collection = self.db['equipment']
-        results = list(collection.find())
-        return results
+        return list(self.equipmentCatalog()[0])
 
-    def usersGet(self):
+    def equipmentNames(self):
+        """
+        Equipment id to name lookup for enriching users and rooms
+        Returns: Dict mapping equipment id to name
+        """
+        return self.equipmentCatalog()[1]
+
+    @metrics.timed('db_call_seconds')
+    def usersGet(self, enrichment='python', fields=None):
         """
         Retrieve all users with their room preferences and equipment details
         Enriches equipment data with names from equipment collection
+        
+        Args:
+            enrichment: Where equipment names are joined in, one of USER_ENRICHMENTS
+                - 'python': joined in this process from the cached equipment catalog
+                - 'aggregate': joined inside MongoDB with a $lookup pipeline
+            fields: Top-level user fields to return, None for every field
+            
         Returns: List of user documents with complete equipment information
         """
+        if enrichment not in USER_ENRICHMENTS:
+            raise ValueError(f"Unknown enrichment: {enrichment}")
+        projection = {field: 1 for field in fields} if fields else None
+        if enrichment == 'aggregate':
+            return self.usersAggregate(projection)
+
         userCollection = self.db['users']
-        userResults = list(userCollection.find())
-        # Get equipment for name mapping
-        equipmentResults = self.equipmentGet()
-        eDict = {}
-        # Create equipment lookup dictionary
-        for equipment in equipmentResults:
-            eDict[equipment['_id']] = equipment['name']
+        userResults = list(userCollection.find({}, projection))
+        # Get cached equipment lookup dictionary for name mapping
+        eDict = self.equipmentNames()
         # Enrich user equipment data with names
         for user in userResults:
-            if 'equipment' in user['roomPreference']:
-                for index, e in enumerate(user['roomPreference']['equipment']):
-                    eId = e['_id']
-                    eQuantity = e['quantity']
-                    user['roomPreference']['equipment'][index] = {
-                        '_id': eId,
-                        'name': eDict[eId],
-                        'quantity': eQuantity
-                    }
+            self.enrichUserEquipment(user, eDict)
         return userResults
 
+    def enrichUserEquipment(self, user, eDict):
+        """
+        Add equipment names to a user's room preference in place
+        
+        Args:
+            user: User document
+            eDict: Equipment id to name lookup dictionary
+        """
+        if 'equipment' in user.get('roomPreference', {}):
+            for index, e in enumerate(user['roomPreference']['equipment']):
+                eId = e['_id']
+                eQuantity = e['quantity']
+                user['roomPreference']['equipment'][index] = {
+                    '_id': eId,
+                    'name': eDict[eId],
+                    'quantity': eQuantity
+                }
+
+    def pageCursor(self, collectionName, after=None, limit=None, fields=None):
+        """
+        Cursor over a collection in _id order, resuming after a given _id
+        
+        Args:
+            collectionName: Collection to read
+            after: Last _id already returned, None to start from the beginning
+            limit: Maximum number of documents, None for no limit
+            fields: Top-level fields to return, None for every field
+            
+        Returns: pymongo cursor
+        """
+        query = {'_id': {'$gt': after}} if after is not None else {}
+        projection = {field: 1 for field in fields} if fields else None
+        cursor = self.db[collectionName].find(query, projection).sort('_id', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def usersIter(self, after=None, limit=None, fields=None):
+        """
+        Iterate users in _id order straight off the database cursor,
+        enriching each one with equipment names as it is read
+        Yields: User documents with complete equipment information
+        """
+        eDict = self.equipmentNames()
+        for user in self.pageCursor('users', after, limit, fields):
+            self.enrichUserEquipment(user, eDict)
+            yield user
+
+    def timetableIter(self, after=None, limit=None):
+        """
+        Iterate timetable documents in _id order straight off the database cursor
+        Yields: Timetable documents
+        """
+        for document in self.pageCursor('timetable', after, limit):
+            # The version guarding concurrent writes is served by timetableDelta
+            document.pop('version', None)
+            yield document
+
+    def page(self, iterate, limit, after=None):
+        """
+        Read one page from a resumable iterator
+        
+        Args:
+            iterate: Iterator function taking (after, limit), e.g. usersIter
+            limit: Page size
+            after: Last _id of the previous page, None for the first page
+            
+        Returns:
+            tuple: (documents, last _id to resume from or None if this is the last page)
+        """
+        # One extra document tells whether another page exists
+        documents = list(iterate(after, limit + 1))
+        if len(documents) > limit:
+            documents = documents[:limit]
+            return documents, documents[-1]['_id']
+        return documents, None
+
+    @metrics.timed('db_call_seconds')
+    def usersAggregate(self, projection=None):
+        """
+        Retrieve users with equipment names joined by a MongoDB aggregation
+        pipeline, so the enrichment runs in the database instead of the worker
+        
+        Args:
+            projection: Top-level fields to return, None for every field
+            
+        Returns: List of user documents with complete equipment information
+        """
+        pipeline = []
+        if projection:
+            pipeline.append({'$project': projection})
+
+        if projection is None or 'roomPreference' in projection:
+            equipmentName = {'$arrayElemAt': [
+                {'$map': {
+                    'input': {'$filter': {
+                        'input': '$_equipmentCatalog',
+                        'as': 'c',
+                        'cond': {'$eq': ['$$c._id', '$$e._id']}
+                    }},
+                    'as': 'c',
+                    'in': '$$c.name'
+                }},
+                0
+            ]}
+            pipeline += [
+                # Only the equipment each user references is joined
+                {'$addFields': {'_equipmentIds': {'$map': {
+                    'input': {'$ifNull': ['$roomPreference.equipment', []]},
+                    'as': 'e',
+                    'in': '$$e._id'
+                }}}},
+                {'$lookup': {
+                    'from': 'equipment',
+                    'localField': '_equipmentIds',
+                    'foreignField': '_id',
+                    'as': '_equipmentCatalog'
+                }},
+                {'$addFields': {'roomPreference.equipment': {'$cond': [
+                    {'$isArray': '$roomPreference.equipment'},
+                    {'$map': {
+                        'input': '$roomPreference.equipment',
+                        'as': 'e',
+                        'in': {'_id': '$$e._id', 'name': equipmentName, 'quantity': '$$e.quantity'}
+                    }},
+                    '$$REMOVE'
+                ]}}},
+                {'$project': {'_equipmentIds': 0, '_equipmentCatalog': 0}}
+            ]
+
+        return list(self.db['users'].aggregate(pipeline))
+
+    @metrics.timed('db_call_seconds')
     def roomsGet(self):
         """
         Retrieve all room records from database
@@ -58,15 +455,64 @@ class Database:
         results = list(collection.find())
         return results
 
+    @metrics.timed('db_call_seconds')
+    def roomModelsGet(self):
+        """
+        Retrieve all rooms as compact Room models for the allocation algorithm
+        Returns: List of Room models
+        """
+        return [Room.fromDocument(room) for room in self.db['rooms'].find()]
+
+    @metrics.timed('db_call_seconds')
+    def userModelsGet(self, userIds):
+        """
+        Retrieve the given users as compact User models for the allocation algorithm
+        
+        Args:
+            userIds: User identifiers to fetch
+            
+        Returns:
+            list: User models, in the order of userIds
+        """
+        order = {userId: i for i, userId in enumerate(userIds)}
+        users = [User.fromDocument(user) for user in self.db['users'].find({'_id': {'$in': userIds}})]
+        users.sort(key=lambda user: order[user.id])
+        return users
+
+    @metrics.timed('db_call_seconds')
+    def allocationModelsGet(self, userIds=None):
+        """
+        Retrieve allocation input with the eligibility filters run by MongoDB
+        Users unavailable all week are never read
+        
+        Args:
+            userIds: Users to consider, None for every user
+            
+        Returns:
+            tuple: (User models in userIds order, or stored order when None,
+                    Room models in stored order); stored order matches usersGet
+                    and roomModelsGet, so allocations tie-break identically
+        """
+        userQuery = availabilityQuery()
+        if userIds is not None:
+            userQuery['_id'] = {'$in': list(userIds)}
+
+        users = [User.fromDocument(user) for user in self.db['users'].find(userQuery)]
+        if userIds is not None:
+            order = {userId: i for i, userId in enumerate(userIds)}
+            users.sort(key=lambda user: order[user.id])
+        rooms = [Room.fromDocument(room) for room in self.db['rooms'].find()]
+        return users, rooms
+
+    @metrics.timed('db_call_seconds')
     def timetableGet(self):
         """
         Retrieve current timetable allocation
         Returns: List of timetable documents
         """
-        timetableCollection = self.db['timetable']
-        results = list(timetableCollection.find())
-        return results
+        return list(self.timetableIter())
 
+    @metrics.timed('db_call_seconds')
     def setRoomPreference(self, userId, capacity, chemicalUse, equipment):
         """
         Update room preferences for a specific user
@@ -82,9 +528,6 @@ class Database:
         """
         users = self.db['users']
         userQuery = {"_id": userId}
-        user = users.find_one(userQuery)
-        if not user:
-            return False
 
         roomPreference = {
             "capacity": capacity,
@@ -97,27 +540,370 @@ class Database:
                 "roomPreference": roomPreference
             }
         }
-        users.update_one(userQuery, updateRoomPreference)
-        return True
+        # One round trip: a missing user matches nothing and returns None
+        user = users.find_one_and_update(userQuery, updateRoomPreference, projection={'_id': 1})
+        return user is not None
 
-    def changeTimetable(self, users):
+    @metrics.timed('db_call_seconds')
+    def changeTimetable(self, users, engine='python', solver='greedy', maxWorkers=1, mode='week', slots=1,
+                        dependencies=False, improveTime=0, progress=None):
         """
         Generate and update the room allocation timetable
+        Results are memoized by the allocation input: resubmitting users
+        while rooms and equipment are unchanged reuses the earlier result,
+        and skips the database writes too if that result is still stored
         
         Args:
             users: List of users to be allocated rooms
+            engine: Scoring engine used by the allocation algorithm
+            solver: Phase 1 assignment strategy, 'greedy' or 'optimal'
+            maxWorkers: Worker processes solving independent partitions in parallel
+            mode: Scheduling mode, 'week' or 'daily', see allocateRooms
+            slots: Time slots per day in 'daily' mode
+            dependencies: Whether users also need the dependencies of their
+                equipment, e.g. a workbench for a bench mat
+            improveTime: Seconds of local search after Phase 1 in 'week' mode
+            progress: Optional callable reporting the current phase, see allocateAndSave
             
         Returns:
-            bool: True if update successful
+            dict: Allocation statistics (total score, assigned users, wall time,
+                  whether the result was cached) if update successful
+        """
+        return self.allocateAndSave(
+            toUsers(users), self.roomModelsGet(), engine, solver, maxWorkers, mode, slots, dependencies,
+            improveTime, progress
+        )
+
+    @metrics.timed('db_call_seconds')
+    def generateTimetable(self, engine='python', solver='greedy', maxWorkers=1, mode='week', slots=1,
+                          dependencies=False, improveTime=0, userIds=None):
         """
-        timetable_result = assignRoomsToUsers(users, self.roomsGet())
-        replace_object = {
-            "timetable": timetable_result
+        Generate and update the timetable from the users stored in the database
+        Only users available on at least one day are fetched, see allocationModelsGet,
+        so nothing is enriched or sent over HTTP first
+        
+        Args:
+            engine: Scoring engine used by the allocation algorithm
+            solver: Phase 1 assignment strategy, 'greedy' or 'optimal'
+            maxWorkers: Worker processes solving independent partitions in parallel
+            mode: Scheduling mode, 'week' or 'daily', see allocateRooms
+            slots: Time slots per day in 'daily' mode
+            dependencies: Whether users also need the dependencies of their equipment
+            improveTime: Seconds of local search after Phase 1 in 'week' mode
+            userIds: Users to roster, None for every user
+            
+        Returns:
+            dict: Allocation statistics, as changeTimetable returns them
+        """
+        users, rooms = self.allocationModelsGet(userIds)
+        return self.allocateAndSave(
+            users, rooms, engine, solver, maxWorkers, mode, slots, dependencies, improveTime
+        )
+
+    @metrics.timed('db_call_seconds')
+    def runScenarios(self, scenarios, engine='python', solver='greedy', maxWorkers=1, mode='week', slots=1,
+                     dependencies=False, improveTime=0, userIds=None):
+        """
+        Evaluate what-if scenarios against the stored users and rooms
+        Each result is stored in the scenarios collection under the run id and
+        scenario name; the live timetable and allocation state are not touched
+        
+        Args:
+            scenarios: Scenario documents, see main.scenarios
+            maxWorkers: Worker processes evaluating scenarios
+            userIds: Users to roster, None for every user
+            Other arguments as generateTimetable takes them
+            
+        Returns:
+            dict: The run id and each scenario's name and allocation statistics
+            
+        Raises:
+            ValueError: If a scenario is invalid
+        """
+        users, rooms = self.allocationModelsGet(userIds)
+        closures = self.equipmentClosures() if dependencies else None
+        results = runScenarios(
+            users, rooms, scenarios, engine=engine, solver=solver, mode=mode, slots=slots,
+            closures=closures, improveTime=improveTime, maxWorkers=maxWorkers,
+            scoreCache=self.scoreCache, policy=self.scoringPolicy()
+        )
+
+        runId = uuid.uuid4().hex
+        now = datetime.now(timezone.utc)
+        self.db['scenarios'].insert_many([
+            {
+                '_id': f"{runId}/{result['name']}",
+                'run': runId,
+                'index': i,
+                'name': result['name'],
+                'scenario': scenario,
+                'timetable': result['timetable'],
+                'assignments': [a.toDocument() for a in result['assignments'].values()],
+                'stats': result['stats'],
+                'time': now
+            }
+            for i, (scenario, result) in enumerate(zip(scenarios, results))
+        ])
+        return {
+            'runId': runId,
+            'results': [{'name': result['name'], 'stats': result['stats']} for result in results]
         }
-        timetable_collection = self.db['timetable']
-        timetable_collection.replace_one({'_id': 1}, replace_object, upsert=True)
-        return True
 
+    @metrics.timed('db_call_seconds')
+    def scenarioResultsGet(self, runId):
+        """
+        Stored results of a scenario run
+        
+        Returns:
+            list: Scenario result documents in scenario order, empty if the run is unknown
+        """
+        return list(self.db['scenarios'].find({'run': runId}).sort('index', ASCENDING))
+
+    def allocateAndSave(self, users, rooms, engine, solver, maxWorkers, mode='week', slots=1,
+                        dependencies=False, improveTime=0, progress=None):
+        """
+        Allocate rooms and store the timetable and allocation state
+        Results are memoized by allocationKey; a memo hit skips the algorithm,
+        and the writes too while the stored allocation came from the same input.
+        On a miss, pair scores still unchanged since earlier runs come from scoreCache
+        
+        Args:
+            users: User models in submission order
+            rooms: Room models
+            progress: Optional callable taking phase, partitionsDone and
+                partitions keywords, called by allocateRooms for its phases and
+                here once more as the 'save' phase starts
+            
+        Returns:
+            dict: Allocation statistics with 'cached' set on a memo hit
+        """
+        closures = self.equipmentClosures() if dependencies else None
+        policy = self.scoringPolicy()
+        key = self.allocationKey(users, rooms, engine, solver, mode, slots, dependencies, improveTime, policy)
+        userIds = [user.id for user in users]
+
+        allocation = self.timetableMemo.get(key)
+        if allocation is not None:
+            metrics.increment('timetable_memo_total', result='hit')
+            # Another run or a reroster may have replaced the stored timetable since
+            if not self.db['allocation'].count_documents({'_id': 1, 'inputKey': key}, limit=1):
+                self.saveTimetable(allocation['timetable'])
+                self.saveAllocationState(userIds, allocation['assignments'], key, mode, dependencies)
+            return dict(allocation['stats'], cached=True)
+
+        metrics.increment('timetable_memo_total', result='miss')
+        allocation = allocateRooms(
+            users, rooms, engine=engine, solver=solver, maxWorkers=maxWorkers,
+            mode=mode, slots=slots, closures=closures, improveTime=improveTime,
+            scoreCache=self.scoreCache, policy=policy, progress=progress
+        )
+        if progress is not None:
+            partitions = allocation['stats']['partitions']
+            progress(phase='save', partitionsDone=partitions, partitions=partitions)
+        self.saveTimetable(allocation['timetable'])
+        self.saveAllocationState(userIds, allocation['assignments'], key, mode, dependencies)
+        self.timetableMemo.put(key, allocation)
+        return dict(allocation['stats'], cached=False)
+
+    def allocationKey(self, users, rooms, engine, solver, mode='week', slots=1, dependencies=False,
+                      improveTime=0, policy=None):
+        """
+        Content hash identifying an allocation's result
+        Covers the users' and rooms' allocation-relevant fields in order, the
+        equipment catalog version, engine, solver, scheduling mode, local
+        search budget and scoring policy, the default one when None
+        
+        Returns: Hex digest string
+        """
+        normalizedUsers = [
+            (u.id, u.name, u.unavailability, u.capacity, u.chemicalUse, u.equipment, u.extra)
+            for u in users
+        ]
+        normalizedRooms = [
+            (r.id, r.name, r.capacity, r.chemicalUse, list(r.equipment.items()), r.extra)
+            for r in rooms
+        ]
+        return fingerprint([
+            normalizedUsers, normalizedRooms, self.equipmentVersion, engine, solver, mode, slots,
+            dependencies, improveTime, policy.key() if policy is not None else None
+        ])
+
+    @metrics.timed('db_call_seconds')
+    def saveTimetable(self, timetable):
+        """
+        Store a new version of the timetable
+        Only days whose entries changed are written, each with a targeted $set,
+        and the changed days are recorded under the new version number in the
+        timetableHistory collection for timetableDelta. The version is stored
+        in the timetable document and each write only applies over the version
+        it was diffed against, so concurrent writers retry instead of mixing runs.
+        
+        Args:
+            timetable: Weekly timetable mapping each day to its assignments
+            
+        Returns:
+            int: Current timetable version, unchanged if nothing differed
+        """
+        timetableCollection = self.db['timetable']
+        while True:
+            current = timetableCollection.find_one({'_id': 1})
+            version = self.timetableVersion(current)
+            if current is None or 'timetable' not in current:
+                changes = dict(timetable)
+                update = {'timetable': timetable}
+            else:
+                previous = current['timetable']
+                changes = {day: entries for day, entries in timetable.items() if previous.get(day) != entries}
+                if not changes:
+                    return version
+                update = {f'timetable.{day}': entries for day, entries in changes.items()}
+            update['version'] = version + 1
+
+            if current is None:
+                try:
+                    timetableCollection.insert_one({'_id': 1, **update})
+                    break
+                except DuplicateKeyError:
+                    continue  # Another writer stored the first timetable
+            # A missing version matches None, so legacy documents are guarded too
+            if timetableCollection.update_one(
+                {'_id': 1, 'version': current.get('version')}, {'$set': update}
+            ).matched_count:
+                break
+
+        version += 1
+        # The first recorded version holds every day so deltas always start from a full timetable
+        if version == 1:
+            changes = dict(timetable)
+        history = self.db['timetableHistory']
+        history.insert_one({'_id': version, 'changes': changes, 'time': datetime.now(timezone.utc)})
+        history.delete_many({'_id': {'$lte': version - self.timetableHistorySize}})
+        return version
+
+    def timetableVersion(self, current):
+        """
+        Version of a stored timetable document, 0 if there is none or it was
+        stored without one
+        """
+        if current is None:
+            return 0
+        return current.get('version') or 0
+
+    @metrics.timed('db_call_seconds')
+    def timetableDelta(self, since):
+        """
+        Timetable changes made after a given version
+        
+        Args:
+            since: Version the caller already holds, 0 for none
+            
+        Returns:
+            dict: 'version' now current, 'changes' mapping each changed day to its
+                  full entry list, and 'full' true when the versions since were no
+                  longer kept and 'changes' holds the whole timetable instead
+        """
+        history = list(self.db['timetableHistory'].find({'_id': {'$gt': since}}).sort('_id', 1))
+        if not history:
+            version = self.timetableVersion(self.db['timetable'].find_one({'_id': 1}))
+            if since >= version:
+                return {'version': version, 'full': False, 'changes': {}}
+        elif since >= 0 and history[0]['_id'] == since + 1:
+            changes = {}
+            # Later versions overwrite the days they changed again
+            for entry in history:
+                changes.update(entry['changes'])
+            return {'version': history[-1]['_id'], 'full': False, 'changes': changes}
+
+        # Versions since are gone: send the whole timetable
+        current = self.db['timetable'].find_one({'_id': 1})
+        return {
+            'version': self.timetableVersion(current),
+            'full': True,
+            'changes': current['timetable'] if current else {}
+        }
+
+    @metrics.timed('db_call_seconds')
+    def saveAllocationState(self, userIds, assignments, inputKey=None, mode='week', dependencies=False):
+        """
+        Store the rostered users and Phase 1 assignments so later single-user
+        changes can be repaired incrementally
+        
+        Args:
+            userIds: Ids of rostered users, in the order they were submitted
+            assignments: Phase 1 Assignments keyed by user id
+            inputKey: allocationKey of the input the stored timetable was
+                generated from, None if it was repaired rather than generated
+            mode: Scheduling mode of the stored timetable; only 'week'
+                timetables can be repaired
+            dependencies: Whether equipment dependencies were required, so
+                repairs score the same way
+        """
+        state = {
+            "userIds": userIds,
+            "assignments": [assignment.toDocument() for assignment in assignments.values()],
+            "inputKey": inputKey,
+            "mode": mode,
+            "dependencies": dependencies
+        }
+        self.db['allocation'].replace_one({'_id': 1}, state, upsert=True)
+
+    @metrics.timed('db_call_seconds')
+    def rerosterUser(self, userId, maxCascade=3):
+        """
+        Incrementally repair the current timetable after one user's change
+        Only the changed user and up to maxCascade displaced users are re-placed
+        
+        Args:
+            userId: Identifier of the user whose preference or unavailability changed
+            maxCascade: Maximum number of other users the repair may displace
+            
+        Returns:
+            dict: Repair statistics if the timetable was updated
+            bool: False if there is no stored week-mode allocation or the user is not rostered
+        """
+        state = self.db['allocation'].find_one({'_id': 1})
+        if not state or userId not in state['userIds'] or state.get('mode', 'week') != 'week':
+            return False
+
+        # Submission order is restored so priority ties break as in the full run
+        users = self.userModelsGet(state['userIds'])
+        assignments = {
+            a['user_id']: Assignment.fromDocument(a) for a in state['assignments']
+        }
+        dependencies = state.get('dependencies', False)
+        closures = self.equipmentClosures() if dependencies else None
+        allocation = repairAllocation(
+            users, self.roomModelsGet(), assignments, userId, maxCascade, closures, self.scoringPolicy()
+        )
+
+        self.saveTimetable(allocation['timetable'])
+        self.saveAllocationState(state['userIds'], allocation['assignments'], dependencies=dependencies)
+        return allocation['stats']
+
+    @metrics.timed('db_call_seconds')
+    def regenerateTimetable(self, userIds):
+        """
+        Regenerate the current timetable once after many users' changes
+        The stored roster is allocated in full with the default engine and
+        solver, as PUT /put_timetable does, instead of one repair per user
+        
+        Args:
+            userIds: Identifiers of the users whose preference or unavailability changed
+            
+        Returns:
+            dict: Allocation statistics if the timetable was regenerated
+            bool: False if there is no stored week-mode allocation or none of the users is rostered
+        """
+        state = self.db['allocation'].find_one({'_id': 1})
+        if not state or state.get('mode', 'week') != 'week' or not set(userIds) & set(state['userIds']):
+            return False
+
+        users = self.userModelsGet(state['userIds'])
+        return self.allocateAndSave(
+            users, self.roomModelsGet(), 'python', 'greedy', 1, dependencies=state.get('dependencies', False)
+        )
+
+    @metrics.timed('db_call_seconds')
     def changeUnavailability(self, userId, unavailability):
         """
         Update a user's unavailability schedule
@@ -132,19 +918,59 @@ class Database:
         """
         users = self.db['users']
         userQuery = {'_id': userId}
-        user = users.find_one(userQuery)
-        if not user:
-            return False
 
         newUnavailability = {
             '$set': {
                 'unavailability': unavailability
             }
         }
-        users.update_one(userQuery, newUnavailability)
-        user = users.find_one(userQuery)
+        # One round trip returning the document as updated
+        user = users.find_one_and_update(
+            userQuery, newUnavailability,
+            projection={'unavailability': 1}, return_document=ReturnDocument.AFTER
+        )
+        if not user:
+            return False
         return user['unavailability']
 
+    @metrics.timed('db_call_seconds')
+    def bulkUpdateUsers(self, updates):
+        """
+        Apply many user field updates with a single unordered bulk write
+        
+        Args:
+            updates: List of (userId, fields) pairs, where fields maps
+                top-level user fields to their new values
+            
+        Returns:
+            list: Per update status, in input order: 'updated', 'not_found',
+                  or the write error message if MongoDB rejected it
+        """
+        if not updates:
+            return []
+        users = self.db['users']
+        userIds = [userId for userId, _ in updates]
+        existing = {user['_id'] for user in users.find({'_id': {'$in': userIds}}, {'_id': 1})}
+
+        statuses = ['updated' if userId in existing else 'not_found' for userId in userIds]
+        operations = []
+        positions = []
+        for position, (userId, fields) in enumerate(updates):
+            if userId in existing:
+                operations.append(UpdateOne({'_id': userId}, {'$set': fields}))
+                positions.append(position)
+        if not operations:
+            return statuses
+
+        try:
+            users.bulk_write(operations, ordered=False)
+        except BulkWriteError as error:
+            # Unordered writes carry on past failures; each error names its operation
+            for writeError in error.details.get('writeErrors', []):
+                statuses[positions[writeError['index']]] = writeError.get('errmsg', 'Write failed')
+        return statuses
+
+    @metrics.timed('db_call_seconds')
     def getUserRequestedRoom(self, userId):
         """
         Get room preference details for a specific user
@@ -162,9 +988,8 @@ class Database:
         if not user or 'roomPreference' not in user:
             return None
             
-        # Get equipment details for name mapping
-        equipmentResults = self.equipmentGet()
-        equipmentDict = {eq['_id']: eq['name'] for eq in equipmentResults}
+        # Get cached equipment details for name mapping
+        equipmentDict = self.equipmentNames()
         
         # Format room preference with equipment names
         roomPreference = user['roomPreference']
@@ -178,6 +1003,7 @@ class Database:
             "requestDetails": roomPreference
         }
     
+    @metrics.timed('db_call_seconds')
     def getRoomWithId(self, room_id):
         """
         Get detailed information about a specific room
@@ -195,9 +1021,8 @@ class Database:
         if not room:
             return None
             
-        # Get equipment details for name mapping
-        equipmentResults = self.equipmentGet()
-        equipmentDict = {eq['_id']: eq['name'] for eq in equipmentResults}
+        # Get cached equipment details for name mapping
+        equipmentDict = self.equipmentNames()
         
         # Map equipment names in room attributes
         if 'equipment' in room['attributes']:
@@ -208,4 +1033,5 @@ class Database:
 
         return room
 
+# Shared handler; it connects on first use, so importing this module never opens a connection
 database = Database()
\ No newline at end of file
@@ -0,0 +1,70 @@
+# Equipment dependency chains, e.g. Pipette -> Beaker -> Workbench
+# A required item is only usable in a room that also has everything it depends on,
+# so users' requirements are expanded with the transitive dependencies of each item
+# and each requirement scores nothing in rooms missing any of its dependencies
+from main.models import Equipment, User
+
+def dependencyClosures(equipment):
+    """
+    Transitive dependencies of every catalog item
+
+    Args:
+        equipment: Equipment catalog, as Equipment models or documents
+
+    Returns:
+        dict: Equipment id to a tuple of the ids it depends on, nearest first;
+              cycles and unknown ids end a chain
+
+    Time Complexity: O(N * L) where L is the longest dependency chain
+    """
+    dependentOf = {}
+    for item in equipment:
+        if not isinstance(item, Equipment):
+            item = Equipment.fromDocument(item)
+        dependentOf[item.id] = item.dependentId
+
+    closures = {}
+    for eqId in dependentOf:
+        chain = []
+        seen = {eqId}
+        dependentId = dependentOf[eqId]
+        while dependentId is not None and dependentId not in seen:
+            chain.append(dependentId)
+            seen.add(dependentId)
+            dependentId = dependentOf.get(dependentId)
+        closures[eqId] = tuple(chain)
+    return closures
+
+def expandUser(user, closures):
+    """
+    User with the dependencies of each required item added as requirements
+    Items the user already requires keep their quantity; added dependencies
+    need a quantity of 1. Requirements of zero quantity add nothing.
+    Every requirement is gated on its own dependencies: it only counts in
+    rooms holding at least one of each, so a room lacking a dependency
+    scores that item, and the dependency itself, as zero.
+
+    Returns:
+        User: A new model, or the same one if nothing depends on anything
+    """
+    required = dict(user.equipment)
+    added = []
+    for eqId, quantity in user.equipment:
+        if quantity <= 0:
+            continue
+        for dependencyId in closures.get(eqId, ()):
+            if dependencyId not in required:
+                required[dependencyId] = 1
+                added.append((dependencyId, 1))
+    equipment = user.equipment + tuple(added)
+    gates = tuple(closures.get(eqId, ()) if quantity > 0 else () for eqId, quantity in equipment)
+    if not any(gates):
+        return user
+    return User(
+        user.id, user.name, user.unavailability, user.availability,
+        user.capacity, user.chemicalUse, equipment, user.extra, gates
+    )
+
+def expandUsers(users, closures):
+    """Expand every user's requirements once, see expandUser"""
+    return [expandUser(user, closures) for user in users]
@@ -0,0 +1,56 @@
+# JSON response encoding with native handling of BSON types
+import hashlib
+import json
+from bson import json_util
+from flask import Response, current_app, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def encode(data):
+    """
+    Encode data as JSON bytes in a single pass
+    BSON types such as ObjectId and datetime are written as MongoDB extended
+    JSON, exactly as bson.json_util.dumps writes them. Uses orjson when it is
+    installed and the standard library otherwise.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data,
+            default=json_util.default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+    return json.dumps(data, default=json_util.default).encode()
+
+def fingerprint(data):
+    """
+    Content hash of JSON-like data, independent of dict key order
+    Returns: Hex SHA-256 digest of the canonical encoding
+    """
+    if orjson is not None:
+        body = orjson.dumps(
+            data,
+            default=json_util.default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS
+        )
+    else:
+        body = json.dumps(data, default=json_util.default, sort_keys=True).encode()
+    return hashlib.sha256(body).hexdigest()
+
+def jsonResponse(data, status=200):
+    """JSON response encoded by encode"""
+    return Response(encode(data), status=status, mimetype='application/json')
+
+def documentResponse(data, status=200):
+    """
+    JSON response for routes that historically returned their JSON text wrapped
+    in a JSON string. The wrapped format is kept while the NESTED_JSON_STRINGS
+    setting is on, unless the request asks for format=json; migrated clients
+    get plain JSON either way.
+    """
+    body = encode(data)
+    if current_app.config.get('NESTED_JSON_STRINGS', True) and request.args.get('format') != 'json':
+        body = encode(body.decode())
+    return Response(body, status=status, mimetype='application/json')
@@ -0,0 +1,132 @@
+# Background jobs for long running timetable generation
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Job states reported by JobManager.get
+JOB_STATES = ('queued', 'running', 'done', 'failed')
+
+class JobManager:
+    """
+    Runs submitted functions on a background thread pool and keeps their
+    status and result for polling.
+    Submissions sharing a key with a queued or running job are deduplicated
+    to that job instead of running again.
+    Jobs submitted with reportProgress receive a progress callback whose
+    keyword arguments become the job's 'progress' record.
+    """
+
+    def __init__(self, maxWorkers=1, maxJobs=100):
+        """
+        Args:
+            maxWorkers: Threads running jobs; 1 runs jobs one at a time in
+                submission order so timetable writes never interleave
+            maxJobs: Finished jobs kept for polling, oldest discarded first
+        """
+        self.maxWorkers = maxWorkers
+        self.maxJobs = maxJobs
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.futures = {}
+        self.active = {}
+        # Created on first submission so importing never starts threads
+        self.executor = None
+
+    def submit(self, key, function, *args, reportProgress=False, **kwargs):
+        """
+        Queue function(*args, **kwargs) as a job
+
+        Args:
+            key: Identifies the job's input, e.g. a fingerprint of it
+            function: Callable run in the background; its return value is the job result
+            reportProgress: Whether function also takes a progress keyword
+                argument, see setProgress
+
+        Returns:
+            tuple: (job id, True if a new job was queued or False if an
+                    identical queued or running job was reused)
+        """
+        with self.lock:
+            jobId = self.active.get(key)
+            if jobId is not None:
+                return jobId, False
+
+            jobId = uuid.uuid4().hex
+            self.jobs[jobId] = {
+                'id': jobId,
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'progress': None,
+                'result': None,
+                'error': None
+            }
+            self.active[key] = jobId
+            self.evict()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+            if reportProgress:
+                kwargs = dict(kwargs, progress=lambda **fields: self.setProgress(jobId, fields))
+            self.futures[jobId] = self.executor.submit(self.run, jobId, key, function, args, kwargs)
+        return jobId, True
+
+    def run(self, jobId, key, function, args, kwargs):
+        """Run one job, recording its status transitions"""
+        with self.lock:
+            self.jobs[jobId]['status'] = 'running'
+            self.jobs[jobId]['started'] = time.time()
+        try:
+            result = function(*args, **kwargs)
+            update = {'status': 'done', 'result': result}
+        except Exception as error:
+            update = {'status': 'failed', 'error': str(error)}
+        with self.lock:
+            update['finished'] = time.time()
+            self.jobs[jobId].update(update)
+            self.futures.pop(jobId, None)
+            if self.active.get(key) == jobId:
+                del self.active[key]
+
+    def setProgress(self, jobId, fields):
+        """Replace a job's progress record, e.g. its current phase"""
+        with self.lock:
+            if jobId in self.jobs:
+                self.jobs[jobId]['progress'] = dict(fields)
+
+    def evict(self):
+        """Discard the oldest finished jobs beyond maxJobs; caller holds the lock"""
+        excess = len(self.jobs) - self.maxJobs
+        for jobId in list(self.jobs):
+            if excess <= 0:
+                break
+            if self.jobs[jobId]['status'] in ('done', 'failed'):
+                del self.jobs[jobId]
+                excess -= 1
+
+    def get(self, jobId):
+        """
+        Current status of a job
+
+        Returns:
+            dict: Copy of the job record, with its id, status, submitted,
+                  started and finished timestamps, progress, result and error
+            None: If the job is unknown or has been discarded
+        """
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return dict(job) if job is not None else None
+
+    def wait(self, jobId, timeout=None):
+        """
+        Block until a job finishes
+
+        Returns: The job record as get returns it
+        """
+        with self.lock:
+            future = self.futures.get(jobId)
+        if future is not None:
+            future.result(timeout)
+        return self.get(jobId)
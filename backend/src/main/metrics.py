@@ -0,0 +1,151 @@
+# Timing spans and counters for the allocation hot path and database calls
+# Rendered in the Prometheus text exposition format by the /metrics route.
+# Every recording call returns immediately while metrics are disabled.
+import functools
+import threading
+import time
+from contextlib import nullcontext
+
+# Help text and type of each metric, keyed by name without the prefix
+DESCRIPTIONS = {
+    'db_call_seconds': ('summary', 'Time spent in Database methods'),
+    'allocation_phase_seconds': ('summary', 'Time spent in each allocation phase'),
+    'allocations_total': ('counter', 'Allocation runs'),
+    'timetable_memo_total': ('counter', 'changeTimetable memo lookups by result'),
+    'score_evaluations_total': ('counter', 'User and room pairs scored'),
+    'rooms_pruned_total': ('counter', 'Candidate rooms skipped by RoomIndex bounds'),
+    'score_cache_hits_total': ('counter', 'User and room pair scores reused from the score cache'),
+    'users_assigned_total': ('counter', 'Users given a room in Phase 1'),
+    'users_unassigned_total': ('counter', 'Available users left without a room in Phase 1'),
+    'local_search_moves_total': ('counter', 'Moves applied by the local search after Phase 1')
+}
+
+NULL_SPAN = nullcontext()
+
+class Span:
+    """Context manager observing its elapsed time into a summary"""
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics:
+    """
+    Registry of counters and timing summaries
+    Series are identified by metric name and label values.
+    """
+
+    def __init__(self, enabled=False, prefix='roomroster'):
+        """
+        Args:
+            enabled: Whether recording calls store anything
+            prefix: Prepended to every metric name when rendering
+        """
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard every recorded series"""
+        with self.lock:
+            self.counters = {}
+            self.summaries = {}
+
+    def increment(self, name, value=1, **labels):
+        """Add value to a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Record one duration in a summary"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0.0])
+            summary[0] += 1
+            summary[1] += seconds
+
+    def span(self, name, **labels):
+        """
+        Context manager timing its body into a summary
+        Returns a shared no-op context while disabled
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator timing every call of a function into a summary
+        The function's name is added as the 'method' label
+        """
+        def decorator(function):
+            methodLabels = dict(labels, method=function.__name__)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **methodLabels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        """
+        Render every series in the Prometheus text exposition format
+        Returns: str
+        """
+        with self.lock:
+            series = {}
+            for (name, labels), value in self.counters.items():
+                series.setdefault(name, []).append((name, labels, value))
+            for (name, labels), (count, total) in self.summaries.items():
+                series.setdefault(name, []).append((f'{name}_count', labels, count))
+                series.setdefault(name, []).append((f'{name}_sum', labels, total))
+
+        lines = []
+        for name in sorted(series):
+            kind, description = DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f'# HELP {self.prefix}_{name} {description}')
+            lines.append(f'# TYPE {self.prefix}_{name} {kind}')
+            for sample, labels, value in sorted(series[name], key=lambda s: (s[1], s[0])):
+                lines.append(f'{self.prefix}_{sample}{formatLabels(labels)} {formatValue(value)}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+def formatLabels(labels):
+    """Prometheus label set for sorted (name, value) pairs"""
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def formatValue(value):
+    """Prometheus sample value, integers without a decimal point"""
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+# Process-wide registry, enabled by the server from its configuration
+metrics = Metrics()
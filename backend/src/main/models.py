@@ -0,0 +1,152 @@
+# Compact in-memory models used by the allocation algorithm
+# Documents from MongoDB or the API are converted once, at the data layer
+# boundary, so the scoring hot loop reads plain attributes instead of
+# walking nested dicts
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+
+# Fields modelled explicitly; anything else is kept in the 'extra' dict
+USER_PREFERENCE_FIELDS = ('capacity', 'chemicalUse', 'equipment')
+ROOM_ATTRIBUTE_FIELDS = ('capacity', 'chemicalUse', 'equipment')
+
+@dataclass
+class Equipment:
+    """Equipment catalog entry"""
+    __slots__ = ('id', 'name', 'dependentId')
+    id: Any
+    name: str
+    dependentId: Any
+
+    @classmethod
+    def fromDocument(cls, doc):
+        return cls(doc['_id'], doc['name'], doc.get('dependentId'))
+
+    def toDocument(self):
+        return {'_id': self.id, 'name': self.name, 'dependentId': self.dependentId}
+
+def availabilityMask(unavailability):
+    """Bitmask with bit i set when the user is available on DAYS[i]"""
+    mask = 0
+    for dayIdx, unavailable in enumerate(unavailability):
+        if not unavailable:
+            mask |= 1 << dayIdx
+    return mask
+
+@dataclass
+class User:
+    """
+    User with their room preference flattened
+    unavailability holds one boolean per day in DAYS order, availability the
+    same as a bitmask of available days, and equipment holds (equipment id,
+    quantity) pairs, deduplicated as calculateRoomScore does.
+    gates is None, or holds for each equipment pair the ids of items a room
+    must also have for that pair to count at all, see expandUser
+    """
+    __slots__ = ('id', 'name', 'unavailability', 'availability', 'capacity', 'chemicalUse', 'equipment', 'extra',
+                 'gates')
+    id: Any
+    name: str
+    unavailability: Tuple[bool, ...]
+    availability: int
+    capacity: float
+    chemicalUse: bool
+    equipment: Tuple[Tuple[Any, float], ...]
+    extra: Optional[Dict[str, Any]]
+    gates: Optional[Tuple[Tuple[Any, ...], ...]]
+
+    @classmethod
+    def fromDocument(cls, doc):
+        preference = doc['roomPreference']
+        # Later duplicates overwrite earlier ones, matching calculateRoomScore
+        equipment = {eq['_id']: eq['quantity'] for eq in preference['equipment']}
+        extra = {k: v for k, v in preference.items() if k not in USER_PREFERENCE_FIELDS}
+        unavailability = tuple(bool(doc['unavailability'][day]) for day in DAYS)
+        return cls(
+            doc['_id'],
+            doc.get('name'),
+            unavailability,
+            availabilityMask(unavailability),
+            preference['capacity'],
+            preference['chemicalUse'],
+            tuple(equipment.items()),
+            extra or None,
+            None
+        )
+
+    def constraint(self, key):
+        """Value of a room preference field used as a hard constraint"""
+        if key == 'chemicalUse':
+            return self.chemicalUse
+        return self.extra.get(key) if self.extra else None
+
+@dataclass
+class Room:
+    """Room with its attributes flattened and equipment as an id to quantity dict"""
+    __slots__ = ('id', 'name', 'capacity', 'chemicalUse', 'equipment', 'extra')
+    id: Any
+    name: str
+    capacity: float
+    chemicalUse: bool
+    equipment: Dict[Any, float]
+    extra: Optional[Dict[str, Any]]
+
+    @classmethod
+    def fromDocument(cls, doc):
+        attributes = doc['attributes']
+        extra = {k: v for k, v in attributes.items() if k not in ROOM_ATTRIBUTE_FIELDS}
+        return cls(
+            doc['_id'],
+            doc.get('name'),
+            attributes['capacity'],
+            attributes['chemicalUse'],
+            {eq['_id']: eq['quantity'] for eq in attributes['equipment']},
+            extra or None
+        )
+
+    def constraint(self, key):
+        """Value of a room attribute field used as a hard constraint"""
+        if key == 'chemicalUse':
+            return self.chemicalUse
+        return self.extra.get(key) if self.extra else None
+
+@dataclass
+class Assignment:
+    """Phase 1 assignment of a room to a user for the week"""
+    __slots__ = ('userId', 'roomId', 'roomName', 'score')
+    userId: Any
+    roomId: Any
+    roomName: str
+    score: float
+
+    @classmethod
+    def fromDocument(cls, doc):
+        return cls(doc['user_id'], doc['room_id'], doc['room_name'], doc['score'])
+
+    def toDocument(self):
+        return {
+            'user_id': self.userId,
+            'room_id': self.roomId,
+            'room_name': self.roomName,
+            'score': self.score
+        }
+
+@dataclass
+class Booking:
+    """Room given to a user for one day, and time slot, in daily scheduling"""
+    __slots__ = ('userId', 'day', 'slot', 'roomId', 'roomName', 'score')
+    userId: Any
+    day: int
+    slot: int
+    roomId: Any
+    roomName: str
+    score: float
+
+def toUsers(users):
+    """Convert user documents to User models, passing models through unchanged"""
+    return [user if isinstance(user, User) else User.fromDocument(user) for user in users]
+
+def toRooms(rooms):
+    """Convert room documents to Room models, passing models through unchanged"""
+    return [room if isinstance(room, Room) else Room.fromDocument(room) for room in rooms]
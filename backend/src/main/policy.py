@@ -0,0 +1,130 @@
+# Scoring policy: the weights, capacity curve and threshold behind every room score
+# A policy is compiled once into a scalar kernel with its constants bound as
+# closure variables; calculateScoreMatrix and RoomIndex read the same fields.
+from dataclasses import dataclass, field, fields
+from typing import Callable
+
+@dataclass(frozen=True)
+class ScoringPolicy:
+    """
+    Compatibility scoring parameters
+    A score is capacityWeight * capacity score + equipmentWeight * equipment score, where
+    - the capacity score is undersizedScore for rooms smaller than required,
+      otherwise required / available + capacityBonus, capped at 1.0
+    - the equipment score is the fraction of required items the room has,
+      counting partial quantities proportionally
+    Users are only given rooms scoring above threshold.
+    """
+    capacityWeight: float = 0.3
+    equipmentWeight: float = 0.7
+    threshold: float = 0.6
+    undersizedScore: float = 0.2
+    capacityBonus: float = 0.2
+    scoreRoom: Callable = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        for name in ('capacityWeight', 'equipmentWeight', 'undersizedScore', 'capacityBonus'):
+            value = getattr(self, name)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                raise ValueError(f"Invalid scoring policy {name}: {value}")
+        if not isinstance(self.threshold, (int, float)) or isinstance(self.threshold, bool) or \
+                not 0 <= self.threshold < 1:
+            raise ValueError(f"Invalid scoring policy threshold: {self.threshold}")
+        object.__setattr__(self, 'scoreRoom', compileScorer(self))
+
+    def __reduce__(self):
+        # The compiled kernel is a closure, so worker processes recompile it
+        return (ScoringPolicy, self.key())
+
+    def key(self):
+        """Parameter values in field order, for cache keys and fingerprints"""
+        return tuple(getattr(self, name) for name in POLICY_FIELDS)
+
+    def toDocument(self):
+        """Parameters as a document, as stored in the config collection"""
+        return dict(zip(POLICY_FIELDS, self.key()))
+
+    @classmethod
+    def fromDocument(cls, doc, base=None):
+        """
+        Policy from a document of parameters, others taken from base
+
+        Args:
+            doc: Dict of parameter values by field name
+            base: Policy supplying parameters missing from doc, DEFAULT_POLICY when None
+
+        Raises:
+            ValueError: If doc is not a dict, names an unknown parameter or a value is invalid
+        """
+        if not isinstance(doc, dict):
+            raise ValueError("Scoring policy must be an object")
+        unknown = set(doc) - set(POLICY_FIELDS) - {'_id'}
+        if unknown:
+            raise ValueError(f"Unknown scoring policy parameters: {sorted(unknown)}")
+        values = (base or DEFAULT_POLICY).toDocument()
+        values.update((name, doc[name]) for name in POLICY_FIELDS if name in doc)
+        return cls(**values)
+
+def compileScorer(policy):
+    """
+    Scalar scoring kernel for a policy
+    Returns a function scoring a User model against a Room model, between 0
+    and 1, or None if the room is incompatible
+    Time Complexity: O(E) per call where E is number of equipment items
+    """
+    capacityWeight = policy.capacityWeight
+    equipmentWeight = policy.equipmentWeight
+    undersizedScore = policy.undersizedScore
+    capacityBonus = policy.capacityBonus
+
+    def scoreRoom(user, room):
+        # Strict chemical safety check - immediate disqualification if mismatch
+        if user.chemicalUse != room.chemicalUse:
+            return None
+
+        # Capacity scoring:
+        # - If room is too small: the undersized penalty score
+        # - Otherwise: ratio of required/available plus the bonus, capped at 1.0
+        requiredCapacity = user.capacity
+        roomCapacity = room.capacity
+
+        if roomCapacity < requiredCapacity:
+            capacityScore = undersizedScore  # Penalty for undersized rooms
+        else:
+            capacityRatio = requiredCapacity / roomCapacity
+            capacityScore = min(1.0, capacityRatio + capacityBonus)  # Bonus for right-sized rooms
+
+        # Equipment scoring (0 to 1.0):
+        # Room equipment is already an id to quantity dict for O(1) lookup
+        userEquipment = user.equipment
+
+        if userEquipment:
+            roomEquipment = room.equipment
+            gates = user.gates
+            matches = 0
+
+            # Calculate partial matches for each equipment
+            for k, (eqId, requiredQty) in enumerate(userEquipment):
+                # An item is unusable in a room missing anything it depends on
+                if gates is not None and any(roomEquipment.get(gateId, 0) <= 0 for gateId in gates[k]):
+                    continue
+                availableQty = roomEquipment.get(eqId, 0)
+                if availableQty >= requiredQty:
+                    matches += 1  # Full match
+                elif availableQty > 0:
+                    matches += (availableQty / requiredQty)  # Partial match
+
+            equipmentScore = matches / len(userEquipment)
+        else:
+            equipmentScore = 1.0  # No equipment requirements means perfect match
+
+        # Calculate weighted final score
+        return capacityScore * capacityWeight + equipmentScore * equipmentWeight
+
+    return scoreRoom
+
+# Parameter fields, in the order key() lists them
+POLICY_FIELDS = tuple(f.name for f in fields(ScoringPolicy) if f.init)
+
+# Policy used when none is configured
+DEFAULT_POLICY = ScoringPolicy()
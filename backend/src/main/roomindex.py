@@ -0,0 +1,211 @@
+# Room candidate index for fast best-room lookups during allocation
+import copy
+from bisect import bisect_left
+from main.models import toRooms
+from main.policy import DEFAULT_POLICY
+
+class RoomIndex:
+    """
+    Prebuilt index over rooms for greedy best-room retrieval.
+    Rooms are grouped by chemicalUse and sorted by capacity within each group.
+    Equipment is stored as an integer bitset of items present plus a quantity
+    array per room, so upper bounds on a room's score cost O(1) and exact
+    scores skip rebuilding equipment dicts.
+    """
+
+    def __init__(self, rooms, policy=None):
+        """
+        Build the index
+
+        Args:
+            rooms: List of rooms, as Room models or documents;
+                positions in this list identify rooms
+            policy: ScoringPolicy rooms are scored and bounded with,
+                DEFAULT_POLICY when None
+
+        Time Complexity: O(R log R + R * E)
+        """
+        self.rooms = toRooms(rooms)
+        self.policy = policy or DEFAULT_POLICY
+        self.column = {}
+        for room in self.rooms:
+            for eqId in room.equipment:
+                self.column.setdefault(eqId, len(self.column))
+
+        self.capacity = []
+        self.bits = []
+        self.quantity = []
+        for room in self.rooms:
+            quantity = [0] * len(self.column)
+            bits = 0
+            for eqId, qty in room.equipment.items():
+                quantity[self.column[eqId]] = qty
+            for col, qty in enumerate(quantity):
+                if qty > 0:
+                    bits |= 1 << col
+            self.capacity.append(room.capacity)
+            self.bits.append(bits)
+            self.quantity.append(quantity)
+
+        # Per chemicalUse group: (capacity, room position) keys in ascending order
+        # plus a removed flag per key so removal is a binary search and a flag set
+        self.groups = {}
+        for r, room in enumerate(self.rooms):
+            group = self.groups.setdefault(
+                room.chemicalUse, {'keys': [], 'removed': [], 'live': 0}
+            )
+            group['keys'].append((self.capacity[r], r))
+        for group in self.groups.values():
+            group['keys'].sort()
+            group['removed'] = [False] * len(group['keys'])
+            group['live'] = len(group['keys'])
+
+        # Counters for instrumentation
+        self.evaluations = 0
+        self.pruned = 0
+
+    def copy(self):
+        """
+        Independent index over the same rooms, e.g. one per day or time slot
+        Per-room capacity, bitset and quantity arrays are shared and only the
+        removal state is copied, with fresh counters
+
+        Time Complexity: O(R)
+        """
+        clone = copy.copy(self)
+        clone.groups = {
+            key: {'keys': list(group['keys']), 'removed': list(group['removed']), 'live': group['live']}
+            for key, group in self.groups.items()
+        }
+        clone.evaluations = 0
+        clone.pruned = 0
+        return clone
+
+    def remove(self, roomIdx):
+        """
+        Remove an assigned room from the index
+
+        Time Complexity: O(log R), amortised compaction included
+        """
+        group = self.groups[self.rooms[roomIdx].chemicalUse]
+        pos = bisect_left(group['keys'], (self.capacity[roomIdx], roomIdx))
+        if group['removed'][pos]:
+            return
+        group['removed'][pos] = True
+        group['live'] -= 1
+
+        # Compact once more than half the keys are dead so scans stay proportional to live rooms
+        if group['live'] * 2 < len(group['keys']):
+            group['keys'] = [k for k, dead in zip(group['keys'], group['removed']) if not dead]
+            group['removed'] = [False] * len(group['keys'])
+
+    def encodeUser(self, user):
+        """
+        Encode a User model's equipment requirements against the index columns
+
+        Returns:
+            tuple: (required (column, quantity, gate columns) triples, requirement
+                    bitset, number of requirements satisfied regardless of the
+                    room, number of distinct requirements); a gate column is
+                    None for an item no room has
+        """
+        required = []
+        bits = 0
+        alwaysMet = 0
+        gates = user.gates
+        for k, (eqId, requiredQty) in enumerate(user.equipment):
+            col = self.column.get(eqId)
+            # Zero quantity requirements are met even by rooms without the item
+            if requiredQty <= 0:
+                alwaysMet += 1
+            elif col is not None:
+                bits |= 1 << col
+            gateColumns = tuple(self.column.get(gateId) for gateId in gates[k]) if gates is not None else ()
+            required.append((col, requiredQty, gateColumns))
+        return required, bits, alwaysMet, len(user.equipment)
+
+    def bestRoom(self, user, threshold=None):
+        """
+        Find the best remaining room for a User model, as the policy's kernel would rank them
+        Rooms whose score upper bound cannot beat the current best or the
+        threshold, the policy's when None, are skipped without being scored.
+
+        Returns:
+            tuple: (room position, score), or (None, 0) if no room scores above threshold;
+                   ties resolve to the earliest room in the original list
+        """
+        group = self.groups.get(user.chemicalUse)
+        if group is None or group['live'] == 0:
+            return None, 0
+
+        required, userBits, alwaysMet, itemCount = self.encodeUser(user)
+        requiredCapacity = user.capacity
+        keys = group['keys']
+        removed = group['removed']
+
+        policy = self.policy
+        capacityWeight = policy.capacityWeight
+        equipmentWeight = policy.equipmentWeight
+        capacityBonus = policy.capacityBonus
+        undersizedScore = policy.undersizedScore
+
+        bestIdx = None
+        bestScore = policy.threshold if threshold is None else threshold
+
+        def consider(pos, capacityScore):
+            nonlocal bestIdx, bestScore
+            roomIdx = keys[pos][1]
+            if itemCount:
+                present = bin(userBits & self.bits[roomIdx]).count('1') + alwaysMet
+                upperBound = capacityScore * capacityWeight + (present / itemCount) * equipmentWeight
+            else:
+                upperBound = capacityScore * capacityWeight + equipmentWeight
+            if upperBound < bestScore or (upperBound == bestScore and
+                                          (bestIdx is None or roomIdx > bestIdx)):
+                self.pruned += 1
+                return
+
+            self.evaluations += 1
+            if itemCount:
+                matches = 0
+                quantity = self.quantity[roomIdx]
+                for col, requiredQty, gateColumns in required:
+                    # Gated items only count when the room has all their dependencies;
+                    # the upper bound above ignores gates, so it stays an upper bound
+                    if gateColumns and any(gate is None or quantity[gate] <= 0 for gate in gateColumns):
+                        continue
+                    availableQty = quantity[col] if col is not None else 0
+                    if availableQty >= requiredQty:
+                        matches += 1  # Full match
+                    elif availableQty > 0:
+                        matches += (availableQty / requiredQty)  # Partial match
+                equipmentScore = matches / itemCount
+            else:
+                equipmentScore = 1.0
+            score = capacityScore * capacityWeight + equipmentScore * equipmentWeight
+            if score > bestScore or (score == bestScore and bestIdx is not None and roomIdx < bestIdx):
+                bestScore = score
+                bestIdx = roomIdx
+
+        # Rooms large enough, smallest first: capacity score only falls as rooms grow
+        start = bisect_left(keys, (requiredCapacity, -1))
+        for pos in range(start, len(keys)):
+            if removed[pos]:
+                continue
+            capacityScore = min(1.0, requiredCapacity / keys[pos][0] + capacityBonus)
+            if capacityScore * capacityWeight + equipmentWeight < bestScore:
+                self.pruned += len(keys) - pos
+                break
+            consider(pos, capacityScore)
+
+        # Undersized rooms all share the undersized capacity penalty
+        if undersizedScore * capacityWeight + equipmentWeight >= bestScore:
+            for pos in range(start):
+                if not removed[pos]:
+                    consider(pos, undersizedScore)
+        else:
+            self.pruned += start
+
+        if bestIdx is None:
+            return None, 0
+        return bestIdx, bestScore
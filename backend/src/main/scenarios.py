@@ -0,0 +1,170 @@
+# What-if roster scenarios evaluated against one shared base dataset
+# A scenario names a set of changes to the base rooms, e.g.
+#   {'name': 'no lab 3', 'closeRooms': [3]}
+#   {'name': 'more pipettes', 'addEquipment': [{'roomId': 1, 'equipmentId': 5, 'quantity': 2}]}
+#   {'name': 'stricter', 'policy': {'threshold': 0.7}}
+# Each is allocated independently; none of them touches the live timetable.
+from concurrent.futures import ProcessPoolExecutor
+from main.algorithm import allocateRooms, partitionUsersAndRooms, usesScoreMatrix, workerContext
+from main.dependencies import expandUsers
+from main.models import Room, toUsers, toRooms
+from main.policy import DEFAULT_POLICY, ScoringPolicy
+from main.scorecache import ScoreCache
+
+# Change lists a scenario may contain
+SCENARIO_CHANGES = ('closeRooms', 'addEquipment', 'policy')
+
+def isScalarId(value):
+    """Whether a scenario change can use value as a room or equipment id; bools are not ids"""
+    return isinstance(value, (int, str)) and not isinstance(value, bool)
+
+def validateScenarios(scenarios, rooms, policy=None):
+    """
+    Check scenario documents against the base rooms and scoring policy
+
+    Raises:
+        ValueError: If scenarios is not a non-empty list of dicts with unique
+            string names, or a change is malformed, uses a non-scalar id or
+            names an unknown room
+    """
+    if not isinstance(scenarios, list) or not scenarios:
+        raise ValueError("Scenarios must be a non-empty list")
+    roomIds = {room.id for room in rooms}
+    names = set()
+    for scenario in scenarios:
+        if not isinstance(scenario, dict) or not isinstance(scenario.get('name'), str):
+            raise ValueError("Every scenario needs a name")
+        if scenario['name'] in names:
+            raise ValueError(f"Duplicate scenario name: {scenario['name']}")
+        names.add(scenario['name'])
+        unknown = set(scenario) - set(SCENARIO_CHANGES) - {'name'}
+        if unknown:
+            raise ValueError(f"Unknown scenario changes: {sorted(unknown)}")
+
+        closeRooms = scenario.get('closeRooms', [])
+        if not isinstance(closeRooms, list) or not all(
+            isScalarId(roomId) and roomId in roomIds for roomId in closeRooms
+        ):
+            raise ValueError(f"Invalid closeRooms in scenario {scenario['name']}")
+        addEquipment = scenario.get('addEquipment', [])
+        if not isinstance(addEquipment, list) or not all(
+            isinstance(item, dict) and isScalarId(item.get('roomId')) and item['roomId'] in roomIds and
+            isScalarId(item.get('equipmentId')) and
+            isinstance(item.get('quantity'), (int, float)) and item['quantity'] > 0
+            for item in addEquipment
+        ):
+            raise ValueError(f"Invalid addEquipment in scenario {scenario['name']}")
+        if 'policy' in scenario:
+            try:
+                ScoringPolicy.fromDocument(scenario['policy'], policy)
+            except ValueError as error:
+                raise ValueError(f"Invalid policy in scenario {scenario['name']}: {error}")
+
+def applyScenario(rooms, scenario):
+    """
+    Base rooms with a scenario's changes applied
+    Unchanged rooms are shared with the base list, so their score columns are
+    reused from a shared ScoreCache
+
+    Returns:
+        list: Room models, in base order without closed rooms
+    """
+    closed = set(scenario.get('closeRooms', []))
+    added = {}
+    for item in scenario.get('addEquipment', []):
+        equipment = added.setdefault(item['roomId'], {})
+        equipment[item['equipmentId']] = equipment.get(item['equipmentId'], 0) + item['quantity']
+
+    scenarioRooms = []
+    for room in rooms:
+        if room.id in closed:
+            continue
+        if room.id in added:
+            equipment = dict(room.equipment)
+            for eqId, quantity in added[room.id].items():
+                equipment[eqId] = equipment.get(eqId, 0) + quantity
+            room = Room(room.id, room.name, room.capacity, room.chemicalUse, equipment, room.extra)
+        scenarioRooms.append(room)
+    return scenarioRooms
+
+# Base input of the scenario run a worker process serves, see initScenarioWorker
+workerInput = None
+
+def initScenarioWorker(*baseInput):
+    """Keep a scenario run's base input in a worker process, sent once per worker"""
+    global workerInput
+    workerInput = baseInput
+
+def evaluateScenario(scenario, users, rooms, options, scoreCache, policy):
+    """
+    Allocate rooms under one scenario
+    Returns: allocateRooms result with the scenario's 'name'
+    """
+    result = allocateRooms(
+        users, applyScenario(rooms, scenario), scoreCache=scoreCache,
+        policy=ScoringPolicy.fromDocument(scenario.get('policy', {}), policy), **options
+    )
+    result['name'] = scenario['name']
+    return result
+
+def runScenarioWorker(scenario):
+    """evaluateScenario over the base input of this worker process"""
+    return evaluateScenario(scenario, *workerInput)
+
+def runScenarios(users, rooms, scenarios, engine='python', solver='greedy', mode='week', slots=1,
+                 closures=None, improveTime=0, maxWorkers=1, scoreCache=None, policy=None):
+    """
+    Allocate rooms under every scenario, all starting from the same users and rooms
+    When the allocation works from score matrices, the base scores are
+    computed once into a shared ScoreCache, so each scenario only scores the
+    rooms it changed. With several workers, scenarios run on a process pool
+    whose workers each receive the base input and a copy of the cached rows once.
+
+    Args:
+        users: Base users, as User models or documents
+        rooms: Base rooms, as Room models or documents
+        scenarios: Scenario documents, see validateScenarios
+        engine, solver, mode, slots, closures, improveTime: As allocateRooms takes them
+        maxWorkers: Worker processes evaluating scenarios, 1 evaluates them in
+            the calling process, None uses every core
+        scoreCache: ScoreCache to share, a new one sized for the users when None
+        policy: Base ScoringPolicy, DEFAULT_POLICY when None; a scenario's
+            'policy' overrides some of its parameters
+
+    Returns:
+        list: allocateRooms results in scenario order, each with its 'name'
+
+    Raises:
+        ValueError: If a scenario is invalid, see validateScenarios
+    """
+    users = toUsers(users)
+    rooms = toRooms(rooms)
+    policy = policy or DEFAULT_POLICY
+    validateScenarios(scenarios, rooms, policy)
+
+    if usesScoreMatrix(engine, solver, mode, improveTime):
+        if scoreCache is None:
+            scoreCache = ScoreCache(maxSize=len(users))
+        # Rows are keyed by expanded preference, as allocateRooms scores them
+        baseUsers = [user for user in users if user.availability]
+        if closures is not None:
+            baseUsers = expandUsers(baseUsers, closures)
+        for partitionUsers, partitionRooms in partitionUsersAndRooms(baseUsers, rooms):
+            if partitionUsers and partitionRooms:
+                scoreCache.matrix(partitionUsers, partitionRooms, policy=policy)
+
+    options = {
+        'engine': engine, 'solver': solver, 'mode': mode, 'slots': slots,
+        'closures': closures, 'improveTime': improveTime
+    }
+    if maxWorkers == 1 or len(scenarios) == 1:
+        return [evaluateScenario(scenario, users, rooms, options, scoreCache, policy) for scenario in scenarios]
+
+    # Workers score with their own copy of the precomputed rows, not the store
+    workerCache = scoreCache.detached() if scoreCache is not None else None
+    workers = min(maxWorkers or len(scenarios), len(scenarios))
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=workerContext(), initializer=initScenarioWorker,
+        initargs=(users, rooms, options, workerCache, policy)
+    ) as executor:
+        return list(executor.map(runScenarioWorker, scenarios))
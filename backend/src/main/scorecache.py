@@ -0,0 +1,168 @@
+# Score matrix cache reused across allocation runs
+# Rows of user x room scores are kept per distinct room preference and
+# indexed by room fingerprint, so a re-run only scores the pairs whose
+# preference or room attributes changed since the row was last scored.
+import numpy as np
+from pymongo import UpdateOne
+from main.cache import LRUCache
+from main.encoding import fingerprint
+from main.scoring import calculateScoreMatrix
+from main.policy import DEFAULT_POLICY
+
+def preferenceKey(user):
+    """
+    Everything about a User that affects its scores, usable as a dict key
+    Equipment keeps its order since scores are summed in requirement order
+    """
+    return (user.capacity, user.chemicalUse, user.equipment, user.gates)
+
+def roomFingerprint(room):
+    """Hex digest of everything about a Room that affects its scores"""
+    return fingerprint([room.capacity, room.chemicalUse, sorted(room.equipment.items())])
+
+class ScoreCache:
+    """
+    LRU cache of score rows keyed by scoring policy and room preference, optionally backed by a
+    MongoDB collection so rows survive restarts and are shared between processes
+
+    Each row is stored with a columns mapping of room fingerprint to position;
+    rows scored together share one mapping. Cached rows are re-indexed to the
+    current rooms by fingerprint, and only rooms missing from a row are scored.
+    """
+
+    def __init__(self, maxSize=4096, store=None):
+        """
+        Args:
+            maxSize: Distinct room preferences kept in memory, 0 disables caching
+            store: Optional MongoDB collection persisting rows; None keeps
+                them in memory only
+        """
+        self.rows = LRUCache(maxSize)
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Discard every row held in memory"""
+        self.rows.clear()
+
+    def detached(self):
+        """
+        Copy of the rows held in memory without the store, e.g. for worker
+        processes, which must not share the parent's MongoDB connections
+        Rows are never modified in place, so the copy shares them
+        """
+        cache = ScoreCache(self.rows.maxSize)
+        cache.rows = self.rows.copy()
+        return cache
+
+    def matrix(self, users, rooms, counters=None, policy=None):
+        """
+        Score matrix of users x rooms, as calculateScoreMatrix returns it
+        Users sharing a room preference are scored once
+
+        Args:
+            users: List of User models
+            rooms: List of Room models
+            counters: Optional dict whose 'scoreEvaluations' count is increased
+                by the pairs scored and 'scoreCacheHits' by the pairs reused
+            policy: ScoringPolicy to score with, DEFAULT_POLICY when None
+
+        Returns:
+            numpy.ndarray: U x R matrix of scores, NaN where incompatible
+
+        Time Complexity: O(P * R) to gather cached rows plus O(M * E) to score
+        the M missing pairs, where P is the number of distinct preferences
+        """
+        policy = policy or DEFAULT_POLICY
+        policyKey = policy.key()
+        roomKeys = [roomFingerprint(room) for room in rooms]
+        columns = {key: c for c, key in enumerate(roomKeys)}
+
+        # First user of each distinct preference stands in for the rest
+        position = {}
+        representatives = []
+        userRows = np.empty(len(users), dtype=int)
+        for u, user in enumerate(users):
+            key = (policyKey, preferenceKey(user))
+            if key not in position:
+                position[key] = len(representatives)
+                representatives.append(user)
+            userRows[u] = position[key]
+
+        keys = list(position)
+        entries = [self.rows.get(key) for key in keys]
+        if self.store is not None:
+            self.loadRows(keys, entries)
+
+        scores = np.empty((len(keys), len(rooms)))
+        hits = 0
+        missing = []
+        scored = []
+        # Rows scored together share their columns mapping, so re-index per mapping
+        groups = {}
+        for p, entry in enumerate(entries):
+            if entry is None:
+                missing.append(p)
+            else:
+                groups.setdefault(id(entry[0]), (entry[0], []))[1].append(p)
+
+        for cachedColumns, group in groups.values():
+            index = np.array([cachedColumns.get(key, -1) for key in roomKeys], dtype=int)
+            known = index >= 0
+            cached = np.stack([entries[p][1] for p in group])
+            scores[np.ix_(group, np.flatnonzero(known))] = cached[:, index[known]]
+            hits += len(group) * int(np.count_nonzero(known))
+            unknown = np.flatnonzero(~known)
+            if len(unknown):
+                scores[np.ix_(group, unknown)] = calculateScoreMatrix(
+                    [representatives[p] for p in group], [rooms[r] for r in unknown], policy
+                )
+                scored.extend(group)
+
+        if missing:
+            scores[missing] = calculateScoreMatrix([representatives[p] for p in missing], rooms, policy)
+            scored.extend(missing)
+
+        # Every row is re-indexed to the current rooms so the next run gathers it directly
+        for p, key in enumerate(keys):
+            self.rows.put(key, (columns, scores[p].copy()))
+        if self.store is not None and scored:
+            self.saveRows([keys[p] for p in scored], roomKeys, scores[scored])
+
+        evaluations = scores.size - hits
+        self.hits += hits
+        self.misses += evaluations
+        if counters is not None:
+            counters['scoreEvaluations'] += evaluations
+            counters['scoreCacheHits'] = counters.get('scoreCacheHits', 0) + hits
+        return scores[userRows]
+
+    def loadRows(self, keys, entries):
+        """Fill entries missing from memory with rows from the store, in place"""
+        wanted = {fingerprint(keys[p]): p for p, entry in enumerate(entries) if entry is None}
+        if not wanted:
+            return
+        roomLists = {}
+        for document in self.store.find({'_id': {'$in': list(wanted)}}):
+            roomsId = document['rooms']
+            if roomsId not in roomLists:
+                roomList = self.store.find_one({'_id': roomsId})
+                roomLists[roomsId] = (
+                    {key: c for c, key in enumerate(roomList['roomKeys'])} if roomList else None
+                )
+            if roomLists[roomsId] is None:
+                continue
+            p = wanted[document['_id']]
+            entries[p] = (roomLists[roomsId], np.frombuffer(document['scores'], dtype=float))
+            self.rows.put(keys[p], entries[p])
+
+    def saveRows(self, keys, roomKeys, rows):
+        """Upsert rows scored against roomKeys into the store"""
+        roomsId = 'rooms-' + fingerprint(roomKeys)
+        requests = [UpdateOne({'_id': roomsId}, {'$set': {'roomKeys': roomKeys}}, upsert=True)]
+        requests.extend(
+            UpdateOne({'_id': fingerprint(key)}, {'$set': {'rooms': roomsId, 'scores': row.tobytes()}}, upsert=True)
+            for key, row in zip(keys, rows)
+        )
+        self.store.bulk_write(requests, ordered=False)
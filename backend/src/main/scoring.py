@@ -0,0 +1,164 @@
+# Vectorised scoring engine for room allocation
+import numpy as np
+from main.models import toUsers, toRooms
+from main.policy import DEFAULT_POLICY
+
+def encodeRooms(rooms, equipmentIds):
+    """
+    Encode rooms into dense arrays for batch scoring
+
+    Args:
+        rooms: List of Room models
+        equipmentIds: List of equipment ids, one per matrix column
+
+    Returns:
+        dict: Capacity vector (R), chemical use vector (R) and
+              equipment quantity matrix (R x E)
+    """
+    column = {eqId: i for i, eqId in enumerate(equipmentIds)}
+    capacity = np.zeros(len(rooms), dtype=float)
+    chemicalUse = np.zeros(len(rooms), dtype=bool)
+    quantity = np.zeros((len(rooms), len(equipmentIds)), dtype=float)
+
+    for r, room in enumerate(rooms):
+        capacity[r] = room.capacity
+        chemicalUse[r] = room.chemicalUse
+        for eqId, qty in room.equipment.items():
+            if eqId in column:
+                quantity[r, column[eqId]] = qty
+
+    return {
+        'capacity': capacity,
+        'chemicalUse': chemicalUse,
+        'quantity': quantity
+    }
+
+def encodeUsers(users, equipmentIds):
+    """
+    Encode user room preferences into dense arrays for batch scoring
+    Each user's equipment requirements keep their original order so scores
+    are summed exactly as calculateRoomScore sums them
+
+    Args:
+        users: List of User models
+        equipmentIds: List of equipment ids, one per matrix column
+
+    Returns:
+        dict: Capacity vector (U), chemical use vector (U), required equipment
+              column (U x K, -1 padded) and quantity (U x K) per requirement slot,
+              columns of the items each slot is gated on (U x K x G, -1 padded),
+              and number of distinct equipment items per user (U)
+    """
+    column = {eqId: i for i, eqId in enumerate(equipmentIds)}
+    maxItems = max((len(user.equipment) for user in users), default=0)
+    maxGates = max((len(gate) for user in users if user.gates for gate in user.gates), default=0)
+
+    capacity = np.zeros(len(users), dtype=float)
+    chemicalUse = np.zeros(len(users), dtype=bool)
+    itemColumn = np.full((len(users), maxItems), -1, dtype=int)
+    itemQuantity = np.zeros((len(users), maxItems), dtype=float)
+    itemGates = np.full((len(users), maxItems, maxGates), -1, dtype=int)
+    itemCount = np.zeros(len(users), dtype=int)
+
+    for u, user in enumerate(users):
+        capacity[u] = user.capacity
+        chemicalUse[u] = user.chemicalUse
+        itemCount[u] = len(user.equipment)
+        for k, (eqId, quantity) in enumerate(user.equipment):
+            itemColumn[u, k] = column[eqId]
+            itemQuantity[u, k] = quantity
+            if user.gates is not None:
+                for g, gateId in enumerate(user.gates[k]):
+                    itemGates[u, k, g] = column[gateId]
+
+    return {
+        'capacity': capacity,
+        'chemicalUse': chemicalUse,
+        'itemColumn': itemColumn,
+        'itemQuantity': itemQuantity,
+        'itemGates': itemGates,
+        'itemCount': itemCount
+    }
+
+def requiredEquipmentIds(users):
+    """
+    Collect the equipment ids requested or gated on by any user, in first-seen order
+    Rooms only need to be encoded on these columns
+    """
+    equipmentIds = {}
+    for user in users:
+        for eqId, _ in user.equipment:
+            equipmentIds.setdefault(eqId, None)
+        for gate in user.gates or ():
+            for gateId in gate:
+                equipmentIds.setdefault(gateId, None)
+    return list(equipmentIds)
+
+def calculateScoreMatrix(users, rooms, policy=None):
+    """
+    Calculate compatibility scores for every user and room pair at once
+    Produces the same weighted scores as the policy's scalar kernel
+
+    Args:
+        users: List of users, as User models or documents
+        rooms: List of rooms, as Room models or documents
+        policy: ScoringPolicy supplying weights and the capacity curve,
+            DEFAULT_POLICY when None
+
+    Returns:
+        numpy.ndarray: U x R matrix of scores between 0 and 1, with NaN
+                       where the chemical preference does not match
+
+    Time Complexity: O(U * R * K) where K is the largest number of
+    equipment items requested by one user, evaluated as K broadcast operations
+    """
+    users = toUsers(users)
+    rooms = toRooms(rooms)
+    policy = policy or DEFAULT_POLICY
+    equipmentIds = requiredEquipmentIds(users)
+    userData = encodeUsers(users, equipmentIds)
+    roomData = encodeRooms(rooms, equipmentIds)
+
+    # Capacity scoring: the undersized penalty for undersized rooms, otherwise
+    # ratio plus the bonus, capped at 1.0
+    requiredCapacity = userData['capacity'][:, None]
+    roomCapacity = roomData['capacity'][None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        capacityScore = np.where(
+            roomCapacity < requiredCapacity,
+            policy.undersizedScore,
+            np.minimum(1.0, requiredCapacity / roomCapacity + policy.capacityBonus)
+        )
+
+    # Equipment scoring: accumulate full or partial matches one requirement slot
+    # at a time, in each user's own order, so memory stays at O(U * R)
+    matches = np.zeros((len(users), len(rooms)), dtype=float)
+    for k in range(userData['itemColumn'].shape[1]):
+        userIdx = np.nonzero(userData['itemColumn'][:, k] >= 0)[0]
+        requiredQty = userData['itemQuantity'][userIdx, k][:, None]
+        availableQty = roomData['quantity'][:, userData['itemColumn'][userIdx, k]].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            partial = np.where(
+                availableQty >= requiredQty,
+                1.0,
+                np.where(availableQty > 0, availableQty / requiredQty, 0.0)
+            )
+        # Gated items count nothing in rooms missing any of their dependencies
+        for g in range(userData['itemGates'].shape[2]):
+            gateColumn = userData['itemGates'][userIdx, k, g]
+            gated = gateColumn >= 0
+            present = roomData['quantity'][:, gateColumn].T > 0
+            partial = np.where(gated[:, None] & ~present, 0.0, partial)
+        matches[userIdx] += partial
+
+    itemCount = userData['itemCount'][:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # No equipment requirements means perfect match
+        equipmentScore = np.where(itemCount > 0, matches / np.maximum(itemCount, 1), 1.0)
+
+    scores = capacityScore * policy.capacityWeight + equipmentScore * policy.equipmentWeight
+
+    # Strict chemical safety check - mismatched pairs are incompatible
+    compatible = userData['chemicalUse'][:, None] == roomData['chemicalUse'][None, :]
+    scores[~compatible] = np.nan
+    return scores
@@ -1,52 +1,269 @@
-from flask import Flask, jsonify, request, abort
+import base64
+import os
+from flask import Flask, Response, request, abort, stream_with_context
 from flask_cors import CORS
-from main.data import database
-from bson.json_util import dumps
+from main.data import database, USER_ENRICHMENTS
+from main.algorithm import ENGINES, SOLVERS, MODES
+from main.models import DAYS
+from main.encoding import encode, fingerprint, jsonResponse, documentResponse
+from main.metrics import metrics
+from main.jobs import JobManager
+from bson.json_util import dumps, loads
 
 app = Flask(__name__)
 CORS(app)
 
+# Routes that return BSON documents wrap their JSON in a JSON string while this
+# is on, for clients that still parse the nested format; format=json opts out per request
+app.config['NESTED_JSON_STRINGS'] = os.environ.get('NESTED_JSON_STRINGS', 'true').lower() == 'true'
+
+# Timing spans and counters are only recorded while this is on
+metrics.enabled = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+# Background timetable generation; one worker keeps timetable writes in submission order
+timetableJobs = JobManager(maxWorkers=int(os.environ.get('TIMETABLE_JOB_WORKERS', '1')))
+
+# Upper bound on the improve query parameter, in seconds
+MAX_IMPROVE_SECONDS = float(os.environ.get('MAX_IMPROVE_SECONDS', '30'))
+
+# Upper bound on the workers query parameter, one process per core by default
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', str(os.cpu_count() or 1)))
+
+# Upper bound on the slots query parameter, time slots per day
+MAX_SLOTS = int(os.environ.get('MAX_SLOTS', '24'))
+
+# Whether this process has created the indexes in INDEXES, see ensureIndexesOnce
+indexesEnsured = False
+
+@app.before_request
+def ensureIndexesOnce():
+    """Create missing indexes before the first request this process serves"""
+    global indexesEnsured
+    if not indexesEnsured:
+        database.ensureIndexes()
+        indexesEnsured = True
+
+def encodeResumeToken(lastId):
+    """Opaque pagination token for the last _id of a page"""
+    return base64.urlsafe_b64encode(dumps(lastId).encode()).decode()
+
+def decodeResumeToken(token):
+    """Decode a pagination token back into the _id to resume after"""
+    try:
+        return loads(base64.urlsafe_b64decode(token.encode()).decode())
+    except ValueError:
+        abort(400, description = "Invalid resume token")
+
+def collectionResponse(iterate, getAll):
+    """
+    Serve a collection in one of three modes chosen by query parameters:
+      - format=ndjson: stream one JSON document per line straight off the cursor
+      - limit (and optionally after): one page plus a resume token for the next
+      - neither: the full collection, see documentResponse
+    """
+    limit = request.args.get('limit', type=int)
+    token = request.args.get('after')
+    after = decodeResumeToken(token) if token else None
+    if limit is not None and limit < 1:
+        abort(400, description = "Invalid limit")
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            for document in iterate(after, limit):
+                yield encode(document) + b'\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if limit is not None:
+        documents, lastId = database.page(iterate, limit, after)
+        body = {
+            'items': documents,
+            'next': encodeResumeToken(lastId) if lastId is not None else None
+        }
+        return jsonResponse(body)
+
+    return documentResponse(getAll())
+
+def allocationOptions():
+    """
+    Validated engine, solver, workers, mode, slots, dependencies and improve query
+    parameters of an allocation request, as keyword arguments for
+    Database.changeTimetable
+    """
+    engine = request.args.get('engine', 'python')
+    solver = request.args.get('solver', 'greedy')
+    workers = request.args.get('workers', 1, type=int)
+    mode = request.args.get('mode', 'week')
+    slots = request.args.get('slots', 1, type=int)
+    improve = request.args.get('improve', 0, type=float)
+    if engine not in ENGINES:
+        abort(400, description = "Unknown scoring engine")
+    if solver not in SOLVERS:
+        abort(400, description = "Unknown solver")
+    if not 1 <= workers <= MAX_WORKERS:
+        abort(400, description = "Invalid worker count")
+    if mode not in MODES:
+        abort(400, description = "Unknown scheduling mode")
+    if not 1 <= slots <= MAX_SLOTS or (slots > 1 and mode != 'daily'):
+        abort(400, description = "Invalid slot count")
+    if not 0 <= improve <= MAX_IMPROVE_SECONDS or (improve and mode != 'week'):
+        abort(400, description = "Invalid local search time")
+    return {
+        'engine': engine,
+        'solver': solver,
+        'maxWorkers': workers,
+        'mode': mode,
+        'slots': slots,
+        'dependencies': request.args.get('dependencies', 'false').lower() == 'true',
+        'improveTime': improve
+    }
+
+def rerosterRequested():
+    """Whether the request asks for an incremental timetable repair"""
+    return request.args.get('reroster', 'false').lower() == 'true'
+
+def validUserId(userId):
+    """Whether a bulk update item's userId can name a user; bools are not ids"""
+    return isinstance(userId, (int, str)) and not isinstance(userId, bool) and userId != ''
+
+def roomPreferenceUpdate(item):
+    """(userId, fields) for one room preference update, None if the item is invalid"""
+    if not isinstance(item, dict):
+        return None
+    userId = item.get("userId")
+    capacity = item.get("capacity")
+    chemicalUse = item.get("chemicalUse")
+    equipment = item.get("equipment")
+    if not (validUserId(userId) and capacity is not None and
+            chemicalUse is not None and isinstance(equipment, list)):
+        return None
+    return userId, {"roomPreference": {"capacity": capacity, "chemicalUse": chemicalUse, "equipment": equipment}}
+
+def unavailabilityUpdate(item):
+    """(userId, fields) for one unavailability update, None if the item is invalid"""
+    if not isinstance(item, dict):
+        return None
+    userId = item.get("userId")
+    unavailability = item.get("unavailability")
+    # Every day must be given, each as a bool
+    if not (validUserId(userId) and isinstance(unavailability, dict) and set(unavailability) == set(DAYS) and
+            all(isinstance(unavailable, bool) for unavailable in unavailability.values())):
+        return None
+    return userId, {"unavailability": unavailability}
+
+def bulkUpdateResponse(parseUpdate):
+    """
+    Apply a JSON array of user updates in one bulk write
+    Items that fail parseUpdate are reported 'invalid' and repeated user ids
+    'duplicate'; neither is written. With reroster=true the current
+    timetable is then regenerated once for all updated users.
+    """
+    items = request.json
+    if not isinstance(items, list):
+        abort(400, description = "Expected an array of updates")
+
+    results = [None] * len(items)
+    updates = []
+    positions = []
+    seen = set()
+    for position, item in enumerate(items):
+        update = parseUpdate(item)
+        userId = item.get("userId") if isinstance(item, dict) else None
+        if update is None:
+            results[position] = {"userId": userId, "status": "invalid"}
+        elif update[0] in seen:
+            results[position] = {"userId": userId, "status": "duplicate"}
+        else:
+            seen.add(update[0])
+            updates.append(update)
+            positions.append(position)
+
+    statuses = database.bulkUpdateUsers(updates)
+    for position, (userId, _), status in zip(positions, updates, statuses):
+        results[position] = {"userId": userId, "status": status}
+
+    updated = [userId for (userId, _), status in zip(updates, statuses) if status == 'updated']
+    if rerosterRequested() and updated:
+        database.regenerateTimetable(updated)
+    return jsonResponse({"updated": len(updated), "results": results})
+
 # Route: GET /get_users
 # Purpose: Retrieves all users from the database
-# Input: None
-# Output: JSON array containing all user records
+# Input:
+#   - enrichment (optional query parameter): Where equipment names are joined,
+#     'python' or 'aggregate' (inside MongoDB)
+#   - fields (optional query parameter): Comma separated top-level fields to return
+#   - limit, after (optional query parameters): Page size and resume token
+#   - format (optional query parameter): 'ndjson' to stream one user per line,
+#     'json' for plain JSON instead of a JSON string
+#   Paged and streamed users are always enriched in python, off the cursor
+# Output: JSON array containing all user records, a page object with 'items' and
+#   'next' resume token when limit is given, or an NDJSON stream;
+#   400 for unknown enrichment or invalid paging parameters
 @app.route('/get_users', methods=['GET'])
 def getUsers():
-    result = database.usersGet()
-    return jsonify(dumps(result))
+    enrichment = request.args.get('enrichment', 'python')
+    if enrichment not in USER_ENRICHMENTS:
+        abort(400, description = "Unknown enrichment")
+    fields = request.args.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else None
+
+    return collectionResponse(
+        lambda after, limit: database.usersIter(after, limit, fields),
+        lambda: database.usersGet(enrichment=enrichment, fields=fields)
+    )
 
 # Route: GET /get_equipment
 # Purpose: Retrieves all available equipment from the database
-# Input: None
+# Input:
+#   - format (optional query parameter): 'json' for plain JSON instead of a JSON string
 # Output: JSON array containing all equipment records
 @app.route('/get_equipment', methods=['GET'])
 def getEquipment():
     result = database.equipmentGet()
-    return jsonify(dumps(result))
+    return documentResponse(result)
 
 # Route: GET /get_timetable
 # Purpose: Retrieves the current room allocation timetable
-# Input: None
-# Output: JSON object containing room assignments for each day
+# Input:
+#   - limit, after (optional query parameters): Page size and resume token
+#   - format (optional query parameter): 'ndjson' to stream one document per line,
+#     'json' for plain JSON instead of a JSON string
+#   - since (optional query parameter): Timetable version already held by the client
+# Output: JSON object containing room assignments for each day, a page object
+#   when limit is given, or an NDJSON stream; with since, a JSON object with the
+#   current 'version' and only the days changed after it in 'changes' ('full'
+#   true if the whole timetable had to be sent); 400 for an invalid since
 @app.route('/get_timetable', methods=['GET'])
 def getTimetable():
-    result = database.timetableGet()
-    return jsonify(dumps(result))
+    if 'since' in request.args:
+        since = request.args.get('since', type=int)
+        if since is None:
+            abort(400, description = "Invalid since version")
+        return jsonResponse(database.timetableDelta(since))
+    return collectionResponse(database.timetableIter, database.timetableGet)
 
 # Route: PUT /put_unavailability
 # Purpose: Updates a user's unavailability schedule
 # Input: JSON object containing:
 #   - userId: User identifier
 #   - unavailability: Object with boolean values for each weekday
-# Output: Updated unavailability object on success, 404 if user not found
+#   - reroster (optional query parameter): 'true' to repair the current timetable
+#     for this user instead of requiring a full PUT /put_timetable
+# Output: Updated unavailability object on success, 400 unless every weekday is
+#   given as a boolean, 404 if user not found
 @app.route('/put_unavailability', methods=['PUT'])
 def putUserUnavailability():
-    userId = request.json['userId']
-    unavailability = request.json['unavailability']
+    update = unavailabilityUpdate(request.get_json(silent=True))
+    if update is None:
+        abort(400, description = "Invalid input data")
+    userId, fields = update
+    unavailability = fields["unavailability"]
 
     result = database.changeUnavailability(userId, unavailability)
     if result:
-        return jsonify(result)
+        if rerosterRequested():
+            database.rerosterUser(userId)
+        return jsonResponse(result)
     else:
         abort(404)
 
@@ -57,6 +274,8 @@ def putUserUnavailability():
 #   - capacity: Required room capacity
 #   - chemicalUse: Boolean indicating if chemicals are needed
 #   - equipment: Array of required equipment objects
+#   - reroster (optional query parameter): 'true' to repair the current timetable
+#     for this user instead of requiring a full PUT /put_timetable
 # Output: Success message on update, 400 for invalid data, 404 if user not found
 @app.route('/put_room_preference', methods=['PUT'])
 def putUserRoomPreference():
@@ -71,23 +290,170 @@ def putUserRoomPreference():
 
     result = database.setRoomPreference(userId, capacity, chemicalUse, equipment)
     if result:
-        return jsonify({"message": "Room preference updated successfully"}), 200
+        if rerosterRequested():
+            database.rerosterUser(userId)
+        return jsonResponse({"message": "Room preference updated successfully"}, 200)
     else:
         abort(404, description = "User not found")
 
+# Route: PUT /put_unavailabilities
+# Purpose: Updates many users' unavailability schedules in one database round trip
+# Input: JSON array of objects each containing userId and unavailability,
+#   as for PUT /put_unavailability
+#   - reroster (optional query parameter): 'true' to regenerate the current
+#     timetable once after the updates
+# Output: JSON object with the number of users updated and a per-item status in
+#   input order ('updated', 'not_found', 'invalid', 'duplicate' or a write
+#   error message); 400 if the body is not an array
+@app.route('/put_unavailabilities', methods=['PUT'])
+def putUserUnavailabilities():
+    return bulkUpdateResponse(unavailabilityUpdate)
+
+# Route: PUT /put_room_preferences
+# Purpose: Updates many users' room requirements in one database round trip
+# Input: JSON array of objects each containing userId, capacity, chemicalUse and
+#   equipment, as for PUT /put_room_preference
+#   - reroster (optional query parameter): 'true' to regenerate the current
+#     timetable once after the updates
+# Output: JSON object with the number of users updated and a per-item status in
+#   input order ('updated', 'not_found', 'invalid', 'duplicate' or a write
+#   error message); 400 if the body is not an array
+@app.route('/put_room_preferences', methods=['PUT'])
+def putUserRoomPreferences():
+    return bulkUpdateResponse(roomPreferenceUpdate)
+
 # Route: PUT /put_timetable
 # Purpose: Updates the room allocation timetable
 # Input: JSON array of user objects to be allocated rooms
-# Output: Success message on update, 404 if update fails
+#   - engine (optional query parameter): Scoring engine, 'python', 'numpy' or 'indexed'
+#   - solver (optional query parameter): Assignment strategy, 'greedy' or 'optimal'
+#   - workers (optional query parameter): Worker processes for independent partitions,
+#     at most MAX_WORKERS
+#   - mode (optional query parameter): 'week' for one room per user all week, or
+#     'daily' to allocate rooms per day so rooms can be shared across days
+#   - slots (optional query parameter): Time slots per day in 'daily' mode, at most
+#     MAX_SLOTS; entries then carry their 'slot'
+#   - dependencies (optional query parameter): 'true' to also require the
+#     equipment each requested item depends on, via the catalog's dependentId
+#   - improve (optional query parameter): Seconds of swap and relocation local
+#     search after Phase 1, 'week' mode only, at most MAX_IMPROVE_SECONDS
+# Output: Success message and allocation statistics (total score, assigned users,
+#   wall time, local search gains) on update, 400 for invalid parameters, 404 if update fails
 @app.route('/put_timetable', methods=['PUT'])
 def putTimetable():
     data = request.json
-    result = database.changeTimetable(data)
+    options = allocationOptions()
+
+    result = database.changeTimetable(data, **options)
     if result:
-        return jsonify({"message": "Timetable updated successfully"}), 200
+        return jsonResponse({
+            "message": "Timetable updated successfully",
+            "stats": result
+        }, 200)
     else:
         abort(404, description = "Timetable could not be updated")
 
+# Route: PUT /generate_timetable
+# Purpose: Updates the room allocation timetable from the users stored in the database
+# Input: Optional JSON object with userIds, an array of the users to roster;
+#   every user is rostered when omitted. Takes the same engine, solver and
+#   workers query parameters as PUT /put_timetable
+#   Users unavailable all week are filtered out by the database query
+# Output: Success message and allocation statistics, 400 for invalid parameters
+#   or userIds that are not all string or integer ids
+@app.route('/generate_timetable', methods=['PUT'])
+def generateTimetable():
+    data = request.get_json(silent=True) or {}
+    options = allocationOptions()
+    userIds = data.get('userIds') if isinstance(data, dict) else None
+    if userIds is not None and not (isinstance(userIds, list) and all(validUserId(userId) for userId in userIds)):
+        abort(400, description = "Invalid userIds")
+
+    result = database.generateTimetable(userIds=userIds, **options)
+    return jsonResponse({
+        "message": "Timetable updated successfully",
+        "stats": result
+    }, 200)
+
+# Route: POST /scenarios
+# Purpose: Evaluates what-if scenarios against the stored users and rooms
+#   without touching the live timetable
+# Input: JSON object with scenarios, an array of objects each containing a
+#   unique name and optionally:
+#   - closeRooms: Array of room ids left out of the scenario
+#   - addEquipment: Array of objects with roomId, equipmentId and quantity
+#     added to that room
+#   and optional userIds as for PUT /generate_timetable. Takes the same query
+#   parameters as PUT /put_timetable; workers is the number of worker
+#   processes evaluating scenarios
+# Output: Run id and each scenario's name and allocation statistics; results
+#   are stored for GET /scenarios/<runId>. 400 for invalid scenarios or parameters
+@app.route('/scenarios', methods=['POST'])
+def postScenarios():
+    data = request.get_json(silent=True)
+    options = allocationOptions()
+    if not isinstance(data, dict):
+        abort(400, description = "Invalid scenarios")
+    userIds = data.get('userIds')
+    if userIds is not None and not (isinstance(userIds, list) and all(validUserId(userId) for userId in userIds)):
+        abort(400, description = "Invalid userIds")
+
+    try:
+        result = database.runScenarios(data.get('scenarios'), userIds=userIds, **options)
+    except ValueError as error:
+        abort(400, description = str(error))
+    return jsonResponse(result, 200)
+
+# Route: GET /scenarios/<runId>
+# Purpose: Retrieves the stored results of a scenario run
+# Input: runId as URL parameter
+# Output: JSON array of each scenario with its timetable, assignments and
+#   statistics, in submission order; 404 if the run is unknown
+@app.route('/scenarios/<runId>', methods=['GET'])
+def getScenarios(runId):
+    results = database.scenarioResultsGet(runId)
+    if not results:
+        abort(404, description = "Scenario run not found")
+    return jsonResponse(results)
+
+# Route: POST /timetable_jobs
+# Purpose: Queues timetable generation in the background and returns immediately
+# Input: JSON array of user objects to be allocated rooms, with the same
+#   engine, solver and workers query parameters as PUT /put_timetable
+# Output: 202 with the job id and status; a submission identical to a queued or
+#   running job returns that job with 'duplicate' true; 400 for invalid parameters
+@app.route('/timetable_jobs', methods=['POST'])
+def postTimetableJob():
+    data = request.json
+    options = allocationOptions()
+
+    # Worker count does not change the result
+    key = fingerprint([data, {k: v for k, v in options.items() if k != 'maxWorkers'}])
+    jobId, created = timetableJobs.submit(key, database.changeTimetable, data, reportProgress=True, **options)
+    job = timetableJobs.get(jobId)
+    response = jsonResponse({
+        "jobId": jobId,
+        "status": job['status'] if job else 'queued',
+        "duplicate": not created
+    }, 202)
+    response.headers['Location'] = f'/timetable_jobs/{jobId}'
+    return response
+
+# Route: GET /timetable_jobs/<jobId>
+# Purpose: Reports the progress of a background timetable generation job
+# Input: jobId as URL parameter
+# Output: JSON object with the job's status ('queued', 'running', 'done' or
+#   'failed'), submitted/started/finished timestamps, 'progress' with the current
+#   phase ('assign', 'timetable' or 'save') and partitions solved out of
+#   'partitions' while running, allocation statistics as 'result' once done
+#   and 'error' if it failed; 404 if the job is unknown
+@app.route('/timetable_jobs/<jobId>', methods=['GET'])
+def getTimetableJob(jobId):
+    job = timetableJobs.get(jobId)
+    if job is None:
+        abort(404, description = "Job not found")
+    return jsonResponse(job)
+
 # Route: GET /get_user_requestroom/<userId>
 # Purpose: Retrieves room request details for a specific user
 # Input: userId as URL parameter
@@ -98,26 +464,57 @@ def getUserRequestRoom(userId):
     result = database.getUserRequestedRoom(userIdInt)
     
     if result is None:
-        return jsonify({
+        return jsonResponse({
             "message": "No room request found or user does not exist"
-        }), 404
+        }, 404)
         
-    return jsonify(result), 200
+    return jsonResponse(result)
 
 # Route: GET /get_room/<room_id>
 # Purpose: Retrieves details of a specific room
 # Input: room_id as URL parameter
+#   - format (optional query parameter): 'json' for plain JSON instead of a JSON string
 # Output: JSON object with room details, 404 if room not found
 @app.route('/get_room/<room_id>', methods=['GET'])
 def getRoomById(room_id):
     result = database.getRoomWithId(room_id)
     
     if result is None:
-        return jsonify({
+        return jsonResponse({
             "message": "Room not found"
-        }), 404
+        }, 404)
         
-    return jsonify(dumps(result)), 200
+    return documentResponse(result)
+
+# Route: GET /scoring_policy
+# Purpose: Retrieves the scoring weights, capacity curve and threshold used by allocations
+# Input: None
+# Output: JSON object with capacityWeight, equipmentWeight, threshold,
+#   undersizedScore and capacityBonus
+@app.route('/scoring_policy', methods=['GET'])
+def getScoringPolicy():
+    return jsonResponse(database.scoringPolicy().toDocument())
+
+# Route: PUT /scoring_policy
+# Purpose: Changes the scoring policy used by later allocations
+# Input: JSON object with any of the parameters GET /scoring_policy returns;
+#   parameters left out take their defaults
+# Output: The stored policy, 400 for unknown parameters or invalid values
+@app.route('/scoring_policy', methods=['PUT'])
+def putScoringPolicy():
+    try:
+        policy = database.setScoringPolicy(request.get_json(silent=True))
+    except ValueError as error:
+        abort(400, description = str(error))
+    return jsonResponse(policy.toDocument())
+
+# Route: GET /metrics
+# Purpose: Exposes allocation and database timings and counters for Prometheus
+# Input: None
+# Output: Prometheus text exposition format, empty while METRICS_ENABLED is off
+@app.route('/metrics', methods=['GET'])
+def getMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
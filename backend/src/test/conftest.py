@@ -0,0 +1,17 @@
+# Test setup shared by every test module
+import functools
+from mongomock.collection import BulkOperationBuilder
+
+def ignoreSort(method):
+    """
+    Wrap a mongomock bulk builder method to drop the sort argument that newer
+    pymongo versions pass from UpdateOne and ReplaceOne, which mongomock does
+    not accept yet
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, sort=None, **kwargs):
+        return method(self, *args, **kwargs)
+    return wrapper
+
+BulkOperationBuilder.add_update = ignoreSort(BulkOperationBuilder.add_update)
+BulkOperationBuilder.add_replace = ignoreSort(BulkOperationBuilder.add_replace)
@@ -1,8 +1,23 @@
-from main.server import app, database
+from main.server import app, database, timetableJobs
+from main.algorithm import calculateRoomScore, scoreRoom, allocateRooms, repairAllocation, SOLVERS
+from main.scoring import calculateScoreMatrix
+from main.roomindex import RoomIndex
+from main.models import DAYS, User, Room, Assignment
+from main.metrics import metrics
+from main.jobs import JobManager
+from main.dependencies import dependencyClosures, expandUser
+from main.scorecache import ScoreCache
+from main.scenarios import runScenarios
+from main.policy import ScoringPolicy, DEFAULT_POLICY
+from main import data
 from mongomock import MongoClient
 from flask import jsonify
+import numpy as np
 import pytest
 import json
+import math
+import pickle
+import threading
 
 # Sets up mock mongo instance so that actual mongoDB instance is not required for testing
 dummyClient = MongoClient()
@@ -25,10 +40,31 @@ def mockData():
             data = json.load(file)
             for d in data:
                 database.db['users'].insert_one(d)
+        # Equipment was written directly to the collection, bypassing the cache
+        database.invalidateEquipmentCache()
         yield
         database.db['equipment'].drop()
         database.db['rooms'].drop()
         database.db['users'].drop()
+        database.db['config'].drop()
+        database.invalidateScoringPolicy()
+
+# Builds a user document without chemical use, available on the given days
+def makeUser(userId, capacity=10, equipment=(), days=DAYS):
+    return {
+        '_id': userId,
+        'name': f'User {userId}',
+        'unavailability': {day: day not in days for day in DAYS},
+        'roomPreference': {'capacity': capacity, 'chemicalUse': False, 'equipment': list(equipment)}
+    }
+
+# Builds a room document without chemical use
+def makeRoom(roomId, capacity=10, equipment=(), name=None):
+    return {
+        '_id': roomId,
+        'name': name or f'Room {roomId}',
+        'attributes': {'capacity': capacity, 'chemicalUse': False, 'equipment': list(equipment)}
+    }
 
 # Tests one user avaiable for all days
 def test_algorithmOneUser(mockData):
@@ -264,4 +300,774 @@ def test_algorithmUsersOneDay(mockData):
     }]
 
     assert res.status_code == 200
-    assert actual == expected
\ No newline at end of file
+    assert actual == expected
+
+# Tests score matrix matches scalar scoring for every user and room pair
+def test_scoreMatrixMatchesScalar(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+
+    scores = calculateScoreMatrix(users, rooms)
+
+    for u, user in enumerate(users):
+        for r, room in enumerate(rooms):
+            expected = calculateRoomScore(user, room)
+            if expected is None:
+                assert math.isnan(scores[u, r])
+            else:
+                assert scores[u, r] == pytest.approx(expected)
+
+# Tests numpy engine produces the same timetable as the python engine
+def test_algorithmNumpyEngine(mockData):
+    client = app.test_client()
+
+    res = client.get('/get_users')
+    users = json.loads(res.json)
+
+    res = client.put('/put_timetable', json=users)
+    assert res.status_code == 200
+    expected = json.loads(client.get('/get_timetable').json)
+
+    res = client.put('/put_timetable?engine=numpy', json=users)
+    assert res.status_code == 200
+    actual = json.loads(client.get('/get_timetable').json)
+
+    assert actual == expected
+
+# Tests unknown engine is rejected
+def test_algorithmUnknownEngine(mockData):
+    client = app.test_client()
+
+    res = client.put('/put_timetable?engine=fortran', json=[])
+
+    assert res.status_code == 400
+
+# Tests optimal solver assigns at least as much total score as greedy and reports stats
+def test_algorithmOptimalSolver(mockData):
+    client = app.test_client()
+
+    res = client.get('/get_users')
+    users = json.loads(res.json)
+
+    res = client.put('/put_timetable', json=users)
+    assert res.status_code == 200
+    greedyStats = res.json['stats']
+
+    res = client.put('/put_timetable?solver=optimal', json=users)
+    assert res.status_code == 200
+    optimalStats = res.json['stats']
+
+    assert optimalStats['solver'] == 'optimal'
+    assert optimalStats['totalScore'] >= greedyStats['totalScore'] - 1e-9
+    assert optimalStats['wallTime'] >= 0
+
+# Tests optimal solver finds the pairing a greedy pass misses
+def test_algorithmOptimalBeatsGreedy():
+    # The higher priority user fits both rooms but greedily takes the only room the other user fits
+    users = [
+        makeUser(1, 10, [{'_id': 1, 'quantity': 1}]),
+        makeUser(2, 1, [{'_id': 2, 'quantity': 1}])
+    ]
+    rooms = [
+        makeRoom(1, 10, [{'_id': 1, 'quantity': 1}, {'_id': 2, 'quantity': 1}]),
+        makeRoom(2, 20, [{'_id': 1, 'quantity': 1}])
+    ]
+
+    greedy = allocateRooms(users, rooms, solver='greedy')
+    optimal = allocateRooms(users, rooms, solver='optimal')
+
+    assert greedy['stats']['assignedUsers'] == 1
+    assert optimal['stats']['assignedUsers'] == 2
+    assert optimal['stats']['totalScore'] > greedy['stats']['totalScore']
+
+# Tests parallel partitioned allocation produces the same timetable as the serial run
+def test_algorithmParallelPartitions(mockData, monkeypatch):
+    monkeypatch.setattr('main.server.MAX_WORKERS', 2)
+    client = app.test_client()
+
+    res = client.get('/get_users')
+    users = json.loads(res.json)
+
+    res = client.put('/put_timetable', json=users)
+    assert res.status_code == 200
+    expected = json.loads(client.get('/get_timetable').json)
+
+    res = client.put('/put_timetable?workers=2', json=users)
+    assert res.status_code == 200
+    assert res.json['stats']['partitions'] == 2
+    actual = json.loads(client.get('/get_timetable').json)
+
+    assert actual == expected
+
+# Tests worker counts above MAX_WORKERS are rejected
+def test_algorithmWorkerLimit(mockData, monkeypatch):
+    monkeypatch.setattr('main.server.MAX_WORKERS', 2)
+    client = app.test_client()
+
+    res = client.put('/put_timetable?workers=3', json=[])
+
+    assert res.status_code == 400
+
+# Tests additional partition keys act as hard constraints
+def test_algorithmPartitionKeys(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+    for user in users:
+        user['roomPreference']['building'] = 'North'
+    for room in rooms:
+        room['attributes']['building'] = 'North' if room['_id'] == 4 else 'South'
+
+    result = allocateRooms(users, rooms, partitionKeys=('chemicalUse', 'building'))
+
+    assert result['stats']['partitions'] == 1
+    assert {a.roomId for a in result['assignments'].values()} == {4}
+
+# Tests incremental re-roster after an unavailability change matches a full regeneration
+def test_algorithmRerosterUnavailability(mockData):
+    client = app.test_client()
+
+    res = client.get('/get_users')
+    users = json.loads(res.json)
+    res = client.put('/put_timetable', json=users)
+    assert res.status_code == 200
+
+    # User 1 stops working Mondays
+    unavailability = dict(users[0]['unavailability'], Monday=True)
+    res = client.put(
+        '/put_unavailability?reroster=true',
+        json={'userId': 1, 'unavailability': unavailability}
+    )
+    assert res.status_code == 200
+    actual = json.loads(client.get('/get_timetable').json)
+
+    res = client.get('/get_users')
+    res = client.put('/put_timetable', json=json.loads(res.json))
+    expected = json.loads(client.get('/get_timetable').json)
+
+    assert actual == expected
+    assert [e['user_id'] for e in actual[0]['timetable']['Monday']] == [4]
+
+# Tests a bulk update with reroster regenerates the timetable once for every user
+def test_bulkReroster(mockData, monkeypatch):
+    client = app.test_client()
+    users = database.usersGet()
+    assert client.put('/put_timetable', json=users).status_code == 200
+
+    regenerations = []
+    regenerateTimetable = database.regenerateTimetable
+    monkeypatch.setattr(database, 'rerosterUser', lambda userId: pytest.fail('repaired one user'))
+    monkeypatch.setattr(database, 'regenerateTimetable',
+                        lambda userIds: regenerations.append(userIds) or regenerateTimetable(userIds))
+    res = client.put('/put_unavailabilities?reroster=true', json=[
+        {'userId': 1, 'unavailability': dict(users[0]['unavailability'], Monday=True)},
+        {'userId': 2, 'unavailability': dict(users[1]['unavailability'], Tuesday=True)},
+        {'userId': 99, 'unavailability': users[0]['unavailability']}
+    ])
+    assert res.status_code == 200
+    assert regenerations == [[1, 2]]
+    actual = client.get('/get_timetable').json
+
+    assert client.put('/put_timetable', json=database.usersGet()).status_code == 200
+    assert client.get('/get_timetable').json == actual
+    assert database.regenerateTimetable([99]) is False
+
+# Tests incremental re-roster hands a freed room to an unassigned user
+def test_algorithmRerosterFreedRoom(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+
+    # User 4 only fits the workbench room once user 3 leaves the pipette room
+    users[3]['roomPreference']['equipment'] = [{'_id': 5, 'quantity': 20}]
+    initial = allocateRooms(users, rooms)
+    assert 4 not in initial['assignments']
+
+    users[2]['unavailability'] = {day: True for day in users[2]['unavailability']}
+    result = repairAllocation(users, rooms, initial['assignments'], 3)
+
+    assert 3 not in result['assignments']
+    assert result['assignments'][4].roomId == 4
+    assert result['stats']['repairedUsers'] == [3, 4]
+    assert result['timetable'] == allocateRooms(users, rooms)['timetable']
+
+# Tests indexed engine produces the same assignments as the python engine
+def test_algorithmIndexedEngine(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+
+    expected = allocateRooms(users, rooms, engine='python')
+    actual = allocateRooms(users, rooms, engine='indexed')
+
+    assert actual['assignments'] == expected['assignments']
+    assert actual['timetable'] == expected['timetable']
+
+# Tests room index skips rooms that cannot beat the threshold and supports removal
+def test_roomIndexPruning(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+    index = RoomIndex(rooms)
+    user = User.fromDocument(users[2])
+
+    # User 3 needs pipettes, only the pipette room can reach the threshold
+    roomIdx, score = index.bestRoom(user)
+    assert rooms[roomIdx]['_id'] == 4
+    assert score == calculateRoomScore(users[2], rooms[roomIdx])
+    assert index.pruned > 0
+
+    index.remove(roomIdx)
+    assert index.bestRoom(user) == (None, 0)
+
+# Tests documents convert to compact models and assignments round trip
+def test_modelsFromDocuments(mockData):
+    user = User.fromDocument(database.usersGet()[2])
+    room = Room.fromDocument(database.roomsGet()[3])
+
+    assert user.unavailability == (True, True, True, True, False)
+    assert user.equipment == ((2, 10), (4, 10), (5, 20))
+    assert room.equipment == {2: 15, 4: 15, 5: 30}
+    assert not hasattr(user, '__dict__')
+    assert scoreRoom(user, room) == calculateRoomScore(database.usersGet()[2], database.roomsGet()[3])
+
+    assignment = Assignment(user.id, room.id, room.name, 1.0)
+    assert Assignment.fromDocument(assignment.toDocument()) == assignment
+
+# Tests metrics record database calls and allocation counters when enabled
+def test_metricsEndpoint(mockData):
+    client = app.test_client()
+    users = database.usersGet()
+
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        res = client.put('/put_timetable?engine=indexed', json=users)
+        stats = res.json['stats']
+        body = client.get('/metrics').get_data(as_text=True)
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+
+    # Users unavailable all week are never considered
+    available = [u for u in users if not all(u['unavailability'].values())]
+    assert stats['assignedUsers'] + stats['unassignedUsers'] == len(available)
+    assert 'roomroster_db_call_seconds_count{method="changeTimetable"} 1' in body
+    assert 'roomroster_db_call_seconds_count{method="saveTimetable"} 1' in body
+    assert 'roomroster_allocation_phase_seconds_count{phase="assign"} 1' in body
+    assert ('roomroster_score_evaluations_total{engine="indexed",solver="greedy"} '
+            f"{stats['scoreEvaluations']}") in body
+    assert '# TYPE roomroster_users_assigned_total counter' in body
+
+    # Nothing is recorded while disabled
+    client.put('/put_timetable', json=users)
+    assert client.get('/metrics').get_data(as_text=True) == ''
+
+# Tests timetable jobs run in the background and can be polled
+def test_timetableJob(mockData):
+    client = app.test_client()
+    users = database.usersGet()
+
+    res = client.post('/timetable_jobs?engine=indexed', json=users)
+    assert res.status_code == 202
+    jobId = res.json['jobId']
+    assert res.headers['Location'] == f'/timetable_jobs/{jobId}'
+
+    timetableJobs.wait(jobId, timeout=10)
+    res = client.get(f'/timetable_jobs/{jobId}')
+    assert res.status_code == 200
+    assert res.json['status'] == 'done'
+    assert res.json['result']['engine'] == 'indexed'
+    assert 'progress' in res.json
+    assert json.loads(client.get('/get_timetable').json)[0]['timetable'] == \
+        allocateRooms(users, database.roomsGet())['timetable']
+
+    assert client.get('/timetable_jobs/unknown').status_code == 404
+    assert client.post('/timetable_jobs?solver=fastest', json=users).status_code == 400
+
+# Tests identical submissions share one job while it is pending, and failures are reported
+def test_jobManagerDeduplicates():
+    manager = JobManager()
+    release = threading.Event()
+
+    first, created = manager.submit('same', release.wait, 10)
+    second, duplicate = manager.submit('same', release.wait, 10)
+    other, _ = manager.submit('other', lambda: 1 / 0)
+    assert created and not duplicate
+    assert first == second
+    assert other != first
+    assert manager.get(other)['status'] == 'queued'
+
+    release.set()
+    assert manager.wait(first, timeout=10)['result'] is True
+    failed = manager.wait(other, timeout=10)
+    assert failed['status'] == 'failed'
+    assert 'division by zero' in failed['error']
+
+    # Finished jobs no longer absorb new submissions
+    third, created = manager.submit('same', lambda: 'again')
+    assert created and third != first
+
+# Tests allocation phases are reported as job progress
+def test_jobProgress(mockData):
+    phases = []
+    stats = allocateRooms(database.usersGet(), database.roomsGet(), progress=lambda **fields: phases.append(fields))['stats']
+    partitions = stats['partitions']
+    assert [p['partitionsDone'] for p in phases if p['phase'] == 'assign'] == list(range(partitions + 1))
+    assert phases[-1] == {'phase': 'timetable', 'partitionsDone': partitions, 'partitions': partitions}
+
+    manager = JobManager()
+    release = threading.Event()
+    def job(progress):
+        progress(phase='assign', partitionsDone=1, partitions=2)
+        release.wait(10)
+        return 'done'
+    jobId, _ = manager.submit('progress', job, reportProgress=True)
+    assert manager.get(jobId)['progress'] in (None, {'phase': 'assign', 'partitionsDone': 1, 'partitions': 2})
+    release.set()
+    assert manager.wait(jobId, timeout=10)['progress'] == {'phase': 'assign', 'partitionsDone': 1, 'partitions': 2}
+
+# Tests resubmitting an unchanged roster reuses the memoized timetable
+def test_timetableMemo(mockData, monkeypatch):
+    client = app.test_client()
+    users = database.usersGet()
+    runs = []
+    allocate = data.allocateRooms
+    monkeypatch.setattr(data, 'allocateRooms', lambda *a, **k: runs.append(1) or allocate(*a, **k))
+
+    first = client.put('/put_timetable', json=users).json['stats']
+    expected = json.loads(client.get('/get_timetable').json)
+    assert not first['cached']
+
+    # A hit skips the algorithm and, while the stored timetable is unchanged, the write
+    database.db['timetable'].update_one({'_id': 1}, {'$set': {'marker': True}})
+    second = client.put('/put_timetable', json=users).json['stats']
+    assert second['cached']
+    assert second['totalScore'] == first['totalScore']
+    assert len(runs) == 1
+    assert json.loads(client.get('/get_timetable').json)[0]['marker']
+
+    # A reroster replaces the stored timetable, so the next hit writes it back
+    database.rerosterUser(users[0]['_id'])
+    assert client.put('/put_timetable', json=users).json['stats']['cached']
+    assert json.loads(client.get('/get_timetable').json)[0]['timetable'] == expected[0]['timetable']
+    assert len(runs) == 1
+
+    # Changed rooms or a different solver miss the memo
+    database.db['rooms'].update_one({'_id': 1}, {'$set': {'attributes.capacity': 99}})
+    assert not client.put('/put_timetable', json=users).json['stats']['cached']
+    assert not client.put('/put_timetable?solver=optimal', json=users).json['stats']['cached']
+    assert len(runs) == 3
+
+# Tests timetable writes record versions and deltas hold only changed days
+def test_timetableVersions(mockData):
+    client = app.test_client()
+    users = database.usersGet()
+    database.db['timetable'].drop()
+    database.db['timetableHistory'].drop()
+
+    client.put('/put_timetable', json=users)
+    full = client.get('/get_timetable?since=0').json
+    assert full['version'] == 1
+    assert full['changes'] == json.loads(client.get('/get_timetable').json)[0]['timetable']
+
+    # Rerostering a user now available only on Friday rewrites the days they left, not Friday
+    users[0]['unavailability'] = {day: day != 'Friday' for day in users[0]['unavailability']}
+    database.db['users'].update_one({'_id': users[0]['_id']}, {'$set': {'unavailability': users[0]['unavailability']}})
+    database.rerosterUser(users[0]['_id'])
+    delta = client.get('/get_timetable?since=1').json
+    current = json.loads(client.get('/get_timetable').json)[0]['timetable']
+    assert delta['version'] == 2
+    assert not delta['full']
+    assert 'Friday' not in delta['changes']
+    assert delta['changes'] and all(current[day] == entries for day, entries in delta['changes'].items())
+
+    # Nothing new since the current version; unchanged timetables bump no version
+    assert client.get('/get_timetable?since=2').json == {'version': 2, 'full': False, 'changes': {}}
+    assert database.saveTimetable(current) == 2
+
+    # Versions older than the kept history fall back to the whole timetable
+    database.db['timetableHistory'].delete_one({'_id': 1})
+    assert client.get('/get_timetable?since=0').json == {'version': 2, 'full': True, 'changes': current}
+    assert client.get('/get_timetable?since=x').status_code == 400
+
+# Tests a timetable write diffed against a stale version retries over the newer write
+def test_timetableConcurrentWrite(mockData, monkeypatch):
+    database.db['timetable'].drop()
+    database.db['timetableHistory'].drop()
+    empty = {day: [] for day in DAYS}
+    first = dict(empty, Monday=[{'user_id': 1}])
+    second = dict(empty, Tuesday=[{'user_id': 2}])
+    assert database.saveTimetable(empty) == 1
+
+    # Another writer stores its timetable right after this one reads the current version
+    collectionType = type(database.db['timetable'])
+    findOne = collectionType.find_one
+    raced = []
+    def racingFindOne(self, *args, **kwargs):
+        current = findOne(self, *args, **kwargs)
+        if self.name == 'timetable' and not raced:
+            raced.append(None)
+            raced[0] = database.saveTimetable(second)
+        return current
+    monkeypatch.setattr(collectionType, 'find_one', racingFindOne)
+
+    assert database.saveTimetable(first) == 3
+    assert raced == [2]
+    assert json.loads(app.test_client().get('/get_timetable').json)[0]['timetable'] == first
+    assert database.timetableDelta(2)['changes'] == {'Monday': first['Monday'], 'Tuesday': []}
+
+# Tests index bootstrap and allocation input filtered inside the database
+def test_allocationModelsGet(mockData, monkeypatch):
+    # The first request a process serves creates the indexes
+    monkeypatch.setattr('main.server.indexesEnsured', False)
+    assert app.test_client().get('/get_equipment').status_code == 200
+    assert 'run_1_index_1' in database.db['scenarios'].index_information()
+    names = database.ensureIndexes()
+    assert 'run_1_index_1' in names
+    assert database.ensureIndexes() == names
+
+    documents = database.usersGet()
+    available = [u['_id'] for u in documents if not all(u['unavailability'].values())]
+    users, rooms = database.allocationModelsGet()
+    assert [user.id for user in users] == available
+    assert rooms == database.roomModelsGet()
+    assert allocateRooms(users, rooms)['timetable'] == allocateRooms(documents, database.roomsGet())['timetable']
+
+    someUsers, _ = database.allocationModelsGet(userIds=available[::-1])
+    assert [user.id for user in someUsers] == available[::-1]
+
+# Tests MongoClient options are read from environment variables
+def test_clientOptionsFromEnv():
+    environ = {'MONGO_MAX_POOL_SIZE': '50', 'MONGO_READ_PREFERENCE': 'secondaryPreferred', 'MONGO_APP_NAME': ''}
+    assert data.clientOptionsFromEnv(environ) == {'maxPoolSize': 50, 'readPreference': 'secondaryPreferred'}
+
+# Tests server-side generation matches allocating the fetched users
+def test_generateTimetable(mockData):
+    client = app.test_client()
+    users = database.usersGet()
+
+    res = client.put('/generate_timetable?engine=indexed')
+    assert res.status_code == 200
+    expected = allocateRooms(users, database.roomsGet())
+    assert json.loads(client.get('/get_timetable').json)[0]['timetable'] == expected['timetable']
+    assert res.json['stats']['assignedUsers'] == expected['stats']['assignedUsers']
+
+    # Only the requested users are rostered, and users unavailable all week are never fetched
+    unavailable = [u['_id'] for u in users if all(u['unavailability'].values())]
+    res = client.put('/generate_timetable', json={'userIds': [users[2]['_id']] + unavailable})
+    assert res.json['stats']['assignedUsers'] + res.json['stats']['unassignedUsers'] == 1
+    assert database.db['allocation'].find_one({'_id': 1})['userIds'] == [users[2]['_id']]
+    assert client.put('/generate_timetable', json={'userIds': 3}).status_code == 400
+    assert client.put('/generate_timetable', json={'userIds': [[1]]}).status_code == 400
+    assert client.put('/generate_timetable', json={'userIds': [{'$ne': None}]}).status_code == 400
+
+# Tests Phase 2 schedules users only on days set in their availability bitmask
+def test_userAvailabilityMask(mockData):
+    user = User.fromDocument(database.usersGet()[2])
+    assert user.availability == 0b10000
+
+    result = allocateRooms([user], database.roomsGet())
+    assert [day for day, entries in result['timetable'].items() if entries] == ['Friday']
+
+# Tests daily scheduling shares a room between users available on different days
+def test_dailyMode(mockData):
+    users = [makeUser(1, days=['Monday']), makeUser(2, days=['Tuesday']), makeUser(3, days=['Monday'])]
+    rooms = [makeRoom(1, name='Lab')]
+
+    week = allocateRooms(users, rooms)
+    assert week['stats']['assignedUsers'] == 1
+
+    for solver in SOLVERS:
+        daily = allocateRooms(users, rooms, solver=solver, mode='daily')
+        assert daily['stats']['assignedUsers'] == 2
+        assert daily['stats']['bookings'] == 2
+        assert daily['timetable']['Monday'] == [{'user_id': 1, 'user_name': 'User 1', 'room_id': 1, 'room_name': 'Lab'}]
+        assert [e['user_id'] for e in daily['timetable']['Tuesday']] == [2]
+
+        slotted = allocateRooms(users, rooms, solver=solver, mode='daily', slots=2)
+        assert slotted['stats']['assignedUsers'] == 3
+        assert sorted((e['user_id'], e['slot']) for e in slotted['timetable']['Monday']) == [(1, 0), (3, 1)]
+        # Later slots stay empty once every available user is booked
+        assert allocateRooms(users, rooms, solver=solver, mode='daily', slots=24)['timetable'] == slotted['timetable']
+
+# Tests daily scheduling through the timetable route on the test roster
+def test_dailyModeRoute(mockData):
+    client = app.test_client()
+    users = database.usersGet()
+
+    week = client.put('/put_timetable', json=users).json['stats']
+    res = client.put('/put_timetable?mode=daily&engine=indexed', json=users)
+    assert res.status_code == 200
+    assert res.json['stats']['mode'] == 'daily'
+    assert res.json['stats']['assignedUsers'] >= week['assignedUsers']
+    assert database.rerosterUser(users[0]['_id']) is False
+
+    assert client.put('/put_timetable?mode=hourly', json=users).status_code == 400
+    assert client.put('/put_timetable?slots=2', json=users).status_code == 400
+    assert client.put('/put_timetable?mode=daily&slots=1000000', json=users).status_code == 400
+
+# Tests dependency closures follow chains, stop at cycles and expand requirements
+def test_dependencyClosures(mockData):
+    closures = dependencyClosures(database.equipmentGet())
+    assert closures[5] == (4, 2)
+    assert closures[2] == ()
+    assert dependencyClosures([
+        {'_id': 1, 'name': 'A', 'dependentId': 2},
+        {'_id': 2, 'name': 'B', 'dependentId': 1}
+    ]) == {1: (2,), 2: (1,)}
+
+    user = User.fromDocument(dict(database.usersGet()[0], roomPreference={
+        'capacity': 5, 'chemicalUse': False, 'equipment': [{'_id': 5, 'quantity': 3}, {'_id': 2, 'quantity': 4}]
+    }))
+    assert expandUser(user, closures).equipment == ((5, 3), (2, 4), (4, 1))
+
+    # Closures are computed once per catalog version
+    assert database.equipmentClosures() is database.equipmentClosures()
+    cached = database.equipmentClosures()
+    database.invalidateEquipmentCache()
+    assert database.equipmentClosures() is not cached
+
+# Tests dependency-aware scoring prefers rooms that have what requested items depend on
+def test_dependencyScoring(mockData):
+    user = dict(database.usersGet()[0], roomPreference={
+        'capacity': 10, 'chemicalUse': False, 'equipment': [{'_id': 5, 'quantity': 10}]
+    })
+    rooms = [
+        {'_id': 1, 'name': 'Mats only', 'attributes': {
+            'capacity': 10, 'chemicalUse': False, 'equipment': [{'_id': 5, 'quantity': 10}]}},
+        {'_id': 2, 'name': 'Full bench', 'attributes': {
+            'capacity': 10, 'chemicalUse': False,
+            'equipment': [{'_id': 5, 'quantity': 8}, {'_id': 4, 'quantity': 1}, {'_id': 2, 'quantity': 1}]}}
+    ]
+    closures = database.equipmentClosures()
+
+    assert allocateRooms([user], rooms)['assignments'][user['_id']].roomId == 1
+    for engine in ('python', 'numpy', 'indexed'):
+        result = allocateRooms([user], rooms, engine=engine, closures=closures)
+        assert result['assignments'][user['_id']].roomId == 2
+
+    client = app.test_client()
+    res = client.put('/put_timetable?dependencies=true', json=database.usersGet())
+    assert res.status_code == 200
+    assert database.db['allocation'].find_one({'_id': 1})['dependencies'] is True
+
+# Tests a room lacking an item's dependency does not count that item at all
+def test_dependencyGating(mockData):
+    # Bunsen burners (1) depend on a workbench (2), which this room lacks
+    users = [makeUser(1, 10, [{'_id': 1, 'quantity': 2}])]
+    rooms = [makeRoom(1, 10, [{'_id': 1, 'quantity': 5}], name='Burners only')]
+    closures = {1: (2,)}
+
+    assert allocateRooms(users, rooms)['assignments'][1].roomId == 1
+    for engine in ('python', 'numpy', 'indexed'):
+        for solver in ('greedy', 'optimal'):
+            result = allocateRooms(users, rooms, engine=engine, solver=solver, closures=closures)
+            assert 1 not in result['assignments']
+            assert result['stats']['assignedUsers'] == 0
+
+    rooms.append(makeRoom(2, 10, [{'_id': 1, 'quantity': 2}, {'_id': 2, 'quantity': 1}], name='Bench'))
+    for engine in ('python', 'numpy', 'indexed'):
+        assert allocateRooms(users, rooms, engine=engine, closures=closures)['assignments'][1].roomId == 2
+
+# Tests the local search places a user stranded by greedy tie-breaking
+def test_localSearch(mockData):
+    # User 1 scores both labs equally and takes the first, which user 2 needs
+    users = [makeUser(1, 20), makeUser(2, 5, [{'_id': 7, 'quantity': 1}])]
+    rooms = [makeRoom(1, 10, [{'_id': 7, 'quantity': 1}], name='Lab A'), makeRoom(2, 10, name='Lab B')]
+
+    greedy = allocateRooms(users, rooms)
+    assert greedy['stats']['assignedUsers'] == 1
+    assert 'localSearch' not in greedy['stats']
+
+    for engine in ('python', 'numpy', 'indexed'):
+        improved = allocateRooms(users, rooms, engine=engine, improveTime=1)
+        assert improved['stats']['assignedUsers'] == 2
+        assert improved['assignments'][1].roomId == 2
+        assert improved['assignments'][2].roomId == 1
+        search = improved['stats']['localSearch']
+        assert search['moves'] == 1
+        assert search['assignedGain'] == 1
+        assert math.isclose(improved['stats']['totalScore'], greedy['stats']['totalScore'] + search['scoreGain'])
+
+    # Never worse than greedy on the test roster
+    users = database.usersGet()
+    rooms = database.roomsGet()
+    greedy = allocateRooms(users, rooms)['stats']
+    improved = allocateRooms(users, rooms, improveTime=1)['stats']
+    assert improved['assignedUsers'] >= greedy['assignedUsers']
+    assert improved['totalScore'] >= greedy['totalScore'] - 1e-9
+
+    client = app.test_client()
+    res = client.put('/put_timetable?improve=0.5', json=users)
+    assert res.status_code == 200
+    assert 'localSearch' in res.json['stats']
+    assert client.put('/put_timetable?improve=-1', json=users).status_code == 400
+    assert client.put('/put_timetable?improve=1&mode=daily', json=users).status_code == 400
+
+# Tests cached score matrices match fresh ones and only changed pairs are rescored
+def test_scoreCache(mockData):
+    users = [User.fromDocument(u) for u in database.usersGet()]
+    rooms = [Room.fromDocument(r) for r in database.roomsGet()]
+    expected = calculateScoreMatrix(users, rooms)
+    distinct = len({(u.capacity, u.chemicalUse, u.equipment) for u in users})
+
+    cache = ScoreCache(store=database.db['scoreCache'])
+    counters = {'scoreEvaluations': 0}
+    assert np.array_equal(cache.matrix(users, rooms, counters), expected, equal_nan=True)
+    assert counters == {'scoreEvaluations': distinct * len(rooms), 'scoreCacheHits': 0}
+
+    # One room changed: only its column is scored again
+    rooms[0] = Room(rooms[0].id, rooms[0].name, rooms[0].capacity + 7, rooms[0].chemicalUse,
+                    rooms[0].equipment, rooms[0].extra)
+    counters = {'scoreEvaluations': 0}
+    assert np.array_equal(cache.matrix(users, rooms, counters), calculateScoreMatrix(users, rooms), equal_nan=True)
+    assert counters == {'scoreEvaluations': distinct, 'scoreCacheHits': distinct * (len(rooms) - 1)}
+
+    # A fresh cache on the same collection starts from the stored rows
+    counters = {'scoreEvaluations': 0}
+    reloaded = ScoreCache(store=database.db['scoreCache'])
+    assert np.array_equal(reloaded.matrix(users, rooms, counters), calculateScoreMatrix(users, rooms), equal_nan=True)
+    assert counters['scoreEvaluations'] == 0
+
+    # A detached copy, as sent to worker processes, keeps the rows but not the store
+    detached = pickle.loads(pickle.dumps(reloaded.detached()))
+    assert detached.store is None
+    counters = {'scoreEvaluations': 0}
+    assert np.array_equal(detached.matrix(users, rooms, counters), calculateScoreMatrix(users, rooms), equal_nan=True)
+    assert counters['scoreEvaluations'] == 0
+
+    for solver in SOLVERS:
+        plain = allocateRooms(users, rooms, engine='numpy', solver=solver)
+        cached = allocateRooms(users, rooms, engine='numpy', solver=solver, scoreCache=cache)
+        assert cached['assignments'] == plain['assignments']
+        assert cached['stats']['scoreEvaluations'] == 0
+        assert cached['stats']['scoreCacheHits'] > 0
+
+    # Scalar greedy passes never build a matrix, even with a cache given
+    empty = ScoreCache()
+    for engine in ('python', 'indexed'):
+        plain = allocateRooms(users, rooms, engine=engine, scoreCache=empty)
+        assert plain['stats']['scoreCacheHits'] == 0
+        assert len(empty.rows) == 0
+
+# Tests scenarios are evaluated on their own rooms and stored without touching the live timetable
+def test_scenarios(mockData):
+    users = database.usersGet()
+    rooms = database.roomsGet()
+    closed = rooms[0]['_id']
+    scenarios = [
+        {'name': 'base'},
+        {'name': 'closed', 'closeRooms': [closed]},
+        {'name': 'equipped', 'addEquipment': [{'roomId': closed, 'equipmentId': 5, 'quantity': 3}]}
+    ]
+
+    for engine, solver in (('python', 'greedy'), ('numpy', 'greedy'), ('numpy', 'optimal')):
+        results = runScenarios(users, rooms, scenarios, engine=engine, solver=solver, maxWorkers=2)
+        assert [r['name'] for r in results] == ['base', 'closed', 'equipped']
+        base = allocateRooms(users, rooms, engine=engine, solver=solver)
+        assert results[0]['assignments'] == base['assignments']
+        assert all(a.roomId != closed for a in results[1]['assignments'].values())
+        if engine == 'numpy':
+            # Worker processes reuse the base scores computed before dispatch
+            assert results[1]['stats']['scoreEvaluations'] == 0
+        equipped = dict(rooms[0], attributes=dict(rooms[0]['attributes'], equipment=(
+            rooms[0]['attributes']['equipment'] + [{'_id': 5, 'quantity': 3}])))
+        assert results[2]['assignments'] == allocateRooms(
+            users, [equipped] + rooms[1:], engine=engine, solver=solver)['assignments']
+
+    with pytest.raises(ValueError):
+        runScenarios(users, rooms, [{'name': 'a'}, {'name': 'a'}])
+    with pytest.raises(ValueError):
+        runScenarios(users, rooms, [{'name': 'a', 'closeRooms': ['nope']}])
+    for equipmentId in ({'$gt': 0}, [5], None):
+        with pytest.raises(ValueError):
+            runScenarios(users, rooms, [{'name': 'a', 'addEquipment': [
+                {'roomId': closed, 'equipmentId': equipmentId, 'quantity': 1}]}])
+
+    client = app.test_client()
+    before = client.get('/get_timetable').json
+    res = client.post('/scenarios?engine=numpy', json={'scenarios': scenarios})
+    assert res.status_code == 200
+    runId = res.json['runId']
+    assert [r['name'] for r in res.json['results']] == ['base', 'closed', 'equipped']
+    assert client.get('/get_timetable').json == before
+
+    stored = client.get(f'/scenarios/{runId}')
+    assert stored.status_code == 200
+    assert [r['name'] for r in stored.json] == ['base', 'closed', 'equipped']
+    assert stored.json[1]['scenario'] == {'name': 'closed', 'closeRooms': [closed]}
+    assert client.get('/scenarios/unknown').status_code == 404
+    assert client.post('/scenarios', json={'scenarios': [{'name': 'x', 'bulldoze': True}]}).status_code == 400
+    assert client.post('/scenarios', json={'scenarios': scenarios, 'userIds': [[1]]}).status_code == 400
+    assert client.post('/scenarios', json={'scenarios': [{'name': 'x', 'closeRooms': [[closed]], 'addEquipment': [
+        {'roomId': closed, 'equipmentId': {'_id': 5}, 'quantity': 1}]}]}).status_code == 400
+
+# Tests every engine scores and thresholds with a configured policy
+def test_scoringPolicy(mockData):
+    users = [User.fromDocument(u) for u in database.usersGet()]
+    rooms = [Room.fromDocument(r) for r in database.roomsGet()]
+    policy = ScoringPolicy(capacityWeight=0.5, equipmentWeight=0.5, threshold=0.7,
+                           undersizedScore=0.1, capacityBonus=0.1)
+
+    scores = calculateScoreMatrix(users, rooms, policy)
+    for u, user in enumerate(users):
+        for r, room in enumerate(rooms):
+            score = policy.scoreRoom(user, room)
+            assert (score is None and math.isnan(scores[u, r])) or score == scores[u, r]
+    assert scoreRoom(users[0], rooms[0]) == DEFAULT_POLICY.scoreRoom(users[0], rooms[0])
+
+    greedy = [allocateRooms(users, rooms, engine=engine, policy=policy) for engine in ('python', 'numpy', 'indexed')]
+    assert greedy[0]['assignments'] == greedy[1]['assignments'] == greedy[2]['assignments']
+    assert all(a.score > 0.7 for a in greedy[0]['assignments'].values())
+    assert greedy[0]['stats']['threshold'] == 0.7
+    # The policy is recompiled in worker processes
+    parallel = allocateRooms(users, rooms, solver='optimal', maxWorkers=2, policy=policy)
+    assert parallel['assignments'] == allocateRooms(users, rooms, solver='optimal', policy=policy)['assignments']
+
+    with pytest.raises(ValueError):
+        ScoringPolicy.fromDocument({'threshold': 1.5})
+    with pytest.raises(ValueError):
+        ScoringPolicy.fromDocument({'weight': 1})
+
+    client = app.test_client()
+    assert client.get('/scoring_policy').json == DEFAULT_POLICY.toDocument()
+    default = client.put('/put_timetable', json=database.usersGet()).json['stats']
+    res = client.put('/scoring_policy', json={'threshold': 0.9})
+    assert res.status_code == 200
+    assert res.json == dict(DEFAULT_POLICY.toDocument(), threshold=0.9)
+    strict = client.put('/put_timetable', json=database.usersGet()).json['stats']
+    assert strict['cached'] is False
+    assert strict['threshold'] == 0.9
+    assert strict['assignedUsers'] <= default['assignedUsers']
+    assert client.put('/scoring_policy', json={'capacityWeight': -1}).status_code == 400
+    # A policy stored by another worker process applies to the next allocation
+    database.db['config'].replace_one({'_id': 'scoringPolicy'}, {'threshold': 0.8})
+    assert database.scoringPolicy().threshold == 0.8
+    assert database.scoringPolicy() is database.scoringPolicy()
+
+    results = runScenarios(users, rooms, [{'name': 'base'}, {'name': 'strict', 'policy': {'threshold': 0.9}}])
+    assert results[1]['stats']['threshold'] == 0.9
+    with pytest.raises(ValueError):
+        runScenarios(users, rooms, [{'name': 'bad', 'policy': {'threshold': -1}}])
+
+# Tests importing and constructing never connect, and a forked process gets its own client
+def test_lazyConnection(mockData):
+    import subprocess
+    import sys
+    pure = subprocess.run(
+        [sys.executable, '-c', "import sys, main.algorithm; sys.exit('pymongo' in sys.modules)"],
+        cwd='src'
+    )
+    assert pure.returncode == 0
+
+    lazy = data.Database(uri='mongodb://localhost:1/', clientOptions={'connect': False}, persistScores=True)
+    assert lazy.clientHandle is None and lazy.dbHandle is None
+    client = lazy.client
+    assert lazy.client is client
+    assert lazy.db.name == 'data'
+    assert lazy.scoreCache.store.database is lazy.db
+
+    # As seen from a child process after a fork
+    lazy.clientPid = -1
+    assert lazy.db is not None
+    assert lazy.client is not client
+    assert lazy.scoreCache.store.database is lazy.db
+    client.close()
+    lazy.client.close()
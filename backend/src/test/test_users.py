@@ -1,4 +1,7 @@
 from main.server import app, database
+from main import encoding
+from bson import ObjectId
+from bson.json_util import dumps
 from mongomock import MongoClient
 from flask import jsonify
 import pytest
@@ -25,6 +28,8 @@ def mockData():
             data = json.load(file)
             for d in data:
                 database.db['users'].insert_one(d)
+        # Equipment was written directly to the collection, bypassing the cache
+        database.invalidateEquipmentCache()
         yield
         database.db['equipment'].drop()
         database.db['rooms'].drop()
@@ -138,6 +143,22 @@ def test_putUserUnavailabilityInvalidId(mockData):
 
     assert res.status_code == 404
 
+# Tests /put_unavailability rejects schedules missing a weekday or not boolean
+def test_putUserUnavailabilityInvalidData(mockData):
+    client = app.test_client()
+    unavailability = {'Monday': False, 'Tuesday': False, 'Wednesday': False, 'Thursday': False, 'Friday': True}
+
+    for inputData in (
+        {'userId': 1, 'unavailability': {'Monday': True}},
+        {'userId': 1, 'unavailability': dict(unavailability, Friday='yes')},
+        {'userId': 1, 'unavailability': dict(unavailability, Saturday=True)},
+        {'userId': [1], 'unavailability': unavailability},
+        {'userId': 1}
+    ):
+        assert client.put('/put_unavailability', json=inputData).status_code == 400
+    assert client.put('/put_unavailability', data='nope').status_code == 400
+    assert database.db['users'].find_one({'_id': 1})['unavailability'] != {'Monday': True}
+
 # Tests successful /put_room_preference route
 def test_putUserRoomPreferenceSuccess(mockData):
     client = app.test_client()
@@ -279,4 +300,177 @@ def test_getRoom(mockData):
     actual = json.loads(res.json)
 
     assert res.status_code == 200
-    assert actual == expected
\ No newline at end of file
+    assert actual == expected
+
+# Tests equipment catalog is cached until invalidated
+def test_equipmentCacheInvalidation(mockData):
+    client = app.test_client()
+    res = client.get('/get_equipment')
+    assert len(json.loads(res.json)) == 2
+
+    database.db['equipment'].insert_one({'_id': 3, 'name': 'Beaker', 'dependentId': 2})
+    res = client.get('/get_equipment')
+    assert len(json.loads(res.json)) == 2
+
+    database.invalidateEquipmentCache()
+    res = client.get('/get_equipment')
+    assert len(json.loads(res.json)) == 3
+
+# Tests equipment catalog is re-read once the cache TTL expires
+def test_equipmentCacheTtl(mockData):
+    database.equipmentCacheTtl = 0
+    try:
+        assert len(database.equipmentGet()) == 2
+        database.db['equipment'].insert_one({'_id': 3, 'name': 'Beaker', 'dependentId': 2})
+        assert database.equipmentNames()[3] == 'Beaker'
+    finally:
+        database.equipmentCacheTtl = None
+
+# Tests /get_users enriched by a MongoDB aggregation matches the python join
+def test_getUsersAggregate(mockData):
+    client = app.test_client()
+
+    expected = json.loads(client.get('/get_users').json)
+    res = client.get('/get_users?enrichment=aggregate')
+    actual = json.loads(res.json)
+
+    assert res.status_code == 200
+    assert actual == expected
+
+# Tests /get_users returns only the requested fields
+def test_getUsersFields(mockData):
+    client = app.test_client()
+
+    for enrichment in ['python', 'aggregate']:
+        res = client.get(f'/get_users?enrichment={enrichment}&fields=name,roomPreference')
+        actual = json.loads(res.json)
+
+        assert res.status_code == 200
+        assert actual == [{
+            '_id': 1,
+            'name': 'John Johnson',
+            'roomPreference': {
+                'capacity': 1,
+                'chemicalUse': True,
+                'equipment': [{'_id': 1, 'name': 'Chair', 'quantity': 1}]
+            }
+        }]
+
+    res = client.get('/get_users?enrichment=sql')
+    assert res.status_code == 400
+
+# Tests /get_users pages through users with a resume token
+def test_getUsersPaginated(mockData):
+    client = app.test_client()
+    for userId in [2, 3]:
+        database.db['users'].insert_one({
+            '_id': userId,
+            'name': f'User {userId}',
+            'isManager': False,
+            'unavailability': {},
+            'roomPreference': {'capacity': 1, 'chemicalUse': False, 'equipment': []}
+        })
+
+    res = client.get('/get_users?limit=2')
+    firstPage = json.loads(res.data)
+    assert res.status_code == 200
+    assert [user['_id'] for user in firstPage['items']] == [1, 2]
+    assert firstPage['items'][0]['roomPreference']['equipment'][0]['name'] == 'Chair'
+
+    res = client.get(f"/get_users?limit=2&after={firstPage['next']}")
+    secondPage = json.loads(res.data)
+    assert [user['_id'] for user in secondPage['items']] == [3]
+    assert secondPage['next'] is None
+
+    res = client.get('/get_users?limit=2&after=notatoken')
+    assert res.status_code == 400
+
+# Tests /get_users streams one user per line as NDJSON
+def test_getUsersNdjson(mockData):
+    client = app.test_client()
+    res = client.get('/get_users?format=ndjson')
+
+    lines = res.data.decode().splitlines()
+    assert res.status_code == 200
+    assert res.mimetype == 'application/x-ndjson'
+    assert [json.loads(line) for line in lines] == json.loads(client.get('/get_users').json)
+
+# Tests format=json returns plain JSON instead of a JSON encoded string
+def test_getEquipmentPlainJson(mockData):
+    client = app.test_client()
+
+    nested = client.get('/get_equipment')
+    plain = client.get('/get_equipment?format=json')
+
+    assert isinstance(nested.json, str)
+    assert plain.json == json.loads(nested.json)
+
+# Tests the nested string format can be switched off for every client
+def test_nestedJsonStringsDisabled(mockData):
+    client = app.test_client()
+    app.config['NESTED_JSON_STRINGS'] = False
+    try:
+        res = client.get('/get_room/1')
+    finally:
+        app.config['NESTED_JSON_STRINGS'] = True
+
+    assert res.status_code == 200
+    assert res.json['name'] == 'Clancy'
+
+# Tests BSON types encode like bson.json_util with and without orjson
+def test_encodeBsonTypes(monkeypatch):
+    document = {'_id': ObjectId('65f1c0ffee0ddba11cafe000'), 'items': [1, 'two', None]}
+    expected = json.loads(dumps(document))
+
+    assert json.loads(encoding.encode(document)) == expected
+    monkeypatch.setattr(encoding, 'orjson', None)
+    assert json.loads(encoding.encode(document)) == expected
+
+# Tests bulk room preference updates report a status per item
+def test_putUserRoomPreferencesBulk(mockData):
+    client = app.test_client()
+    preference = {'capacity': 25, 'chemicalUse': False, 'equipment': [{'_id': 2, 'quantity': 25}]}
+
+    res = client.put('/put_room_preferences', json=[
+        dict(preference, userId=1),
+        dict(preference, userId=99),
+        {'userId': 1, 'capacity': 5},
+        dict(preference, userId=True),
+        dict(preference, userId=1, capacity=50)
+    ])
+
+    assert res.status_code == 200
+    assert res.json == {
+        'updated': 1,
+        'results': [
+            {'userId': 1, 'status': 'updated'},
+            {'userId': 99, 'status': 'not_found'},
+            {'userId': 1, 'status': 'invalid'},
+            {'userId': True, 'status': 'invalid'},
+            {'userId': 1, 'status': 'duplicate'}
+        ]
+    }
+    user = database.db['users'].find_one({'_id': 1})
+    assert user['roomPreference'] == preference
+
+    assert client.put('/put_room_preferences', json={'userId': 1}).status_code == 400
+
+# Tests bulk unavailability updates report a status per item
+def test_putUserUnavailabilitiesBulk(mockData):
+    client = app.test_client()
+    unavailability = {'Monday': False, 'Tuesday': True, 'Wednesday': False, 'Thursday': True, 'Friday': False}
+
+    res = client.put('/put_unavailabilities', json=[
+        {'userId': 1, 'unavailability': unavailability},
+        {'userId': 2, 'unavailability': unavailability},
+        {'userId': 1, 'unavailability': 'never'},
+        {'userId': 1, 'unavailability': {'Monday': True}},
+        {'userId': 1, 'unavailability': dict(unavailability, Friday='yes')},
+        {'userId': 1, 'unavailability': dict(unavailability, Saturday=True)},
+        {'userId': True, 'unavailability': unavailability}
+    ])
+
+    assert res.status_code == 200
+    assert [r['status'] for r in res.json['results']] == ['updated', 'not_found'] + ['invalid'] * 5
+    assert database.db['users'].find_one({'_id': 1})['unavailability'] == unavailability
+    assert client.put('/put_unavailabilities', json=[]).json == {'updated': 0, 'results': []}